@@ -1,25 +1,8 @@
 import streamlit as st
 
-import pandas as pd
-import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.patches import Rectangle
-
-from datetime import datetime
-from io import BytesIO
-
-from PIL import Image
-from google.cloud import storage
-from google.cloud import bigquery
-from google.oauth2 import service_account
-
 
 st.set_page_config(layout='wide', page_title='CAP - Home')
 
-credentials = service_account.Credentials.from_service_account_file('xxx-6d563dad79b2.json')
-storage_client = storage.Client(project='xxx', credentials=credentials)
-bq_client = bigquery.Client(project='xxx', credentials=credentials)
-
 
 st.markdown("# Homepage")
 st.write(
@@ -0,0 +1,431 @@
+"""
+Synthetic warehouse and creatives served through in-process stand-ins of the BigQuery and Cloud Storage clients,
+so the page pipelines can run without credentials (see benchmarks/offline.py).
+
+The fake BigQuery client answers the queries the app builds (core.query_utils and the snapshot export) from
+pandas tables; it is not a SQL engine. FakeWarehouse.write_extracts writes the same tables as local extracts, for
+the DuckDB backend (core.backend_utils) to run the real SQL on. The fake Storage client serves generated JPEG creatives.
+
+Example:
+    warehouse = fakes.make_warehouse(campaigns=500)
+    cl.set_client('bigquery', fakes.FakeBigQueryClient(warehouse))
+    cl.set_client('storage', fakes.FakeStorageClient(fakes.make_creatives(warehouse)))
+"""
+import io
+import re
+import time
+import datetime
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from PIL import Image, ImageDraw
+
+import core.sl_utils as sl
+import core.query_utils as qu
+
+
+MARKETS = ['SG', 'ID', 'MY', 'NZ', 'PH', 'VN']
+OBJECTIVES = ['Awareness', 'Conversion (PO)', 'Conversion (Launch)', 'Conversion (Sustain)', 'Engagement']
+DIVISIONS = ['MX', 'VD', 'DA'] # VD and DA are recategorized as CE by the pages
+POD_LABELS = ['hero', 'kv', 'product', 'offer', 'banner', 'cta', 'feature', 'review', 'footer']
+POD_POSITIONS = ['Top', 'Middle', 'Bottom', 'Footers']
+HEIGHT_BINS = ['0-10%', '10-20%', '20-40%', '40-60%', '60-100%']
+SEGMENTS = ['SEG01', 'SEG02', 'SEG03', 'SEG04']
+WORDS = (
+    'new galaxy deal save exclusive offer today only limited launch discover smart home upgrade free gift bundle '
+    'members early access pre order now last chance weekend sale week get yours experience power meet the ultimate '
+    'ai camera screen fold flip watch buds tab tv fridge washer'
+).split()
+
+
+def make_subject_lines(rng, n, min_words=4, max_words=10):
+    # Random word sequences, some with an emoji or a question mark, like the real subject lines
+    lengths = rng.integers(min_words, max_words + 1, n)
+    words = rng.choice(WORDS, lengths.sum())
+    lines = [' '.join(w).capitalize() for w in np.split(words, np.cumsum(lengths)[:-1])]
+    suffixes = rng.choice(['', '', '', '!', '?', ' 🎁'], n)
+    return [line + suffix for line, suffix in zip(lines, suffixes)]
+
+
+def make_features(rng, n):
+    # Subject line features: CUTES scores in [0, 1], one-hot length, binary flags
+    features = {c: rng.random(n).round(3) for c in sl.list_sl_cutes}
+    length = rng.integers(0, len(sl.list_sl_length), n)
+    features.update({c: (length == i).astype(float) for i, c in enumerate(sl.list_sl_length)})
+    features.update({c: (rng.random(n) < 0.3).astype(float) for c in sl.list_sl_binary})
+    return features
+
+
+def make_warehouse(campaigns=200, min_pods=3, max_pods=15, subject_lines=2000, push_share=0.3, start=datetime.date(2024, 1, 1), days=365, seed=0):
+    """
+    Generates the tables the app reads, keyed by their names in core.query_utils.TABLES and BP_TABLES, with the
+    columns named as the app projects them.
+
+    Args:
+        campaigns (int): Campaigns, EMAIL and PUSH.
+        min_pods, max_pods (int): Range of the pod count of an EMAIL campaign's click report.
+        subject_lines (int): Best practice subject lines per market (and product and objective, for EMAIL).
+        push_share (float): Share of PUSH campaigns.
+        start (datetime.date): First campaign date.
+        days (int): Days campaigns are spread over.
+        seed (int): Random seed, the same arguments always give the same warehouse.
+
+    Returns:
+        FakeWarehouse: The tables.
+    """
+    rng = np.random.default_rng(seed)
+    n = campaigns
+
+    delivered = rng.integers(10_000, 500_000, n)
+    opened = (delivered * rng.uniform(0.1, 0.4, n)).astype(int)
+    segments = rng.choice(SEGMENTS, n)
+    channels = np.where(rng.random(n) < push_share, 'PUSH', 'EMAIL')
+    countries = rng.choice(MARKETS, n)
+
+    # Benchmarks are per market, segment and channel
+    bm_keys = pd.MultiIndex.from_product([MARKETS, SEGMENTS, ['EMAIL', 'PUSH']])
+    df_benchmark = bm_keys.to_frame(index=False, name=['Market_Area', 'Segment', 'Channel']).assign(
+        open_rate=rng.uniform(0.15, 0.3, len(bm_keys)).round(4),
+        ctr=rng.uniform(0.02, 0.08, len(bm_keys)).round(4),
+    )
+
+    df_campaigns = pd.DataFrame({
+        'campaign_id': [f'{i:010d}' for i in range(n)],
+        'channel': channels,
+        'product': rng.choice(DIVISIONS, n),
+        'country': countries,
+        'date': [start + datetime.timedelta(days=int(d)) for d in rng.integers(0, days, n)],
+        'campaign_name': [f'2024_CAMPAIGN_NAME_PREFX_{s}_{i}' for i, s in enumerate(segments)], # SUBSTR(name, 26, 5) is the segment
+        'segment_name': segments,
+        'bm_segment': segments,
+        'delivered': delivered,
+        'opened': opened,
+        'clicked': (opened * rng.uniform(0.01, 0.1, n)).astype(int),
+        'subject_line': make_subject_lines(rng, n),
+        'ticker': make_subject_lines(rng, n, 2, 4),
+        'text': make_subject_lines(rng, n, 6, 14),
+        **make_features(rng, n),
+    })
+
+    # Click report: one row per pod of each EMAIL campaign, click rates and heights summing to 1 per campaign
+    email = df_campaigns[df_campaigns['channel'] == 'EMAIL']
+    pod_counts = rng.integers(min_pods, max_pods + 1, len(email))
+    pod_campaign = np.repeat(np.arange(len(email)), pod_counts)
+    pod_index = np.arange(len(pod_campaign)) - np.repeat(np.cumsum(pod_counts) - pod_counts, pod_counts)
+
+    def per_campaign_shares():
+        weights = rng.gamma(1.0, 1.0, len(pod_campaign))
+        return weights / np.bincount(pod_campaign, weights)[pod_campaign]
+
+    click_rate = per_campaign_shares()
+    is_footer = pod_index == pod_counts[pod_campaign] - 1
+    positions = np.where(is_footer, 'Footers', rng.choice(POD_POSITIONS[:-1], len(pod_campaign)))
+    height_bins = rng.choice(HEIGHT_BINS, len(pod_campaign))
+    # Pod benchmarks are per position and relative height
+    bm_keys = pd.MultiIndex.from_product([POD_POSITIONS, HEIGHT_BINS])
+    df_bm_click_rate = bm_keys.to_frame(index=False, name=['position', 'height_pct_bin']).assign(click_rate=rng.uniform(0.02, 0.3, len(bm_keys)).round(4))
+    pod_ctr = click_rate * rng.uniform(0.01, 0.06, len(pod_campaign))
+    df_click_report = pd.DataFrame({
+        'campaign_id': email['campaign_id'].to_numpy()[pod_campaign],
+        'country': email['country'].to_numpy()[pod_campaign],
+        'date': email['date'].to_numpy()[pod_campaign],
+        'pod': pod_index,
+        'height': per_campaign_shares(),
+        'click_rate': click_rate,
+        'pod_ctr': pod_ctr,
+        'pod_ctr_with_unsub': pod_ctr * 1.05,
+        'click_rate_excl_footer': np.where(is_footer, 0.0, click_rate),
+        'click_rate_with_unsub': click_rate,
+        'label_name': np.where(is_footer, 'footer', rng.choice(POD_LABELS[:-1], len(pod_campaign))),
+        'url': [f'https://example.com/pods/{c}/{p}.jpg' for c, p in zip(pod_campaign, pod_index)],
+        'position': positions,
+        'height_bin': height_bins,
+    })
+
+    tables = {
+        qu.TABLES['campaigns']: df_campaigns,
+        qu.TABLES['click_report']: df_click_report,
+        qu.TABLES['benchmark']: df_benchmark, # dimension tables are already in their warehouse form
+        qu.TABLES['bm_click_rate']: df_bm_click_rate,
+    }
+
+    # Best practice tables: feature rows per top_flag and ranked subject lines (top_flag 1 best performing, 0 others)
+    for channel, (feature_table, perf_table) in qu.BP_TABLES.items():
+        if channel == 'EMAIL':
+            keys = pd.MultiIndex.from_product([MARKETS, ['MX', 'CE'], OBJECTIVES], names=['country', 'product', 'objective']).to_frame(index=False)
+        else:
+            keys = pd.DataFrame({'country': MARKETS})
+
+        flags = pd.DataFrame({'top_flag': qu.BP_FEATURE_FLAGS})
+        df_features = keys.merge(flags, how='cross')
+        features = make_features(rng, len(df_features))
+        is_direction = (df_features['top_flag'] == 'direction').to_numpy()
+        for c in sl.list_sl_all:
+            features[c] = np.where(is_direction, rng.choice([-1.0, 1.0], len(df_features)), features[c])
+        tables[feature_table] = pd.concat([df_features, pd.DataFrame(features)], axis=1)
+
+        df_perf = keys.loc[keys.index.repeat(subject_lines)].reset_index(drop=True)
+        df_perf['top_flag'] = (rng.random(len(df_perf)) < 0.2).astype(int)
+        df_perf['subject_line'] = make_subject_lines(rng, len(df_perf))
+        df_perf['rank'] = df_perf.groupby(list(keys.columns) + ['top_flag']).cumcount() + 1
+        tables[perf_table] = df_perf
+
+    return FakeWarehouse(tables)
+
+
+class FakeWarehouse:
+    """
+    The synthetic tables, {table name: DataFrame}.
+    """
+
+    def __init__(self, tables):
+        self.tables = tables
+
+    def select(self, table, columns=None, **filters):
+        """
+        Returns the rows of a table matching all filters (a list value matches any of its items), like core.snapshot_utils.Snapshot.select.
+        """
+        df = self.tables[table]
+        mask = np.ones(len(df), dtype=bool)
+        for column, value in filters.items():
+            if value is None:
+                continue
+            if isinstance(value, (list, tuple)):
+                mask &= df[column].isin(value).to_numpy()
+            else:
+                mask &= (df[column] == value).to_numpy()
+        df = df[mask]
+        return (df[columns] if columns is not None else df).reset_index(drop=True)
+
+    def warehouse_tables(self):
+        """
+        Returns the tables as they are in the warehouse, with the warehouse column names (e.g. HYBRIS_ID for
+        campaign_id, taken from the core.query_utils column specs) and the tables the queries join.
+
+        Returns:
+            dict: {table name: DataFrame}
+        """
+        def source_names(column_specs):
+            # {page-side name: warehouse column} for the columns read from c
+            names = {}
+            for name, (expr, join) in column_specs.items():
+                match = re.search(r'\bc\.(\w+)', expr)
+                if join is None and match and match.group(1) not in names.values(): # the first column derived from it, e.g. campaign_name not bm_segment
+                    names[name] = match.group(1)
+            return names
+
+        campaign_names = dict(source_names(qu.CAMPAIGN_COLUMNS), channel='Channel')
+        df_campaigns = self.tables[qu.TABLES['campaigns']]
+        df_click_report = self.tables[qu.TABLES['click_report']]
+        email = df_campaigns[df_campaigns['channel'] == 'EMAIL']
+
+        tables = {
+            qu.TABLES['campaigns']: df_campaigns[list(campaign_names)].rename(columns=campaign_names),
+            qu.TABLES['campaign_asset_push']: df_campaigns.loc[df_campaigns['channel'] == 'PUSH', ['campaign_id', 'ticker', 'text']].rename(columns={'campaign_id': 'HYBRIS_ID'}),
+            qu.TABLES['subject_line']: email[['subject_line'] + sl.list_sl_all].drop_duplicates('subject_line'),
+            qu.TABLES['benchmark']: self.tables[qu.TABLES['benchmark']],
+            qu.TABLES['bm_click_rate']: self.tables[qu.TABLES['bm_click_rate']],
+        }
+        click_names = dict(source_names(qu.CLICK_REPORT_COLUMNS), country='Market_Area', date='date')
+        tables[qu.TABLES['click_report']] = df_click_report[list(click_names)].rename(columns=click_names)
+        for table in (t for pair in qu.BP_TABLES.values() for t in pair):
+            tables[table] = self.tables[table]
+        return tables
+
+    def write_extracts(self, extract_dir):
+        """
+        Writes the warehouse tables as the local extracts of core.backend_utils.DuckDBBackend, incl. the manifest.
+
+        Returns:
+            dict: The manifest written.
+        """
+        import core.backend_utils as be
+
+        tables = self.warehouse_tables()
+
+        class Source:
+            # Serves the whole tables to core.backend_utils.export_extracts
+            def run(self, query, label=None, **kwargs):
+                return tables[query.tables[0]]
+
+        return be.export_extracts(extract_dir=extract_dir, backend=Source())
+
+
+def make_creatives(warehouse, width=600, min_height=1500, max_height=4000, variants=8, missing=0.05, seed=0):
+    """
+    Generates the JPEG creative of every campaign, at the paths the app looks them up (core.img_utils.get_blob_paths).
+    Only `variants` distinct images are encoded and shared between campaigns, to keep generation fast.
+
+    Returns:
+        dict: {bucket name: {path: bytes}}
+    """
+    rng = np.random.default_rng(seed)
+    images = []
+    for _ in range(variants):
+        height = int(rng.integers(min_height, max_height + 1))
+        img = Image.new('RGB', (width, height), 'white')
+        draw = ImageDraw.Draw(img)
+        top = 0
+        while top < height: # colored pods with some detail, so that the JPEG does not compress to nothing
+            pod_height = int(rng.integers(150, 600))
+            draw.rectangle([0, top, width, top + pod_height], fill=tuple(int(c) for c in rng.integers(0, 256, 3)))
+            for _ in range(20):
+                x, y = int(rng.integers(0, width)), top + int(rng.integers(0, pod_height))
+                draw.ellipse([x, y, x + 40, y + 40], fill=tuple(int(c) for c in rng.integers(0, 256, 3)))
+            top += pod_height
+        buf = io.BytesIO()
+        img.save(buf, format='JPEG', quality=85)
+        images.append(buf.getvalue())
+
+    objects = {'creative-edm': {}, 'creative-push': {}}
+    df = warehouse.tables[qu.TABLES['campaigns']]
+    for i, (cid, country, channel) in enumerate(zip(df['campaign_id'], df['country'].str.lower(), df['channel'])):
+        if rng.random() < missing:
+            continue
+        content = images[i % variants]
+        if channel == 'EMAIL':
+            objects['creative-edm'][f'{country}/{cid}.jpg'] = content
+        else:
+            objects['creative-push'][f'phone/display/{country}/{cid}.jpg'] = content
+    return objects
+
+
+class FakeRows:
+    # What QueryJob.result() returns: a RowIterator
+    def __init__(self, table):
+        self._table = table
+        self.total_rows = table.num_rows
+
+    def to_arrow(self, **kwargs):
+        return self._table
+
+    def to_dataframe(self, **kwargs):
+        return self._table.to_pandas()
+
+
+class FakeQueryJob:
+    def __init__(self, table, latency=0.0, dry_run=False):
+        self._table = table
+        self._latency = latency
+        self.job_id = f'fake-{id(self):x}'
+        self.total_bytes_processed = table.nbytes if table is not None else 0
+        self.total_bytes_billed = 0 if dry_run else self.total_bytes_processed
+        self.cache_hit = False
+        self.slot_millis = 0
+
+    def result(self):
+        time.sleep(self._latency)
+        return FakeRows(self._table)
+
+
+class FakeBigQueryClient:
+    """
+    Stands in for bigquery.Client: query() answers the queries of core.query_utils and the snapshot export from a
+    FakeWarehouse. Each job waits `latency` seconds in result(), like a round trip to the service would.
+    """
+
+    def __init__(self, warehouse, latency=0.0):
+        self.warehouse = warehouse
+        self.latency = latency
+        self.queries = [] # query texts, in order
+
+    def query(self, query, job_config=None):
+        self.queries.append(query)
+        params = {}
+        if job_config is not None:
+            for p in job_config.query_parameters:
+                params[p.name] = p.values if hasattr(p, 'values') else p.value
+        df = self._answer(query, params)
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        dry_run = job_config is not None and bool(job_config.dry_run)
+        return FakeQueryJob(table, latency=0.0 if dry_run else self.latency, dry_run=dry_run)
+
+    def _answer(self, query, params):
+        table = re.search(r'FROM `([^`]+)`', query).group(1)
+        wh = self.warehouse
+
+        if re.match(r'\s*SELECT \* FROM', query): # snapshot export
+            return wh.tables[table]
+
+        if 'UNION ALL' in query: # core.query_utils.best_practice_query
+            import core.bp_utils as bp
+            channel = next(c for c, (features, _) in qu.BP_TABLES.items() if features == table)
+            return bp.select_best_practice(wh, channel, params['market'], objective=params.get('objective'), product=params.get('product'))
+
+        if table == qu.BP_TABLES['EMAIL'][0]: # core.query_utils.reference_query
+            return wh.select(table, columns=['top_flag'] + sl.list_sl_all, country=params['country'], product=params['product'],
+                             objective=params['objective'], top_flag=params['top_flags'])
+
+        # core.query_utils.campaign_query and click_report_query: projected columns come back under their aliases
+        select = query[:query.index('FROM')]
+        columns = re.findall(r'\bAS (\w+)', select)
+        df = wh.tables[table]
+        mask = np.ones(len(df), dtype=bool)
+        if 'campaign_ids' in params:
+            mask &= df['campaign_id'].isin(params['campaign_ids']).to_numpy()
+        if 'market' in params:
+            mask &= (df['country'] == params['market']).to_numpy()
+        if 'start_date' in params:
+            start, end = (pd.Timestamp(params[k]).date() for k in ('start_date', 'end_date'))
+            mask &= ((df['date'] >= start) & (df['date'] <= end)).to_numpy()
+        if 'channel' in params:
+            mask &= (df['channel'] == params['channel']).to_numpy()
+        df = df.loc[mask, columns]
+
+        order = re.search(r'ORDER BY (.+)$', query.strip())
+        if order and order.group(1).startswith('c.date'):
+            df = df.sort_values('date', kind='stable')
+        return df.reset_index(drop=True)
+
+
+class FakeBlob:
+    def __init__(self, bucket, name, generation=None):
+        self.bucket = bucket
+        self.name = name
+        self.generation = generation
+
+    def download_as_bytes(self, timeout=None):
+        from google.api_core.exceptions import NotFound
+
+        self.bucket.client._request()
+        content = self.bucket.objects.get(self.name)
+        if content is None:
+            raise NotFound(f'{self.bucket.name}/{self.name}')
+        return content
+
+
+class FakeBucket:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.objects = client.objects.get(name, {})
+
+    def get_blob(self, path, timeout=None):
+        self.client._request()
+        if path not in self.objects:
+            return None
+        return FakeBlob(self, path, generation=1)
+
+    def blob(self, path, generation=None):
+        return FakeBlob(self, path, generation=generation)
+
+
+class FakeStorageClient:
+    """
+    Stands in for storage.Client, serving objects from {bucket name: {path: bytes}}. Each request
+    (metadata or download) waits `latency` seconds.
+    """
+
+    def __init__(self, objects, latency=0.0):
+        self.objects = objects
+        self.latency = latency
+        self.requests = 0
+
+    def _request(self):
+        self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def bucket(self, name):
+        return FakeBucket(self, name)
@@ -0,0 +1,235 @@
+"""
+Offline benchmark: throughput and memory of the core modules and page pipelines on synthetic data, without credentials.
+
+A synthetic warehouse and creatives (benchmarks/fakes.py) are served through in-process fakes of the BigQuery and
+Storage clients, installed with core.client_utils.set_client. The pages are loaded with runpy (in Streamlit's bare
+mode, nothing is submitted) to reach their data functions. Caches and snapshots go to a temporary directory.
+With --backend duckdb, the warehouse is written as local extracts and the queries run on the DuckDB backend instead.
+
+Each benchmark is timed over --repeats runs (median reported), then run once more under tracemalloc for its peak
+Python-allocated memory (Arrow buffers are not counted).
+
+Usage (from the app directory):
+    python benchmarks/offline.py --campaigns 500 --max-pods 20 --gcs-latency 0.02
+    python benchmarks/offline.py --only draw_click_rate_bar,get_recommendations,score_campaigns
+    python benchmarks/offline.py --backend duckdb --only get_campaign_data
+"""
+import os
+import sys
+import glob
+import time
+import runpy
+import shutil
+import argparse
+import tempfile
+import statistics
+import tracemalloc
+from concurrent.futures import Future
+
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+
+def setup(args):
+    """
+    Points the caches to a temporary directory, installs the fake clients and loads the pages.
+
+    Returns:
+        dict: The benchmark context: warehouse, clients, page functions, campaign IDs.
+    """
+    cache_dir = tempfile.mkdtemp(prefix='cap-bench-')
+    # Read by the core modules at import time
+    os.environ.update(
+        CAP_CACHE_DIR=cache_dir,
+        CAP_QUERY_CACHE='1' if args.query_cache else '0',
+        CAP_BQ_STORAGE_API='0', # the fake serves Arrow tables directly
+        CAP_SNAPSHOT='1' if args.snapshot else '0',
+        CAP_QUERY_BACKEND=args.backend,
+        CAP_EXTRACT_DIR=os.path.join(cache_dir, 'extracts'),
+    )
+
+    import streamlit
+    streamlit.config.set_option('logger.level', 'error') # bare mode warns on every widget
+    streamlit.logger.set_log_level('error')
+
+    import fakes
+    import core.client_utils as cl
+    import core.query_utils as qu
+
+    t0 = time.perf_counter()
+    warehouse = fakes.make_warehouse(campaigns=args.campaigns, min_pods=args.min_pods, max_pods=args.max_pods, subject_lines=args.subject_lines, seed=args.seed)
+    creatives = fakes.make_creatives(warehouse, width=args.creative_width, max_height=args.creative_max_height, variants=args.creative_variants, seed=args.seed)
+    print(f'Synthetic data generated in {time.perf_counter() - t0:.1f}s')
+
+    bq_client = fakes.FakeBigQueryClient(warehouse, latency=args.bq_latency)
+    storage_client = fakes.FakeStorageClient(creatives, latency=args.gcs_latency)
+    cl.set_client('bigquery', bq_client)
+    cl.set_client('storage', storage_client)
+    if args.backend != 'bigquery':
+        warehouse.write_extracts(os.environ['CAP_EXTRACT_DIR'])
+
+    pages = {}
+    for path in sorted(glob.glob(os.path.join(APP_DIR, 'pages', '*.py'))):
+        pages[os.path.basename(path)[0]] = runpy.run_path(path, run_name='__offline_benchmark__')
+
+    df_campaigns = warehouse.tables[qu.TABLES['campaigns']]
+    email = df_campaigns[df_campaigns['channel'] == 'EMAIL']
+    market = email['country'].value_counts().index[0] # the market with the most campaigns
+
+    return {
+        'cache_dir': cache_dir,
+        'warehouse': warehouse,
+        'bq_client': bq_client,
+        'storage_client': storage_client,
+        'pages': pages,
+        'email_ids': email['campaign_id'].to_list(),
+        'market': market,
+        'start': df_campaigns['date'].min(),
+        'end': df_campaigns['date'].max(),
+    }
+
+
+def make_benchmarks(ctx, args):
+    """
+    Returns {name: (fn, items)}, fn running the benchmarked call once and items the count throughput is reported per.
+    Inputs are prepared here, outside of the timings.
+    """
+    import core.img_utils as im
+    import core.cp_utils as cp
+    import core.bp_utils as bp
+    import core.sl_utils as sl
+    import core.chart_utils as ch
+    import core.query_utils as qu
+    import fakes
+    import numpy as np
+
+    page1, page2 = ctx['pages']['1'], ctx['pages']['2']
+    campaign_input = ', '.join(ctx['email_ids'][:args.analysis_campaigns])
+
+    # Inputs of the per-campaign benchmarks: the Content Comparison result of the busiest market over the whole period
+    data_dict = page2['get_campaign_data'](channel='EMAIL', click_rate_display='Normal', sorting='Campaign Date', market=ctx['market'], date=(ctx['start'], ctx['end']))
+    img_dict, _ = im.get_img_from_dict(data_dict, ctx['storage_client'], 'creative-edm')
+    records = [data_dict[cid] for cid in img_dict]
+
+    df_ref = bp.get_reference_data(country=ctx['market'], product='MX', objective='Awareness')
+    df_campaigns = ctx['warehouse'].tables[qu.TABLES['campaigns']]
+    df_features = df_campaigns[df_campaigns['channel'] == 'EMAIL'] # one campaign per row, with the subject line features
+    # Every campaign against the reference of its market, product (as the pages recategorize it) and an objective
+    df_batch = df_features.assign(
+        product=df_features['product'].where(df_features['product'] == 'MX', 'CE'),
+        objective=[fakes.OBJECTIVES[i % len(fakes.OBJECTIVES)] for i in range(len(df_features))],
+    )
+    batch_keys = list(zip(df_batch['country'], df_batch['product'], df_batch['objective']))
+    batch_outperform = np.arange(len(df_batch)) % 2 == 1
+    batch_models = bp.get_recommendation_models(batch_keys)
+
+    perf_table = qu.BP_TABLES['EMAIL'][1]
+    df_perf = ctx['warehouse'].select(perf_table, country=ctx['market'], product='MX', objective='Awareness')
+    best_text = ' '.join(df_perf.loc[df_perf['top_flag'] == 1, 'subject_line'])
+    cold_runs = iter(range(10 ** 9))
+
+    def get_campaign_data_analysis():
+        page1['get_campaign_data'](campaign_id=campaign_input, objective='Awareness')[5].result('creative')
+
+    def get_campaign_data_comparison():
+        page2['get_campaign_data'](channel='EMAIL', click_rate_display='Normal', sorting='Campaign Date', market=ctx['market'], date=(ctx['start'], ctx['end']))
+
+    def draw_click_rate_bars():
+        for record in records:
+            im.draw_click_rate_bar(img_dict[record.campaign_id], record, click_data_type='Pod click contribution')
+
+    def submit_click_rate_bars():
+        # As the pages do: one bar per fetched creative, rendered in-process or in the pool (CAP_RENDER_WORKERS)
+        futures = []
+        for cid, img in img_dict.items():
+            img_future = Future()
+            img_future.set_result(img)
+            futures.append(im.submit_click_rate_bar(img_future, data_dict[cid].pods(), 'Pod click contribution'))
+        for future in futures:
+            future.result()
+
+    def cold_wordcloud():
+        ch.generate_circular_wordcloud(f'{best_text} run{next(cold_runs)}') # a new text each run misses the word cloud cache
+
+    def recommendations():
+        for i in range(len(df_features)):
+            sl.get_recommendations(df_features.iloc[[i]], df_ref, outperform=bool(i % 2))
+
+    n_analysis = min(args.analysis_campaigns, len(ctx['email_ids']))
+    return {
+        'get_campaign_data (Campaign Content Analysis)': (get_campaign_data_analysis, n_analysis),
+        'get_campaign_data (Content Comparison)': (get_campaign_data_comparison, len(data_dict)),
+        'get_img_from_dict (no cache)': (lambda: im.get_img_from_dict(data_dict, ctx['storage_client'], 'creative-edm', use_cache=False), len(data_dict)),
+        'get_img_from_dict (warm cache)': (lambda: im.get_img_from_dict(data_dict, ctx['storage_client'], 'creative-edm'), len(data_dict)),
+        'draw_click_rate_bar': (draw_click_rate_bars, len(records)),
+        'render_click_rate_bars (process pool)': (lambda: im.render_click_rate_bars(img_dict, data_dict.pods, 'Pod click contribution'), len(img_dict)),
+        'submit_click_rate_bar': (submit_click_rate_bars, len(img_dict)),
+        'generate_circular_wordcloud (cold)': (cold_wordcloud, 1),
+        'generate_circular_wordcloud (warm)': (lambda: ch.generate_circular_wordcloud(best_text), 1),
+        'get_distinctive_terms': (lambda: sl.get_distinctive_terms(df_perf.loc[df_perf['top_flag'] == 1, 'subject_line'], df_perf.loc[df_perf['top_flag'] == 0, 'subject_line']), len(df_perf)),
+        'get_recommendations': (recommendations, len(df_features)),
+        'get_recommendation_models': (lambda: bp.get_recommendation_models(batch_keys), len(batch_models)),
+        'score_campaigns': (lambda: sl.score_campaigns(df_batch, batch_models, batch_outperform), len(df_batch)),
+        'PodStore.from_click_report': (lambda: cp.PodStore.from_click_report(ctx['warehouse'].tables[qu.TABLES['click_report']]), len(ctx['warehouse'].tables[qu.TABLES['click_report']])),
+    }
+
+
+def measure(fn, repeats, memory=True):
+    fn() # warm-up: imports, pools and first-use caches are not what is measured
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+
+    peak_mb = None
+    if memory:
+        tracemalloc.start()
+        fn()
+        peak_mb = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+    return statistics.median(times), peak_mb
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--campaigns', type=int, default=300, help='Synthetic campaigns (EMAIL and PUSH)')
+    parser.add_argument('--min-pods', type=int, default=3)
+    parser.add_argument('--max-pods', type=int, default=15)
+    parser.add_argument('--subject-lines', type=int, default=2000, help='Best practice subject lines per market, product and objective')
+    parser.add_argument('--analysis-campaigns', type=int, default=20, help='Campaign IDs entered on Campaign Content Analysis')
+    parser.add_argument('--creative-width', type=int, default=600)
+    parser.add_argument('--creative-max-height', type=int, default=4000)
+    parser.add_argument('--creative-variants', type=int, default=8, help='Distinct creatives generated, shared between campaigns')
+    parser.add_argument('--bq-latency', type=float, default=0.0, help='Seconds each fake query job takes')
+    parser.add_argument('--gcs-latency', type=float, default=0.0, help='Seconds each fake GCS request takes')
+    parser.add_argument('--backend', choices=['bigquery', 'duckdb', 'auto'], default='bigquery', help='Query backend: the fake BigQuery client or DuckDB over extracts')
+    parser.add_argument('--query-cache', action='store_true', help='Keep the local query cache on')
+    parser.add_argument('--snapshot', action='store_true', help='Serve best practice tables from the local snapshot')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--no-memory', action='store_true', help='Skip the tracemalloc run')
+    parser.add_argument('--only', default='', help='Comma-separated benchmark name prefixes')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    ctx = setup(args)
+    try:
+        benchmarks = make_benchmarks(ctx, args)
+        only = [o.strip() for o in args.only.split(',') if o.strip()]
+
+        print(f"{'benchmark':<46} {'items':>7} {'median s':>10} {'items/s':>11} {'peak MB':>9}")
+        for name, (fn, items) in benchmarks.items():
+            if only and not any(name.startswith(o) for o in only):
+                continue
+            seconds, peak_mb = measure(fn, args.repeats, memory=not args.no_memory)
+            peak = f'{peak_mb:>9.1f}' if peak_mb is not None else f"{'-':>9}"
+            print(f'{name:<46} {items:>7} {seconds:>10.4f} {items / max(seconds, 1e-9):>11.1f} {peak}')
+
+        print(f"\nFake BigQuery queries: {len(ctx['bq_client'].queries)}, fake GCS requests: {ctx['storage_client'].requests}")
+    finally:
+        shutil.rmtree(ctx['cache_dir'], ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""
+Result download benchmark: rows/sec and peak memory of downloading each page's query results, for every
+combination of download path (Storage Read API or REST) and dtype backend (pyarrow or numpy).
+
+Each query runs once in its own subprocess per combination, with the query cache disabled. The query job is
+waited for before timing starts, so only the download and DataFrame conversion are measured. Peak memory is
+the growth of the process' max RSS over the download.
+
+Needs credentials with access to the tables (see core.client_utils).
+
+Usage (from the app directory):
+    python benchmarks/query_download.py --campaign-ids 0000111111,0000222222 --market SG --start 2024-01-01 --end 2024-03-31
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+MODES = [
+    # (label, CAP_BQ_STORAGE_API, CAP_DTYPE_BACKEND)
+    ('storage/pyarrow', '1', 'pyarrow'),
+    ('storage/numpy', '1', 'numpy'),
+    ('rest/pyarrow', '0', 'pyarrow'),
+    ('rest/numpy', '0', 'numpy'),
+]
+
+
+def page_queries(args):
+    """
+    Returns {label: core.query_utils.Query} for the queries of each page, as the pages build them for the given filters.
+    """
+    import core.sl_utils as sl
+    import core.query_utils as qu
+
+    campaign_list = [c.strip() for c in args.campaign_ids.split(',') if c.strip()]
+    by_market_date = {'market': args.market, 'start_date': args.start, 'end_date': args.end}
+
+    queries = {
+        'campaign analysis: campaigns': qu.campaign_query(
+            'EMAIL',
+            ['campaign_id', 'product', 'country', 'date', 'campaign_name', 'delivered', 'opened', 'clicked', 'bm_segment', 'subject_line'] + sl.list_sl_all,
+            campaign_ids=campaign_list,
+        ),
+        'campaign analysis: click report': qu.click_report_query(
+            ['height', 'click_rate', 'pod_ctr', 'label_name', 'url', 'position', 'height_bin'],
+            campaign_ids=campaign_list,
+        ),
+        'content comparison: campaigns': qu.campaign_query(
+            'EMAIL',
+            ['country', 'campaign_id', 'subject_line', 'date', 'campaign_name', 'segment_name', 'delivered', 'opened', 'clicked'],
+            order_by='Campaign Date', **by_market_date,
+        ),
+        'content comparison: click report': qu.click_report_query(
+            ['height', 'click_rate', 'pod_ctr', 'pod_ctr_with_unsub', 'click_rate_excl_footer', 'click_rate_with_unsub', 'label_name'],
+            **by_market_date,
+        ),
+        'subject line bp: email': qu.best_practice_query('EMAIL', args.market, objective=args.objective, product=args.product),
+        'subject line bp: push': qu.best_practice_query('PUSH', args.market),
+        'dimension: benchmark': qu.table_query(qu.TABLES['benchmark']),
+        'dimension: bm_click_rate': qu.table_query(qu.TABLES['bm_click_rate']),
+        'subject line features': qu.Query(lambda d: f"SELECT {', '.join(['subject_line'] + sl.list_sl_all)} FROM {d.table(qu.TABLES['subject_line'])}", tables=[qu.TABLES['subject_line']]),
+    }
+    return queries
+
+
+def run_child(args):
+    # Runs one query in this process and prints its measurements as JSON
+    import core.bq_utils as bq
+    import core.client_utils as cl
+
+    query = page_queries(args)[args.child]
+    job = cl.get_bq_client().query(query.sql(), job_config=query.job_config())
+    job.result() # wait for the query, only the download is measured
+    bq.get_bqstorage_client() # create the Storage API client before measuring, as it is shared by all queries
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t0 = time.perf_counter()
+    df = bq.download_result(job)
+    elapsed = time.perf_counter() - t0
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    print(json.dumps({
+        'rows': len(df),
+        'seconds': elapsed,
+        'peak_mb': (rss_after - rss_before) / 1024, # ru_maxrss is in KB on Linux
+        'df_mb': df.memory_usage(deep=True).sum() / 2 ** 20,
+        'storage_api': bq.get_bqstorage_client() is not None,
+    }))
+
+
+def run_mode(args, label, storage_api, dtype_backend):
+    env = dict(os.environ, PYTHONPATH=APP_DIR, CAP_QUERY_CACHE='0', CAP_BQ_STORAGE_API=storage_api, CAP_DTYPE_BACKEND=dtype_backend)
+    cmd = [sys.executable, os.path.abspath(__file__), '--child', label] + args.forward
+    out = subprocess.run(cmd, cwd=APP_DIR, env=env, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--campaign-ids', default='', help='Comma-separated campaign IDs (Campaign Content Analysis)')
+    parser.add_argument('--market', default='SG')
+    parser.add_argument('--start', default='2024-01-01', help='Start date (Content Comparison)')
+    parser.add_argument('--end', default='2024-12-31', help='End date (Content Comparison)')
+    parser.add_argument('--objective', default='Awareness', help='Objective (Subject Line Best Practices)')
+    parser.add_argument('--product', default='MX', help='Product (Subject Line Best Practices)')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return run_child(args)
+
+    args.forward = [
+        '--campaign-ids', args.campaign_ids, '--market', args.market, '--start', args.start, '--end', args.end,
+        '--objective', args.objective, '--product', args.product,
+    ]
+
+    print(f"{'query':<34} {'mode':<16} {'rows':>9} {'rows/s':>11} {'peak MB':>9} {'frame MB':>9}")
+    for label in page_queries(args):
+        for mode, storage_api, dtype_backend in MODES:
+            r = run_mode(args, label, storage_api, dtype_backend)
+            if storage_api == '1' and not r['storage_api']:
+                mode += ' (REST)' # Storage API unavailable, fell back
+            print(f"{label:<34} {mode:<16} {r['rows']:>9} {r['rows'] / max(r['seconds'], 1e-9):>11.0f} "
+                  f"{r['peak_mb']:>9.1f} {r['df_mb']:>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+Query metrics report: aggregates the query executions exported by the app (CAP_QUERY_METRICS_FILE, see
+core.bq_utils.record_query_metrics) per call site: calls, local and BigQuery cache hits, queries run on DuckDB, wall time
+percentiles, bytes processed and slot time.
+
+Usage (from the app directory):
+    CAP_QUERY_METRICS_FILE=/tmp/cap-queries.jsonl streamlit run Home.py
+    python benchmarks/query_metrics.py /tmp/cap-queries.jsonl
+"""
+import sys
+import argparse
+
+import pandas as pd
+
+
+def summarize(df):
+    """
+    Returns one row per call site (label) with the aggregated metrics of its query executions.
+    """
+    df = df.assign(
+        label=df['label'].fillna('(unlabelled)'),
+        local_cache=df['source'] == 'cache',
+        refused=df['source'] == 'refused',
+        duckdb=df['source'] == 'duckdb',
+        bq_cache_hit=df['bq_cache_hit'].fillna(False).astype(bool),
+    )
+    grouped = df.groupby('label')
+    summary = pd.DataFrame({
+        'calls': grouped.size(),
+        'local cache %': grouped['local_cache'].mean() * 100,
+        'bq cache %': grouped['bq_cache_hit'].mean() * 100,
+        'duckdb %': grouped['duckdb'].mean() * 100,
+        'refused': grouped['refused'].sum(),
+        'p50 s': grouped['wall_seconds'].quantile(0.5),
+        'p95 s': grouped['wall_seconds'].quantile(0.95),
+        'max s': grouped['wall_seconds'].max(),
+        'GiB processed': grouped['bytes_processed'].sum() / 2 ** 30,
+        'max GiB': grouped['bytes_processed'].max() / 2 ** 30,
+        'slot s': grouped['slot_ms'].sum() / 1000,
+    })
+    return summary.sort_values('GiB processed', ascending=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('metrics_file', help='JSONL file written by the app (CAP_QUERY_METRICS_FILE)')
+    parser.add_argument('--since', type=float, default=None, help='Only executions after this Unix time')
+    args = parser.parse_args()
+
+    df = pd.read_json(args.metrics_file, lines=True)
+    if args.since is not None:
+        df = df[df['time'] >= args.since]
+    if df.empty:
+        sys.exit('No query executions recorded')
+
+    with pd.option_context('display.width', 200, 'display.max_columns', None, 'display.float_format', '{:.2f}'.format):
+        print(summarize(df))
+
+
+if __name__ == '__main__':
+    main()
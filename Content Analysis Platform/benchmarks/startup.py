@@ -0,0 +1,57 @@
+"""
+Startup benchmark: time-to-first-render of each page in a fresh interpreter, as after a scale-from-zero.
+
+Each page is run once with streamlit's AppTest (no browser, no form submitted) in its own subprocess, so
+module imports are paid the same way as by the first request a new container serves.
+
+Usage (from the app directory): python benchmarks/startup.py [--runs 3]
+"""
+import os
+import sys
+import json
+import glob
+import argparse
+import subprocess
+import statistics
+
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = '''
+import sys, time, json
+t0 = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+t1 = time.perf_counter()
+at = AppTest.from_file(sys.argv[1], default_timeout=120)
+at.run()
+t2 = time.perf_counter()
+print(json.dumps({"streamlit_import": t1 - t0, "first_render": t2 - t1, "errors": [str(e.value) for e in at.exception]}))
+'''
+
+
+def run_page(path):
+    # Wall time of the whole child process includes interpreter startup
+    env = dict(os.environ, PYTHONPATH=APP_DIR)
+    out = subprocess.run([sys.executable, '-c', CHILD, path], cwd=APP_DIR, env=env, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=3, help='Cold starts per page')
+    args = parser.parse_args()
+
+    pages = [os.path.join(APP_DIR, 'Home.py')] + sorted(glob.glob(os.path.join(APP_DIR, 'pages', '*.py')))
+
+    print(f"{'page':<45} {'streamlit import (s)':>21} {'first render (s)':>17}")
+    for path in pages:
+        results = [run_page(path) for _ in range(args.runs)]
+        errors = {e for r in results for e in r['errors']}
+        name = os.path.relpath(path, APP_DIR)
+        print(f"{name:<45} {statistics.median(r['streamlit_import'] for r in results):>21.3f} "
+              f"{statistics.median(r['first_render'] for r in results):>17.3f}"
+              + (f"  errors: {'; '.join(errors)}" if errors else ''))
+
+
+if __name__ == '__main__':
+    main()
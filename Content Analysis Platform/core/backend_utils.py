@@ -0,0 +1,242 @@
+"""
+Query backends: where the pages' queries (core.query_utils) run.
+
+- BigQueryBackend runs them in the warehouse, through core.bq_utils.run_query (query cache, metrics, byte budget).
+- DuckDBBackend runs the same logical queries in an embedded DuckDB over local Parquet extracts of the tables.
+
+CAP_QUERY_BACKEND picks the backend: 'bigquery' (default), 'duckdb' (everything local, e.g. offline or for
+testing), or 'auto', where a query runs locally when the extracts cover it (all its tables are extracted, for the
+market and date range it selects) and in BigQuery otherwise, so that hot markets get interactive latency.
+
+Extracts are exported from BigQuery, e.g. for the hot markets over the current quarter:
+
+    python -m core.backend_utils --markets SG,MY --start 2024-10-01 --end 2024-12-31
+"""
+import os
+import json
+import time
+import datetime
+import threading
+
+import pandas as pd
+
+import core.bq_utils as bq
+import core.cache_utils as cu
+import core.query_utils as qu
+import core.trace_utils as tr
+
+
+QUERY_BACKEND = os.environ.get('CAP_QUERY_BACKEND', 'bigquery') # 'bigquery', 'duckdb' or 'auto'
+EXTRACT_DIR = os.environ.get('CAP_EXTRACT_DIR', os.path.join(cu.CACHE_ROOT, 'extracts'))
+
+# Tables exported to the extracts: fact tables (and the dimension rows they use) for the extract's markets and
+# dates, the other tables whole
+EXTRACT_TABLES = [
+    qu.TABLES['campaigns'],
+    qu.TABLES['click_report'],
+    qu.TABLES['campaign_asset_push'],
+    qu.TABLES['subject_line'],
+    qu.TABLES['benchmark'],
+    qu.TABLES['bm_click_rate'],
+] + [table for tables in qu.BP_TABLES.values() for table in tables]
+FILTERED_EXTRACT_TABLES = [qu.TABLES[t] for t in ('campaigns', 'click_report', 'campaign_asset_push', 'subject_line')]
+MANIFEST = 'manifest.json'
+EXTRACT_VERSIONS_KEPT = 2 # Older versions may still be read by queries running in other processes
+
+
+class BigQueryBackend:
+    name = 'bigquery'
+    dialect = qu.BIGQUERY
+
+    def covers(self, query):
+        return True
+
+    def run(self, query, label=None, **kwargs):
+        """
+        Runs a query with core.bq_utils.run_query, kwargs (ttl, use_cache, bq_client) are passed on.
+        """
+        return bq.run_query(query.sql(self.dialect), job_config=query.job_config(), label=label, **kwargs)
+
+
+class DuckDBBackend:
+    """
+    Runs queries in an in-memory DuckDB database whose tables are views over the Parquet extracts of the current
+    version in extract_dir, {version}/{table}.parquet, described by {version}/manifest.json. Each query runs on its
+    own cursor, so concurrent page data jobs do not share one. A new version (export_extracts) is picked up by the
+    next query.
+    """
+    name = 'duckdb'
+    dialect = qu.DUCKDB
+
+    def __init__(self, extract_dir=EXTRACT_DIR):
+        self.extract_dir = extract_dir
+        self._lock = threading.Lock()
+        self._con = None
+        self._manifest = None
+        self._version_dir = None
+
+    def manifest(self):
+        """
+        Returns the manifest of the current extracts: {'tables': {table: {'markets': list or None, 'start_date': str or None, 'end_date': str or None}}, ...},
+        re-read when a new version was exported, with no tables if there are no extracts.
+        """
+        version_dir = cu.read_current_version(self.extract_dir)
+        if version_dir is None:
+            return {'tables': {}}
+        with self._lock:
+            if version_dir != self._version_dir:
+                with open(os.path.join(version_dir, MANIFEST)) as f:
+                    self._manifest = json.load(f)
+                self._version_dir = version_dir
+                self._con = None # views are created over the files of the version
+            return self._manifest
+
+    def _connection(self):
+        import duckdb
+
+        manifest = self.manifest()
+        with self._lock:
+            if self._con is None:
+                con = duckdb.connect(':memory:')
+                for table in manifest['tables']:
+                    path = os.path.join(self._version_dir, f'{table}.parquet').replace("'", "''")
+                    con.execute(f"CREATE VIEW {self.dialect.table(table)} AS SELECT * FROM read_parquet('{path}')")
+                self._con = con
+            return self._con
+
+    def covers(self, query):
+        """
+        True if every table of the query is extracted for the whole selection of the query: its market and date
+        range, or any campaign if the table was extracted whole.
+        """
+        tables = self.manifest()['tables']
+        filters = query.filters
+        for table in query.tables:
+            extract = tables.get(table)
+            if extract is None:
+                return False
+            if extract.get('markets') is None and extract.get('start_date') is None:
+                continue # whole table
+            if filters.get('campaign_ids') is not None or filters.get('market') is None:
+                return False # the campaigns selected may be outside of the extract
+            if extract.get('markets') is not None and filters['market'] not in extract['markets']:
+                return False
+            if extract.get('start_date') is not None:
+                if filters.get('start_date') is None or str(filters['start_date']) < extract['start_date'] or str(filters['end_date']) > extract['end_date']:
+                    return False
+        return True
+
+    def run(self, query, label=None, **kwargs):
+        """
+        Runs a query against the extracts. kwargs meant for BigQuery (e.g. use_cache) are ignored.
+        """
+        t0 = time.perf_counter()
+        sql = query.sql(self.dialect)
+        with tr.span('duckdb', label=label):
+            cursor = self._connection().cursor()
+            try:
+                table = cursor.execute(sql, query.param_values()).fetch_arrow_table()
+            finally:
+                cursor.close()
+            if bq.DTYPE_BACKEND == 'pyarrow':
+                df = table.to_pandas(types_mapper=pd.ArrowDtype)
+            else:
+                df = table.to_pandas()
+        bq.record_query_metrics(label, sql, 'duckdb', time.perf_counter() - t0, rows=len(df))
+        return df
+
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend(name=QUERY_BACKEND):
+    """
+    Returns the process-wide instance of a backend: 'bigquery' or 'duckdb'.
+    """
+    with _backends_lock:
+        if name not in _backends:
+            if name == 'bigquery':
+                _backends[name] = BigQueryBackend()
+            elif name == 'duckdb':
+                _backends[name] = DuckDBBackend()
+            else:
+                raise ValueError(f'Unknown query backend: {name!r}')
+        return _backends[name]
+
+
+def backend_for(query):
+    """
+    Returns the backend a query runs on, according to QUERY_BACKEND.
+    """
+    if QUERY_BACKEND != 'auto':
+        return get_backend(QUERY_BACKEND)
+    local = get_backend('duckdb')
+    return local if local.covers(query) else get_backend('bigquery')
+
+
+def run_query(query, label=None, **kwargs):
+    """
+    Runs a query (core.query_utils.Query) on its backend and returns the result as a DataFrame.
+
+    Args:
+        query (qu.Query): The query.
+        label (str): Call site the metrics are recorded under, e.g. 'get_campaign_data: campaigns'.
+        **kwargs: Passed on to core.bq_utils.run_query when the query runs in BigQuery (ttl, use_cache, bq_client).
+
+    Returns:
+        pd.DataFrame: The query result.
+    """
+    return backend_for(query).run(query, label=label, **kwargs)
+
+
+def export_extracts(markets=None, start_date=None, end_date=None, extract_dir=EXTRACT_DIR, backend=None):
+    """
+    Exports EXTRACT_TABLES from BigQuery (or another backend) to Parquet extracts in a new version of extract_dir,
+    with its manifest, then makes it the current one. A running DuckDBBackend switches from one complete version
+    to the next, it never sees a partial export or the files of one export with the manifest of another.
+
+    Args:
+        markets (list): Markets of the campaigns extracted, None for all.
+        start_date, end_date (datetime.date): Campaign date range extracted (inclusive), None for all.
+        extract_dir (str): Directory of the extracts.
+        backend: Backend the tables are read from, BigQueryBackend by default.
+
+    Returns:
+        dict: The manifest written.
+    """
+    backend = backend or get_backend('bigquery')
+
+    manifest = {'exported_at': datetime.datetime.now(datetime.timezone.utc).isoformat(), 'tables': {}}
+    with cu.new_version(extract_dir, EXTRACT_VERSIONS_KEPT) as version_dir:
+        for table in EXTRACT_TABLES:
+            df = backend.run(qu.extract_query(table, markets=markets, start_date=start_date, end_date=end_date), label=f'extract: {table}', use_cache=False)
+            df.to_parquet(os.path.join(version_dir, f'{table}.parquet'), index=False)
+
+            filtered = table in FILTERED_EXTRACT_TABLES
+            manifest['tables'][table] = {
+                'rows': len(df),
+                'markets': sorted(markets) if filtered and markets is not None else None,
+                'start_date': str(start_date) if filtered and start_date is not None else None,
+                'end_date': str(end_date) if filtered and end_date is not None else None,
+            }
+
+        with open(os.path.join(version_dir, MANIFEST), 'w') as f:
+            json.dump(manifest, f, indent=2)
+    return manifest
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Exports the local extracts the DuckDB backend runs queries on.')
+    parser.add_argument('--markets', default='', help='Comma-separated markets, all if omitted')
+    parser.add_argument('--start', type=datetime.date.fromisoformat, help='First campaign date')
+    parser.add_argument('--end', type=datetime.date.fromisoformat, help='Last campaign date')
+    parser.add_argument('--extract-dir', default=EXTRACT_DIR)
+    args = parser.parse_args()
+
+    markets = [m.strip() for m in args.markets.split(',') if m.strip()] or None
+    manifest = export_extracts(markets=markets, start_date=args.start, end_date=args.end, extract_dir=args.extract_dir)
+    for table, extract in manifest['tables'].items():
+        print(f"{table:<32} {extract['rows']:>10} rows")
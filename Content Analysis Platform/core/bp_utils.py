@@ -0,0 +1,189 @@
+import pandas as pd
+
+import core.sl_utils as sl
+import core.query_utils as qu
+import core.backend_utils as be
+import core.snapshot_utils as ss
+
+
+BP_BINARY_FEATURES = sl.list_sl_binary + sl.list_sl_length
+
+
+def get_best_practice(channel, market, objective=None, product=None):
+    """
+    Fetches everything the Subject Line Best Practices page needs for one filter selection in a single query,
+    then splits it locally.
+
+    Args:
+        channel (str): 'EMAIL' or 'PUSH'.
+        market (str): Market, e.g. 'SG'.
+        objective (str): Campaign objective (EMAIL only).
+        product (str): 'MX' or 'CE' (EMAIL only).
+
+    Returns:
+        dict: {
+            'cutes': DataFrame with 'Approach', 'Best Performing', 'All Campaigns' and 'Difference' columns,
+            'features': DataFrame with 'Rank', 'Features', 'Importance', 'Recommendation' and 'Importance_Stars' columns,
+            'best_sl': DataFrame of best performing subject lines ('subject_line', 'rank'),
+            'other_sl': DataFrame of other subject lines ('subject_line', 'rank'),
+        }
+    """
+    snapshot = ss.get_snapshot()
+    if snapshot is not None:
+        df = select_best_practice(snapshot, channel, market, objective=objective, product=product)
+    else:
+        query = qu.best_practice_query(channel, market, objective=objective, product=product)
+        df = be.run_query(query, label='get_best_practice')
+    return split_best_practice(df)
+
+
+def get_reference_data(country, product, objective):
+    """
+    Fetch reference data from the `bp_edm_sl` table based on the specified country, product, and objective.
+
+    Args:
+        country (str): The country to filter the reference data.
+        product (str): The product to filter the reference data.
+        objective (str): The objective to filter the reference data.
+
+    Returns:
+        A DataFrame containing CUTES scores and other binary/categorical variabls.
+    """
+    feature_table, _ = qu.BP_TABLES['EMAIL']
+    top_flags = ['1', 'magnitude', 'direction']
+
+    snapshot = ss.get_snapshot()
+    if snapshot is not None:
+        return snapshot.select(feature_table, columns=['top_flag'] + sl.list_sl_all, country=country, product=product, objective=objective, top_flag=top_flags)
+
+    query = qu.reference_query(country, product, objective, top_flags=top_flags)
+    return be.run_query(query, label='get_reference_data')
+
+
+def get_recommendation_models(keys):
+    """
+    Compiles the recommendation model (core.sl_utils.RecommendationModel) of each country, product and objective,
+    e.g. of all the campaigns of a quarter, for core.sl_utils.score_campaigns.
+
+    With the snapshot, the reference rows of all keys are selected at once. Otherwise each key is queried.
+
+    Args:
+        keys (iterable): (country, product, objective) tuples, countries in upper case as in the warehouse.
+
+    Returns:
+        dict: {(country, product, objective): sl.RecommendationModel}, without the keys that have no reference data.
+    """
+    keys = list(dict.fromkeys(tuple(k) for k in keys))
+    feature_table, _ = qu.BP_TABLES['EMAIL']
+
+    snapshot = ss.get_snapshot()
+    if snapshot is not None:
+        df = snapshot.select(
+            feature_table, columns=['country', 'product', 'objective', 'top_flag'] + sl.list_sl_all,
+            country=sorted({k[0] for k in keys}), product=sorted({k[1] for k in keys}), objective=sorted({k[2] for k in keys}),
+            top_flag=['1', 'magnitude', 'direction'],
+        )
+        df_refs = {key: group.drop(columns=['country', 'product', 'objective']) for key, group in df.groupby(['country', 'product', 'objective'], sort=False)}
+    else:
+        df_refs = {key: get_reference_data(*key) for key in keys}
+
+    return {key: sl.RecommendationModel(df_refs[key]) for key in keys if key in df_refs and not df_refs[key].empty}
+
+
+def select_best_practice(snapshot, channel, market, objective=None, product=None):
+    """
+    Same as running core.query_utils.best_practice_query, against the local snapshot.
+    """
+    feature_table, perf_table = qu.BP_TABLES[channel]
+
+    filters = {'country': market}
+    if channel == 'EMAIL':
+        filters.update(objective=objective, product=product)
+
+    df_features = snapshot.select(feature_table, columns=['top_flag'] + sl.list_sl_all, top_flag=qu.BP_FEATURE_FLAGS, **filters)
+    df_features.insert(0, 'part', 'features')
+
+    df_sl = snapshot.select(perf_table, columns=['top_flag', 'subject_line', 'rank'], top_flag=[0, 1], **filters)
+    df_sl['top_flag'] = df_sl['top_flag'].astype(str)
+    df_sl.insert(0, 'part', 'subject_lines')
+
+    return pd.concat([df_features, df_sl], ignore_index=True)
+
+
+def split_best_practice(df):
+    """
+    Splits the result of core.query_utils.best_practice_query into the frames of get_best_practice.
+    """
+    df_features = df[df['part'] == 'features']
+    df_sl = df[df['part'] == 'subject_lines']
+
+    return {
+        'cutes': get_cutes_score(df_features),
+        'features': get_binary_var_bp(df_features),
+        'best_sl': df_sl.loc[df_sl['top_flag'] == '1', ['subject_line', 'rank']].reset_index(drop=True),
+        'other_sl': df_sl.loc[df_sl['top_flag'] == '0', ['subject_line', 'rank']].reset_index(drop=True),
+    }
+
+
+def _flag_row(df_features, flag, columns):
+    rows = df_features.loc[df_features['top_flag'] == flag, columns]
+    if rows.empty:
+        return None
+    return rows.iloc[0].astype(float)
+
+
+def get_cutes_score(df_features):
+    """
+    Compares the CUTES scores of the best performing campaigns to the other campaigns.
+
+    Returns:
+        pd.DataFrame: One row per CUTES variable with 'Approach', 'Best Performing', 'All Campaigns' and 'Difference'.
+    """
+    bp = _flag_row(df_features, '1', sl.list_sl_cutes)
+    oth = _flag_row(df_features, '0', sl.list_sl_cutes)
+    if bp is None or oth is None:
+        return pd.DataFrame(columns=['Approach', 'Best Performing', 'All Campaigns', 'Difference'])
+
+    return pd.DataFrame({
+        'Approach': sl.list_sl_cutes,
+        'Best Performing': bp.to_numpy(),
+        'All Campaigns': oth.to_numpy(),
+        'Difference': (bp - oth).to_numpy(),
+    })
+
+
+def importance_to_stars(value, max_value=1.0, char="*"):
+    max_stars = 20  # Total number of stars for max progress
+    num_stars = int((value / max_value) * max_stars)
+    return char * num_stars
+
+
+def get_binary_var_bp(df_features):
+    """
+    Ranks the binary and length features by importance, keeping those the best performing campaigns include.
+
+    Returns:
+        pd.DataFrame: Processed DataFrame with 'Rank', 'Features', 'Importance', 'Recommendation' and 'Importance_Stars' columns.
+    """
+    magnitude = _flag_row(df_features, 'magnitude', BP_BINARY_FEATURES)
+    direction = _flag_row(df_features, 'direction', BP_BINARY_FEATURES)
+    if magnitude is None or direction is None:
+        return pd.DataFrame(columns=['Rank', 'Features', 'Importance', 'Recommendation', 'Importance_Stars'])
+
+    df_bv_bp = pd.DataFrame({
+        'Features': BP_BINARY_FEATURES,
+        'Importance': magnitude.abs().to_numpy(),
+        'Recommendation': ['Exclude' if d < 0 else 'Include' for d in direction],
+    })
+    df_bv_bp = df_bv_bp.sort_values('Importance', ascending=False, kind='stable')
+
+    # Filter for rows where Recommendation is 'Include'
+    df_bv_bp = df_bv_bp[df_bv_bp["Recommendation"] == "Include"].reset_index(drop=True)
+
+    # Add a "Rank" column starting from 1
+    df_bv_bp.insert(0, "Rank", range(1, len(df_bv_bp) + 1))
+
+    # Add a new column with star-based progress representation
+    df_bv_bp["Importance_Stars"] = df_bv_bp["Importance"].apply(importance_to_stars)
+
+    return df_bv_bp
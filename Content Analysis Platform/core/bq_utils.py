@@ -0,0 +1,343 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import warnings
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import pandas as pd
+
+import core.cache_utils as cu
+import core.client_utils as cl
+import core.trace_utils as tr
+
+
+QUERY_WORKERS = int(os.environ.get('CAP_QUERY_WORKERS', 16)) # Concurrent page data jobs, shared by all sessions of this process
+
+STORAGE_API_ENABLED = os.environ.get('CAP_BQ_STORAGE_API', '1') != '0' # 0 downloads results over REST pagination only
+DTYPE_BACKEND = os.environ.get('CAP_DTYPE_BACKEND', 'numpy') # 'pyarrow' keeps results Arrow-backed, 'numpy' for the classic pandas dtypes
+
+QUERY_BYTE_BUDGET = int(os.environ.get('CAP_QUERY_BYTE_BUDGET', 0)) # Bytes a query may scan, estimated by a dry run before it runs. 0 disables the check
+QUERY_BUDGET_ACTION = os.environ.get('CAP_QUERY_BUDGET_ACTION', 'warn') # 'warn' runs an over-budget query anyway, 'refuse' raises QueryBudgetExceeded
+QUERY_METRICS_FILE = os.environ.get('CAP_QUERY_METRICS_FILE', '') # JSONL file every query execution is appended to, '' disables the export
+QUERY_METRICS_KEPT = 1000 # Latest query executions kept in memory (get_query_metrics)
+
+_job_pool = None
+_job_pool_lock = threading.Lock()
+_storage_api_failed = False
+_query_metrics = deque(maxlen=QUERY_METRICS_KEPT)
+_metrics_lock = threading.Lock()
+
+
+class QueryBudgetExceeded(Exception):
+    """
+    Raised when the dry run of a query estimates more bytes than QUERY_BYTE_BUDGET and QUERY_BUDGET_ACTION is 'refuse'.
+    """
+
+    def __init__(self, label, estimated_bytes, budget):
+        self.label = label
+        self.estimated_bytes = estimated_bytes
+        self.budget = budget
+        super().__init__(
+            f'Query {label or ""} would scan {estimated_bytes / 2 ** 30:.1f} GiB, over the budget of {budget / 2 ** 30:.1f} GiB. '
+            'Please narrow the search (e.g. a shorter date range).'
+        )
+
+
+def make_job_config(query_parameters=(), **kwargs):
+    """
+    Builds a QueryJobConfig, importing the BigQuery SDK only when a query is actually prepared.
+
+    Args:
+        query_parameters (list): (name, type, value) tuples. List values become array parameters.
+        **kwargs: Other QueryJobConfig properties.
+
+    Returns:
+        bigquery.QueryJobConfig: The job configuration.
+    """
+    from google.cloud import bigquery
+
+    params = []
+    for name, type_, value in query_parameters:
+        if isinstance(value, (list, tuple)):
+            params.append(bigquery.ArrayQueryParameter(name, type_, list(value)))
+        else:
+            params.append(bigquery.ScalarQueryParameter(name, type_, value))
+    return bigquery.QueryJobConfig(query_parameters=params, **kwargs)
+
+
+def run_query(query, job_config=None, ttl=None, use_cache=True, bq_client=None, label=None):
+    """
+    Runs a query and returns its result as a DataFrame, serving it from the local query cache when possible.
+    Every call is recorded (see record_query_metrics), and on a cache miss the query is first dry-run against
+    QUERY_BYTE_BUDGET, if set.
+
+    Args:
+        query (str): SQL text.
+        job_config (bigquery.QueryJobConfig): Job configuration carrying the query parameters.
+        ttl (float): Seconds a cached result stays valid. Defaults to the TTL of the tables read (core.cache_utils.QUERY_TABLE_TTLS).
+        use_cache (bool): Read and write the query cache, if enabled.
+        bq_client (bigquery.Client): Client used to run the query on a cache miss. Defaults to the shared client (core.client_utils).
+        label (str): Call site the metrics are recorded under, e.g. 'get_campaign_data: campaigns'.
+
+    Returns:
+        pd.DataFrame: The query result.
+
+    Raises:
+        QueryBudgetExceeded: If the query is over budget and QUERY_BUDGET_ACTION is 'refuse'.
+    """
+    t0 = time.perf_counter()
+    cache = cu.get_query_cache() if use_cache else None
+
+    if cache is not None:
+        with tr.span('query_cache', label=label) as span:
+            df = cache.get(query, job_config, ttl=ttl, dtype_backend=DTYPE_BACKEND)
+            span.set(hit=df is not None)
+        if df is not None:
+            record_query_metrics(label, query, 'cache', time.perf_counter() - t0, rows=len(df))
+            return df
+
+    if bq_client is None:
+        bq_client = cl.get_bq_client() # only needed (and created) on a cache miss
+
+    with tr.span('bigquery', label=label) as span:
+        estimated_bytes = None
+        if QUERY_BYTE_BUDGET > 0:
+            estimated_bytes = check_query_budget(query, job_config, bq_client, label=label, t0=t0)
+
+        job = bq_client.query(query, job_config=job_config)
+        try:
+            df = download_result(job)
+        except Exception:
+            record_query_metrics(label, query, 'error', time.perf_counter() - t0, job=job, estimated_bytes=estimated_bytes)
+            raise
+        record_query_metrics(label, query, 'bigquery', time.perf_counter() - t0, rows=len(df), job=job, estimated_bytes=estimated_bytes)
+        span.set(job_id=job.job_id, rows=len(df), bytes_processed=job.total_bytes_processed)
+
+    if cache is not None:
+        cache.put(query, job_config, df)
+
+    return df
+
+
+def check_query_budget(query, job_config, bq_client, label=None, t0=None):
+    """
+    Dry-runs a query and compares the bytes it would scan to QUERY_BYTE_BUDGET: above it, warns or raises
+    QueryBudgetExceeded depending on QUERY_BUDGET_ACTION. A dry run is free and does not start a job.
+
+    Returns:
+        int: The estimated bytes processed.
+    """
+    from google.cloud import bigquery
+
+    dry_run_config = bigquery.QueryJobConfig(
+        dry_run=True,
+        use_query_cache=False, # estimate the full scan, as the BigQuery cache may have expired by the time the query runs
+        query_parameters=job_config.query_parameters if job_config is not None else [],
+    )
+    estimated_bytes = bq_client.query(query, job_config=dry_run_config).total_bytes_processed or 0
+
+    if estimated_bytes > QUERY_BYTE_BUDGET:
+        if QUERY_BUDGET_ACTION == 'refuse':
+            elapsed = time.perf_counter() - t0 if t0 is not None else 0.0
+            record_query_metrics(label, query, 'refused', elapsed, estimated_bytes=estimated_bytes)
+            raise QueryBudgetExceeded(label, estimated_bytes, QUERY_BYTE_BUDGET)
+        warnings.warn(f'Query {label or ""} will scan {estimated_bytes} bytes, over the budget of {QUERY_BYTE_BUDGET} bytes')
+
+    return estimated_bytes
+
+
+def record_query_metrics(label, query, source, wall_seconds, rows=None, job=None, estimated_bytes=None):
+    """
+    Records one query execution: kept in memory (get_query_metrics) and appended to QUERY_METRICS_FILE, if set,
+    one JSON object per line for aggregation (see benchmarks/query_metrics.py).
+
+    Args:
+        label (str): Call site.
+        query (str): SQL text, recorded as a short hash of its normalized text.
+        source (str): 'cache' (local query cache), 'bigquery', 'duckdb' (core.backend_utils), 'refused' (over budget) or 'error'.
+        wall_seconds (float): Time spent in run_query, incl. the dry run and the download.
+        rows (int): Rows returned.
+        job (bigquery.QueryJob): The job run, for its ID and statistics.
+        estimated_bytes (int): Bytes estimated by the dry run, if any.
+    """
+    record = {
+        'time': time.time(),
+        'label': label,
+        'query_hash': hashlib.sha1(cu.normalize_sql(query).encode()).hexdigest()[:12],
+        'source': source,
+        'wall_seconds': round(wall_seconds, 4),
+        'rows': rows,
+        'job_id': None,
+        'bytes_processed': None,
+        'bytes_billed': None,
+        'bq_cache_hit': None, # BigQuery's own result cache, distinct from the local query cache
+        'slot_ms': None,
+        'estimated_bytes': estimated_bytes,
+        'over_budget': QUERY_BYTE_BUDGET > 0 and estimated_bytes is not None and estimated_bytes > QUERY_BYTE_BUDGET,
+    }
+    if job is not None:
+        record.update(
+            job_id=job.job_id,
+            bytes_processed=job.total_bytes_processed,
+            bytes_billed=job.total_bytes_billed,
+            bq_cache_hit=job.cache_hit,
+            slot_ms=job.slot_millis,
+        )
+
+    with _metrics_lock:
+        _query_metrics.append(record)
+        if QUERY_METRICS_FILE:
+            try:
+                with open(QUERY_METRICS_FILE, 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+            except OSError as e:
+                warnings.warn(f'Query metrics not exported: {e}')
+
+
+def get_query_metrics():
+    """
+    Returns the latest QUERY_METRICS_KEPT query executions of this process as a DataFrame, one row per run_query call.
+    """
+    with _metrics_lock:
+        return pd.DataFrame(list(_query_metrics))
+
+
+def get_bqstorage_client():
+    """
+    Returns the shared BigQuery Storage Read API client, or None if it is disabled (CAP_BQ_STORAGE_API=0),
+    google-cloud-bigquery-storage is not installed, or a read through it already failed in this process.
+    """
+    global _storage_api_failed
+    if not STORAGE_API_ENABLED or _storage_api_failed:
+        return None
+    try:
+        return cl.get_client('bqstorage')
+    except ImportError:
+        _storage_api_failed = True
+        return None
+
+
+def download_result(job):
+    """
+    Waits for a query job and downloads its result as a DataFrame.
+
+    Results are streamed as Arrow record batches through the Storage Read API when it is available (the SDK still
+    reads small results over REST), and converted according to DTYPE_BACKEND: with 'pyarrow' the Arrow buffers
+    back the DataFrame as is, without a copy into numpy. If a Storage API read fails (e.g. the service account
+    lacks the read session permission), the result is downloaded again over REST and the Storage API is not used
+    again by this process.
+
+    Args:
+        job (bigquery.QueryJob): The query job.
+
+    Returns:
+        pd.DataFrame: The query result.
+    """
+    global _storage_api_failed
+    rows = job.result() # query errors are raised here, before any download
+    bqstorage_client = get_bqstorage_client()
+    if bqstorage_client is None:
+        return _download_rows(rows, None)
+    try:
+        return _download_rows(rows, bqstorage_client)
+    except Exception as e:
+        _storage_api_failed = True
+        warnings.warn(f'BigQuery Storage API read failed, downloading results over REST instead: {e}')
+    return _download_rows(job.result(), None)
+
+
+def _download_rows(rows, bqstorage_client):
+    if DTYPE_BACKEND == 'pyarrow':
+        table = rows.to_arrow(bqstorage_client=bqstorage_client, create_bqstorage_client=False)
+        return table.to_pandas(types_mapper=pd.ArrowDtype)
+    return rows.to_dataframe(bqstorage_client=bqstorage_client, create_bqstorage_client=False)
+
+
+def get_job_pool():
+    """
+    Returns the thread pool page data jobs run on, creating it on first use.
+    """
+    global _job_pool
+    with _job_pool_lock:
+        if _job_pool is None:
+            _job_pool = ThreadPoolExecutor(max_workers=QUERY_WORKERS, thread_name_prefix='data-job')
+    return _job_pool
+
+
+class JobScheduler:
+    """
+    Runs the data jobs of a page concurrently. Each job is submitted as soon as the jobs it depends on are done,
+    so independent BigQuery jobs and creative downloads overlap and a page waits for its critical path only.
+
+    Jobs run on worker threads, so they must not call Streamlit.
+
+    Example:
+        jobs = bq.JobScheduler()
+        jobs.add('campaign', bq.run_query, QUERY_EDM, job_config=job_config, label='campaigns')
+        jobs.add('click', bq.run_query, QUERY_CLICK_REPORT, job_config=job_config, label='click report')
+        jobs.add('reference', get_reference_data, depends_on=['campaign']) # called as get_reference_data(df_campaign)
+        df_click = jobs.result('click')
+    """
+
+    def __init__(self, pool=None):
+        self._pool = pool or get_job_pool()
+        self._futures = {}
+
+    def add(self, name, fn, *args, depends_on=(), **kwargs):
+        """
+        Declares a job. fn is called with the results of depends_on (in order) followed by args and kwargs.
+        If a dependency fails, the job fails with the same exception without running.
+
+        Returns:
+            Future: The future of the job result.
+        """
+        if name in self._futures:
+            raise ValueError(f'Job {name!r} is already declared')
+        deps = [self._futures[d] for d in depends_on] # dependencies must be declared first
+        fn = tr.bind(fn) # spans of the job nest under the span it was declared in
+
+        future = Future()
+        self._futures[name] = future
+
+        def submit():
+            try:
+                dep_results = [d.result() for d in deps] # all done at this point, does not block
+            except Exception as e:
+                future.set_exception(e)
+                return
+            inner = self._pool.submit(fn, *dep_results, *args, **kwargs)
+            inner.add_done_callback(lambda f: _copy_future_state(f, future))
+
+        # Submit once the last dependency is done, without holding a worker thread while waiting
+        pending = [len(deps)]
+        lock = threading.Lock()
+
+        def on_dep_done(_):
+            with lock:
+                pending[0] -= 1
+                ready = pending[0] == 0
+            if ready:
+                submit()
+
+        if not deps:
+            submit()
+        for d in deps:
+            d.add_done_callback(on_dep_done)
+
+        return future
+
+    def result(self, name, timeout=None):
+        """
+        Waits for a job and returns its result (or raises its exception).
+        """
+        return self._futures[name].result(timeout=timeout)
+
+
+def _copy_future_state(source, target):
+    if source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
@@ -0,0 +1,367 @@
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+import contextlib
+import tempfile
+import threading
+import warnings
+
+import pandas as pd
+
+
+CACHE_ROOT = os.environ.get('CAP_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'cap-cache'))
+
+CREATIVE_CACHE_BYTES = int(os.environ.get('CAP_CREATIVE_CACHE_BYTES', 512 * 1024 * 1024)) # 0 disables the creative cache
+CREATIVE_REVALIDATE_SECONDS = float(os.environ.get('CAP_CREATIVE_REVALIDATE_SECONDS', 60)) # How long a metadata check is trusted
+
+QUERY_CACHE_ENABLED = os.environ.get('CAP_QUERY_CACHE', '1') != '0'
+QUERY_DEFAULT_TTL = 60 * 60 # Seconds, for queries that read none of the tables below
+
+# Seconds a cached query result stays valid, by table read. A query gets the shortest TTL of its tables.
+QUERY_TABLE_TTLS = {
+    'gcdm.campaigns': 60 * 60,
+    'gcdm.click_report': 60 * 60,
+    'gcdm.campaign_asset_push': 60 * 60,
+    'gcdm.benchmark': 24 * 60 * 60,
+    'content.subject_line': 24 * 60 * 60,
+    'content.bm_click_rate': 24 * 60 * 60,
+    'content.bp_edm_sl': 24 * 60 * 60,
+    'content.bp_pn_sl': 24 * 60 * 60,
+    'content.bp_edm_sl_perf': 24 * 60 * 60,
+    'content.bp_pn_sl_perf': 24 * 60 * 60,
+}
+
+
+class CreativeCache:
+    """
+    Content-addressed on-disk cache of GCS objects, keyed by (bucket, path, generation).
+
+    An object's generation changes whenever it is overwritten, so a cached entry never needs to be
+    invalidated: a metadata-only lookup tells which generation is current, and the bytes of that
+    generation are either on disk already or downloaded once. Entries are evicted least recently used
+    first (by file mtime) once the cache grows over max_bytes. The directory can be shared by several
+    processes, as entries are written atomically and a vanished entry is treated as a miss.
+    """
+
+    def __init__(self, cache_dir, max_bytes=CREATIVE_CACHE_BYTES, revalidate_after=CREATIVE_REVALIDATE_SECONDS):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.revalidate_after = revalidate_after
+
+        self._lock = threading.Lock()
+        self._generations = {} # {(bucket_name, path): (generation or None, checked_at)}
+        self._size = None # total bytes on disk, computed on first write
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _entry_path(self, bucket_name, path, generation, variant=''):
+        digest = hashlib.sha256(f'{bucket_name}/{path}#{generation}{variant}'.encode()).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest)
+
+    def get(self, bucket_name, path, generation, variant=''):
+        """
+        Returns the cached bytes of an object generation (or of one of its variants), or None on a miss.
+        Read errors (e.g. a permission or I/O error) are warned about and treated as a miss.
+        """
+        entry = self._entry_path(bucket_name, path, generation, variant)
+        try:
+            with open(entry, 'rb') as f:
+                content = f.read()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            warnings.warn(f'Creative cache entry not read: {e}')
+            return None
+        try:
+            os.utime(entry) # mark as recently used
+        except OSError:
+            pass # evicted since the read, or a read-only cache: the bytes read are still good
+        return content
+
+    def put(self, bucket_name, path, generation, content, variant=''):
+        """
+        Stores the bytes of an object generation (or of one of its variants) and evicts old entries if needed.
+        Write errors (e.g. a full disk) are warned about, the entry is then simply not cached.
+        """
+        entry = self._entry_path(bucket_name, path, generation, variant)
+        tmp = None
+        try:
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(entry), suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.replace(tmp, entry) # atomic, readers never see a partial file
+        except OSError as e:
+            warnings.warn(f'Creative not cached: {e}')
+            if tmp is not None and os.path.exists(tmp):
+                os.remove(tmp)
+            return
+
+        with self._lock:
+            if self._size is None:
+                self._size = self._disk_usage()[0]
+            else:
+                self._size += len(content)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _disk_usage(self):
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith('.tmp'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+                total += stat.st_size
+        return total, entries
+
+    def _evict(self):
+        # Drop least recently used entries until the cache is back to 90% of its budget
+        total, entries = self._disk_usage()
+        target = self.max_bytes * 0.9
+        for _, size, entry in sorted(entries):
+            if total <= target:
+                break
+            try:
+                os.remove(entry)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._size = total
+
+    def current_generation(self, bucket, path, timeout=None):
+        """
+        Returns the current generation of a blob (None if it does not exist) using a metadata-only request.
+        Results are trusted for revalidate_after seconds before the next check.
+        """
+        key = (bucket.name, path)
+        with self._lock:
+            known = self._generations.get(key)
+        if known is not None and time.monotonic() - known[1] < self.revalidate_after:
+            return known[0]
+
+        blob = bucket.get_blob(path, timeout=timeout)
+        generation = None if blob is None else blob.generation
+        with self._lock:
+            self._generations[key] = (generation, time.monotonic())
+        return generation
+
+    def fetch(self, bucket, path, timeout=None):
+        """
+        Returns the bytes of a blob, downloading them only if the current generation is not cached.
+
+        Returns:
+            tuple: (generation, bytes), or (None, None) if the blob does not exist. The generation is None
+            if the blob was overwritten during the download and its new generation is unknown (not cached then).
+        """
+        from google.api_core.exceptions import NotFound
+
+        generation = self.current_generation(bucket, path, timeout=timeout)
+        if generation is None:
+            return None, None
+
+        content = self.get(bucket.name, path, generation)
+        if content is not None:
+            return generation, content
+
+        try:
+            content = bucket.blob(path, generation=generation).download_as_bytes(timeout=timeout)
+        except NotFound:
+            # Overwritten or deleted since the metadata check: download whatever is current now, once
+            blob = bucket.blob(path)
+            try:
+                content = blob.download_as_bytes(timeout=timeout)
+            except NotFound:
+                content = None
+            generation = blob.generation if content is not None else None # set from the download's response headers
+            with self._lock:
+                if content is None or generation is not None:
+                    self._generations[(bucket.name, path)] = (generation, time.monotonic())
+                else:
+                    self._generations.pop((bucket.name, path), None) # checked again next time
+            if content is None:
+                return None, None
+            if generation is None:
+                return None, content
+
+        self.put(bucket.name, path, generation, content)
+        return generation, content
+
+
+_creative_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_creative_cache():
+    """
+    Returns the process-wide creative cache, or None if it is disabled (CAP_CREATIVE_CACHE_BYTES=0).
+    """
+    global _creative_cache
+    if CREATIVE_CACHE_BYTES <= 0:
+        return None
+    with _cache_lock:
+        if _creative_cache is None:
+            _creative_cache = CreativeCache(os.path.join(CACHE_ROOT, 'creatives'))
+    return _creative_cache
+
+
+def normalize_sql(query):
+    """
+    Returns query with comments removed and whitespace collapsed, so that formatting changes do not change cache keys.
+    """
+    query = re.sub(r'--[^\n]*', ' ', query)
+    return ' '.join(query.split())
+
+
+def query_parameters_repr(job_config):
+    """
+    Returns the query parameters of a QueryJobConfig as a list of their API representations.
+    """
+    if job_config is None:
+        return []
+    return [param.to_api_repr() for param in job_config.query_parameters]
+
+
+class QueryCache:
+    """
+    On-disk cache of query results, stored as Parquet files keyed by the normalized SQL text and query parameters.
+
+    The directory is shared by every session and rerun of every process that points to it. An entry expires
+    QUERY_TABLE_TTLS seconds (the shortest among the tables the query reads) after it was written.
+    """
+
+    def __init__(self, cache_dir, table_ttls=QUERY_TABLE_TTLS, default_ttl=QUERY_DEFAULT_TTL):
+        self.cache_dir = cache_dir
+        self.table_ttls = table_ttls
+        self.default_ttl = default_ttl
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, query, job_config=None):
+        payload = json.dumps([normalize_sql(query), query_parameters_repr(job_config)], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def ttl(self, query):
+        """
+        Returns the TTL of a query, the shortest among the tables it reads.
+        """
+        sql = normalize_sql(query)
+        ttls = [ttl for table, ttl in self.table_ttls.items() if re.search(rf'\b{re.escape(table)}\b', sql)]
+        return min(ttls) if ttls else self.default_ttl
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.parquet')
+
+    def get(self, query, job_config=None, ttl=None, dtype_backend='numpy'):
+        """
+        Returns the cached result of a query, or None if it is not cached or has expired.
+        With dtype_backend='pyarrow' columns are Arrow-backed, as downloaded results are (core.bq_utils.DTYPE_BACKEND).
+        """
+        entry = self._entry_path(self.key(query, job_config))
+        ttl = self.ttl(query) if ttl is None else ttl
+        try:
+            if time.time() - os.path.getmtime(entry) > ttl:
+                return None
+            if dtype_backend == 'pyarrow':
+                return pd.read_parquet(entry, dtype_backend='pyarrow')
+            return pd.read_parquet(entry)
+        except (FileNotFoundError, OSError):
+            return None
+
+    def put(self, query, job_config, df):
+        """
+        Stores the result of a query. Results that cannot be written as Parquet are not cached.
+        """
+        entry = self._entry_path(self.key(query, job_config))
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        os.close(fd)
+        try:
+            df.to_parquet(tmp, index=False)
+            os.replace(tmp, entry)
+        except Exception as e:
+            warnings.warn(f'Query result not cached: {e}')
+            os.remove(tmp)
+            return
+        self.purge_expired()
+
+    def purge_expired(self):
+        # Entries older than the longest TTL can no longer be served
+        max_ttl = max([self.default_ttl] + list(self.table_ttls.values()))
+        now = time.time()
+        for name in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, name)
+            try:
+                if now - os.path.getmtime(entry) > max_ttl:
+                    os.remove(entry)
+            except FileNotFoundError:
+                continue
+
+
+_query_cache = None
+
+
+def get_query_cache():
+    """
+    Returns the process-wide query result cache, or None if it is disabled (CAP_QUERY_CACHE=0).
+    """
+    global _query_cache
+    if not QUERY_CACHE_ENABLED:
+        return None
+    with _cache_lock:
+        if _query_cache is None:
+            _query_cache = QueryCache(os.path.join(CACHE_ROOT, 'queries'))
+    return _query_cache
+
+
+def read_current_version(store_dir):
+    """
+    Returns the directory of the current version of a versioned store (see new_version), or None if there is none.
+    """
+    try:
+        with open(os.path.join(store_dir, 'CURRENT')) as f:
+            version = f.read().strip()
+    except FileNotFoundError:
+        return None
+    version_dir = os.path.join(store_dir, version)
+    return version_dir if os.path.isdir(version_dir) else None
+
+
+@contextlib.contextmanager
+def new_version(store_dir, versions_kept=2):
+    """
+    Context manager creating a new version directory of a versioned store (the local snapshot and the query
+    extracts), to write a complete export into. On success the version is made current by switching the store's
+    CURRENT pointer atomically, so readers see either the old or the new version, and the versions_kept most
+    recent versions are kept (older ones may still be in use by other processes). On error the partial version is
+    removed and the current one stays as it was.
+
+    Example:
+        with cu.new_version(SNAPSHOT_DIR, SNAPSHOT_VERSIONS_KEPT) as version_dir:
+            write_tables(version_dir)
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    version_dir = tempfile.mkdtemp(dir=store_dir, prefix=f'{int(time.time())}-')
+    try:
+        yield version_dir
+    except BaseException:
+        shutil.rmtree(version_dir, ignore_errors=True)
+        raise
+
+    fd, tmp = tempfile.mkstemp(dir=store_dir, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        f.write(os.path.basename(version_dir))
+    os.replace(tmp, os.path.join(store_dir, 'CURRENT'))
+
+    versions = sorted(
+        (d for d in os.listdir(store_dir) if os.path.isdir(os.path.join(store_dir, d))),
+        key=lambda d: os.path.getmtime(os.path.join(store_dir, d)),
+    )
+    for version in versions[:-versions_kept]:
+        shutil.rmtree(os.path.join(store_dir, version), ignore_errors=True)
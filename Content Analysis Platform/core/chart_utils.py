@@ -1,11 +1,24 @@
+import hashlib
+import threading
+from io import BytesIO
+from collections import OrderedDict
+
 import numpy as np
-import matplotlib.pyplot as plt
-from wordcloud import WordCloud
 
-import plotly.graph_objects as go
-from plotly.subplots import make_subplots
+import core.trace_utils as tr
+
+# plotly and wordcloud are imported by the functions using them, so that pages only load them once a chart is drawn
+
+
+WORDCLOUD_CACHE_SIZE = 64 # Rendered word clouds (and term frequencies) kept in memory, shared by all sessions
+
+_wordcloud_lock = threading.Lock()
+_circle_masks = {} # {(mask_radius, width, height): mask}
+_frequency_cache = OrderedDict() # {text hash: {term: count}}
+_wordcloud_cache = OrderedDict() # {(frequency hash, width, height, mask_radius, background_color): PNG bytes}
 
 
+@tr.traced('chart', chart='cutes')
 def make_cutes_chart(chart_height, y1_data, y2_data=[0, 0, 0, 0, 0], cutes_label_color='#22177A', y1_marker={'color':'#AA5486', 'opacity':1}, y2_marker={'color':'#9ABF80', 'opacity':1}):
     """
     Creates a custom chart comparing two sets of data using scatter plots with dual y-axes.
@@ -22,6 +35,9 @@ def make_cutes_chart(chart_height, y1_data, y2_data=[0, 0, 0, 0, 0], cutes_label
     - fig (plotly.graph_objects.Figure): A Plotly figure object with the configured chart.
     - config (dict): Configuration for rendering the chart, e.g., static display mode.
     """
+    import plotly.graph_objects as go
+    from plotly.subplots import make_subplots
+
     # Create a figure with secondary y-axes to allow for dual y-axis plots.
     fig = make_subplots(specs=[[{"secondary_y": True}]])
 
@@ -65,7 +81,11 @@ def make_cutes_chart(chart_height, y1_data, y2_data=[0, 0, 0, 0, 0], cutes_label
     return fig, config
 
 
+@tr.traced('chart', chart='click_rate')
 def make_click_rate_chart(groups):
+    import plotly.graph_objects as go
+    from plotly.subplots import make_subplots
+
     fig = make_subplots(rows=1, cols=2, subplot_titles=('Click Rate by Pod Position',  'Click Rate by Pod Relative Size (%)'))
 
     fig.add_trace(
@@ -90,6 +110,92 @@ def make_click_rate_chart(groups):
 
     return fig
 
+
+def get_circle_mask(mask_radius=130, width=500, height=500):
+    """
+    Returns the (read-only) circular word cloud mask, computed once per size.
+    """
+    key = (mask_radius, width, height)
+    with _wordcloud_lock:
+        if key not in _circle_masks:
+            x, y = np.ogrid[:height, :width]
+            mask = (x - width // 2) ** 2 + (y - height // 2) ** 2 > mask_radius ** 2
+            mask = 255 * mask.astype(np.uint8)
+            mask.flags.writeable = False
+            _circle_masks[key] = mask
+        return _circle_masks[key]
+
+
+def _lru_get(cache, key):
+    with _wordcloud_lock:
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+    return None
+
+
+def _lru_put(cache, key, value):
+    with _wordcloud_lock:
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > WORDCLOUD_CACHE_SIZE:
+            cache.popitem(last=False)
+
+
+def get_term_frequencies(text):
+    """
+    Computes the term frequencies of text the way WordCloud.generate() does (stopwords removed, plurals merged,
+    collocations kept), once per distinct text.
+
+    Returns:
+    - dict: {term: count}
+    """
+    from wordcloud import WordCloud
+
+    key = hashlib.sha1(text.encode()).hexdigest()
+    frequencies = _lru_get(_frequency_cache, key)
+    if frequencies is None:
+        with tr.span('wordcloud_terms'):
+            frequencies = WordCloud().process_text(text)
+        _lru_put(_frequency_cache, key, frequencies)
+    return frequencies
+
+
+def render_wordcloud(frequencies, mask_radius=130, width=500, height=500, background_color="white"):
+    """
+    Renders a circular word cloud from term frequencies. Images are cached by (frequency hash, size, mask),
+    so repeat visits skip the WordCloud layout.
+
+    Parameters:
+    - frequencies (dict): {term: count}, e.g. from get_term_frequencies.
+    - mask_radius (int): The radius of the circular mask.
+    - width (int): The width of the word cloud image.
+    - height (int): The height of the word cloud image.
+    - background_color (str): The background color of the word cloud image.
+
+    Returns:
+    - bytes: The PNG-encoded word cloud.
+    """
+    from wordcloud import WordCloud
+
+    frequency_hash = hashlib.sha1(repr(sorted(frequencies.items())).encode()).hexdigest()
+    key = (frequency_hash, width, height, mask_radius, background_color)
+    png = _lru_get(_wordcloud_cache, key)
+    if png is not None:
+        return png
+
+    with tr.span('wordcloud', terms=len(frequencies)):
+        wc = WordCloud(height=height, width=width, background_color=background_color, mask=get_circle_mask(mask_radius, width, height), repeat=True)
+        wc.generate_from_frequencies(frequencies)
+
+        buf = BytesIO()
+        wc.to_image().save(buf, format='PNG')
+        png = buf.getvalue()
+    _lru_put(_wordcloud_cache, key, png)
+
+    return png
+
+
 def generate_circular_wordcloud(text, mask_radius=130, width=500, height=500, background_color="white"):
     """
     Generates a circular word cloud from the input text.
@@ -102,20 +208,7 @@ def generate_circular_wordcloud(text, mask_radius=130, width=500, height=500, ba
     - background_color (str): The background color of the word cloud image.
 
     Returns:
-    - fig: The matplotlib figure containing the word cloud.
+    - bytes: The PNG-encoded word cloud.
     """
-    # Circle mask
-    x, y = np.ogrid[:height, :width]
-    mask = (x - width // 2) ** 2 + (y - height // 2) ** 2 > mask_radius ** 2
-    mask = 255 * mask.astype(int)
-
-    # Create the WordCloud object
-    wc = WordCloud(height=height, width=width, background_color=background_color, mask=mask, repeat=True)
-    wc.generate(text)
-
-    # Create the plot
-    fig, ax = plt.subplots(figsize=(6, 6))
-    ax.imshow(wc, interpolation="bilinear")
-    ax.axis("off")
-
-    return fig
\ No newline at end of file
+    frequencies = get_term_frequencies(text)
+    return render_wordcloud(frequencies, mask_radius=mask_radius, width=width, height=height, background_color=background_color)
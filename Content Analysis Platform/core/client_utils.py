@@ -0,0 +1,91 @@
+import os
+import threading
+
+
+PROJECT = os.environ.get('CAP_GCP_PROJECT', 'xxx')
+CREDENTIALS_FILE = os.environ.get('CAP_CREDENTIALS_FILE', 'xxx.json') # Service account JSON file that contains our credentials
+SCOPES = ['https://www.googleapis.com/auth/cloud-platform']
+
+HTTP_POOL_SIZE = int(os.environ.get('CAP_HTTP_POOL_SIZE', 32)) # Keep-alive connections per host, above the creative fetch concurrency
+
+_clients = {}
+_lock = threading.RLock()
+
+
+def _make_credentials():
+    from google.oauth2 import service_account
+    return service_account.Credentials.from_service_account_file(CREDENTIALS_FILE, scopes=SCOPES)
+
+
+def _make_http():
+    # One authorized session, and so one set of connection pools, shared by the BigQuery and Storage clients
+    from requests.adapters import HTTPAdapter
+    from google.auth.transport.requests import AuthorizedSession
+
+    session = AuthorizedSession(get_client('credentials'))
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount('https://', adapter)
+    return session
+
+
+def _make_bigquery():
+    from google.cloud import bigquery
+    return bigquery.Client(project=PROJECT, credentials=get_client('credentials'), _http=get_client('http'))
+
+
+def _make_storage():
+    from google.cloud import storage
+    return storage.Client(project=PROJECT, credentials=get_client('credentials'), _http=get_client('http'))
+
+
+def _make_bqstorage():
+    # Storage Read API client (gRPC, so it keeps its own channel), raises ImportError if google-cloud-bigquery-storage is missing
+    from google.cloud import bigquery_storage
+    return bigquery_storage.BigQueryReadClient(credentials=get_client('credentials'))
+
+
+_factories = {
+    'credentials': _make_credentials,
+    'http': _make_http,
+    'bigquery': _make_bigquery,
+    'bqstorage': _make_bqstorage,
+    'storage': _make_storage,
+}
+
+
+def get_client(name):
+    """
+    Returns the process-wide instance of a client, creating it on first use.
+    Streamlit re-executes pages on every interaction, but this module (and so the clients) lives as long as the process.
+
+    Args:
+        name (str): 'credentials', 'http', 'bigquery', 'bqstorage' or 'storage'.
+    """
+    with _lock:
+        if name not in _clients:
+            _clients[name] = _factories[name]()
+        return _clients[name]
+
+
+def get_bq_client():
+    return get_client('bigquery')
+
+
+def get_storage_client():
+    return get_client('storage')
+
+
+def set_client(name, client):
+    """
+    Replaces a client, e.g. with a local stand-in for testing or benchmarking.
+    """
+    with _lock:
+        _clients[name] = client
+
+
+def reset_clients():
+    """
+    Drops all clients, so that they are created again on next use.
+    """
+    with _lock:
+        _clients.clear()
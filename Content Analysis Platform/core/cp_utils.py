@@ -1,3 +1,8 @@
+import numpy as np
+import pandas as pd
+
+import core.img_utils as im
+
 
 def get_product_from_model(model):
     if model == 'MX':
@@ -22,4 +27,203 @@ def human_format(num):
         magnitude += 1
         num /= 1000.0
     # add more suffixes if you need them
-    return '%.1f%s' % (num, ['', 'K', 'M', 'G', 'T', 'P'][magnitude])
\ No newline at end of file
+    return '%.1f%s' % (num, ['', 'K', 'M', 'G', 'T', 'P'][magnitude])
+
+
+class PodStore:
+    """
+    Pods of many campaigns (one click report row each) kept as flat numpy arrays, with the pods of the i-th campaign
+    at offsets[i]:offsets[i+1]. Labels are stored as codes into the (truncated) distinct labels, so building the
+    store costs a sort and a few array copies, however many campaigns there are.
+
+    Example:
+        pods = cp.PodStore.from_click_report(df_click)
+        pods.pods('0000111111') # {'pod_count': 3, 'height': array([...]), 'click_rate': array([...]), ...}
+    """
+
+    def __init__(self, campaign_ids, offsets, height, click_rate, pod_ctr, label_codes, labels):
+        self.campaign_ids = list(campaign_ids)
+        self.offsets = offsets
+        self.height = height
+        self.click_rate = click_rate
+        self.pod_ctr = pod_ctr
+        self.label_codes = label_codes
+        self.labels = labels
+        self._index = {cid: i for i, cid in enumerate(self.campaign_ids)}
+
+    @classmethod
+    def from_click_report(cls, df_click, click_rate='click_rate', pod_ctr='pod_ctr', label_map=None, max_label_len=10):
+        """
+        Builds the store from a click report DataFrame with one row per pod.
+
+        Args:
+            df_click (pd.DataFrame): Click report with 'campaign_id', 'height', 'label_name' and the click rate columns, pods in display order.
+            click_rate (str): Column holding the pod click contribution.
+            pod_ctr (str): Column holding the pod CTR.
+            label_map (dict): Labels to replace before truncation, e.g. {'footer': 'unsub'}.
+            max_label_len (int): Labels are truncated to this length (refer to core.img_utils.truncate_labels).
+
+        Returns:
+            PodStore: Campaigns in order of first appearance in df_click.
+        """
+        codes, campaign_ids = pd.factorize(df_click['campaign_id'])
+        order = np.argsort(codes, kind='stable') # group the pods of each campaign, keeping their order
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(campaign_ids)))])
+
+        def column(name):
+            return df_click[name].to_numpy(dtype=float, na_value=np.nan)[order]
+
+        # Labels are mapped and truncated once per distinct label rather than once per pod
+        label_codes, labels = pd.factorize(df_click['label_name'], use_na_sentinel=False)
+        labels = ['' if pd.isna(label) else str(label) for label in labels]
+        if label_map:
+            labels = [label_map.get(label, label) for label in labels]
+        labels = np.array(im.truncate_labels(labels, max_len=max_label_len), dtype=object)
+
+        return cls(
+            campaign_ids=np.asarray(campaign_ids, dtype=object),
+            offsets=offsets,
+            height=column('height'),
+            click_rate=column(click_rate),
+            pod_ctr=column(pod_ctr),
+            label_codes=label_codes[order],
+            labels=labels,
+        )
+
+    def __len__(self):
+        return len(self.campaign_ids)
+
+    def __contains__(self, campaign_id):
+        return campaign_id in self._index
+
+    def pod_count(self, campaign_id):
+        i = self._index[campaign_id]
+        return int(self.offsets[i + 1] - self.offsets[i])
+
+    def pods(self, campaign_id):
+        """
+        Returns the pods of a campaign in the format core.img_utils.draw_click_rate_bar reads.
+        Numeric fields are views into the store's arrays, not copies.
+        """
+        i = self._index[campaign_id]
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return {
+            'pod_count': int(end - start),
+            'height': self.height[start:end],
+            'click_rate': self.click_rate[start:end],
+            'pod_ctr': self.pod_ctr[start:end],
+            'label_name': self.labels[self.label_codes[start:end]],
+        }
+
+
+POD_FIELDS = ('pod_count', 'height', 'click_rate', 'pod_ctr', 'label_name')
+
+
+class CampaignCollection:
+    """
+    Read-only, dict-like view of a campaign DataFrame keyed by campaign_id, replacing df.set_index('campaign_id').to_dict('index').
+
+    Nothing is materialized up front: a column is converted to Python values the first time a record reads it,
+    and records are light handles onto a row. Pod fields (POD_FIELDS) are read from the PodStore, if any.
+
+    Example:
+        campaigns = cp.CampaignCollection(df, pods=pods)
+        for cid, campaign in campaigns.items():
+            campaign['country'], campaign['click_rate']
+    """
+    __slots__ = ('_df', '_key', '_index', '_values', 'campaign_ids', 'pods')
+
+    def __init__(self, df, pods=None, key='campaign_id'):
+        self._df = df # not copied, the collection only reads it
+        self._key = key
+        self.campaign_ids = df[key].tolist()
+        self._index = {cid: i for i, cid in enumerate(self.campaign_ids)}
+        self._values = {} # {column: list of Python values}, filled on first access
+        self.pods = pods
+
+    def column(self, name):
+        """
+        Returns the values of a column as a list of Python scalars, converting it on first access.
+        """
+        values = self._values.get(name)
+        if values is None:
+            values = self._values[name] = self._df[name].tolist()
+        return values
+
+    @property
+    def columns(self):
+        fields = [column for column in self._df.columns if column != self._key]
+        if self.pods is not None:
+            fields += list(POD_FIELDS)
+        return fields
+
+    def __len__(self):
+        return len(self.campaign_ids)
+
+    def __iter__(self):
+        return iter(self.campaign_ids)
+
+    def __contains__(self, campaign_id):
+        return campaign_id in self._index
+
+    def __getitem__(self, campaign_id):
+        return CampaignRecord(self, self._index[campaign_id], campaign_id)
+
+    def get(self, campaign_id, default=None):
+        return self[campaign_id] if campaign_id in self._index else default
+
+    def keys(self):
+        return list(self.campaign_ids)
+
+    def values(self):
+        return [self[cid] for cid in self.campaign_ids]
+
+    def items(self):
+        return [(cid, self[cid]) for cid in self.campaign_ids]
+
+
+class CampaignRecord:
+    """
+    One campaign of a CampaignCollection, read like a dict: campaign['country'].
+    """
+    __slots__ = ('_collection', '_row', 'campaign_id')
+
+    def __init__(self, collection, row, campaign_id):
+        self._collection = collection
+        self._row = row
+        self.campaign_id = campaign_id
+
+    def __getitem__(self, field):
+        pods = self._collection.pods
+        if pods is not None and field in POD_FIELDS:
+            return pods.pods(self.campaign_id)[field]
+        if field == self._collection._key:
+            raise KeyError(field) # the key is not a field, as with to_dict('index')
+        try:
+            return self._collection.column(field)[self._row]
+        except KeyError:
+            raise KeyError(field) from None
+
+    def get(self, field, default=None):
+        try:
+            return self[field]
+        except KeyError:
+            return default
+
+    def __contains__(self, field):
+        return field in self._collection.columns
+
+    def keys(self):
+        return self._collection.columns
+
+    def pods(self):
+        """
+        Returns the pods of the campaign, see PodStore.pods(). This, rather than the record, is what to send to other processes.
+        """
+        return self._collection.pods.pods(self.campaign_id)
+
+    def to_dict(self):
+        return {field: self[field] for field in self.keys()}
+
+    def __repr__(self):
+        return f'CampaignRecord({self.campaign_id!r})'
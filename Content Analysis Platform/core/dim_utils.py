@@ -0,0 +1,159 @@
+"""
+In-process index of the reference dimensions attached to query results: the open rate and CTR benchmarks
+(gcdm.benchmark, per market, segment and channel) and the pod click rate benchmarks (content.bm_click_rate, per
+pod position and relative height).
+
+Both tables are tiny, so rather than joining them in the warehouse on every request, they are loaded once per
+process into indexes keyed like the joins were, refreshed in the background every DIM_REFRESH_SECONDS, and
+attached to the campaign and click report results locally with vectorized lookups. The fact queries are plain
+filtered scans, whose cached results stay valid when the benchmarks are updated.
+
+Example:
+    df = dm.attach_benchmarks(be.run_query(query_campaign), channel='EMAIL') # adds bm_open_rate and bm_ctr
+"""
+import os
+import time
+import threading
+import warnings
+
+import numpy as np
+import pandas as pd
+
+import core.query_utils as qu
+import core.backend_utils as be
+
+
+DIM_REFRESH_SECONDS = float(os.environ.get('CAP_DIM_REFRESH_SECONDS', 60 * 60)) # 0 disables scheduled refreshes
+
+# Dimensions: {name: (table, key columns, value columns, aggregation of rows sharing a key)}
+DIMENSIONS = {
+    # Joined on market, segment (SUBSTR(c.Campaign, 26, 5), see qu.CAMPAIGN_COLUMNS['bm_segment']) and channel
+    'benchmark': (qu.TABLES['benchmark'], ['Market_Area', 'Segment', 'Channel'], ['open_rate', 'ctr'], 'first'),
+    # max, like the click report query aggregated the joined rows
+    'bm_click_rate': (qu.TABLES['bm_click_rate'], ['position', 'height_pct_bin'], ['click_rate'], 'max'),
+}
+
+
+class DimensionIndex:
+    """
+    A dimension table indexed by its key columns, one row per key.
+
+    Attributes:
+        keys (list): Key columns.
+        loaded_at (float): time.time() of the load.
+    """
+
+    def __init__(self, df, keys, values, aggregate='first'):
+        df = df.astype({k: object for k in keys}).groupby(keys, sort=False)[values].agg(aggregate)
+        self.keys = keys
+        self.index = df.index if isinstance(df.index, pd.MultiIndex) else pd.MultiIndex.from_arrays([df.index])
+        # Value arrays end with NaN, the value of a missing key (position -1)
+        self.values = {v: np.append(pd.to_numeric(df[v], errors='coerce').to_numpy(dtype=float), np.nan) for v in values}
+        self.loaded_at = time.time()
+
+    def __len__(self):
+        return len(self.index)
+
+    def lookup(self, *key_columns):
+        """
+        Looks the values up for each row of the key columns, like a LEFT JOIN would.
+
+        Args:
+            *key_columns: One array-like per key column, in the order of keys, or a scalar for a key shared by all rows.
+
+        Returns:
+            dict: {value column: np.ndarray of float}, NaN where the key is not in the dimension.
+        """
+        n = max((len(c) for c in key_columns if not np.isscalar(c)), default=1)
+        arrays = [np.full(n, c, dtype=object) if np.isscalar(c) else pd.Series(c).astype(object).to_numpy() for c in key_columns]
+        positions = self.index.get_indexer(pd.MultiIndex.from_arrays(arrays))
+        return {v: values[positions] for v, values in self.values.items()}
+
+
+def load_dimension(name):
+    """
+    Loads a dimension of DIMENSIONS from its table, bypassing the query cache.
+
+    Returns:
+        DimensionIndex: The indexed dimension.
+    """
+    table, keys, values, aggregate = DIMENSIONS[name]
+    df = be.run_query(qu.table_query(table), use_cache=False, label=f'dimension: {name}')
+    return DimensionIndex(df, keys, values, aggregate)
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+_refresher = None
+
+
+def get_dimension(name):
+    """
+    Returns the index of a dimension, loading it on first use. Later calls return the index of the last refresh.
+
+    Returns:
+        DimensionIndex: The indexed dimension.
+    """
+    index = _indexes.get(name)
+    if index is not None:
+        return index
+    with _indexes_lock:
+        _start_refresher()
+    # Load outside the lock, so a slow warehouse load does not block the other dimensions. When two sessions load
+    # the same dimension at once, the first index inserted wins
+    index = load_dimension(name)
+    with _indexes_lock:
+        return _indexes.setdefault(name, index)
+
+
+def refresh_dimensions():
+    """
+    Reloads every dimension loaded so far. An index is swapped in whole, so readers see either the old or the new one.
+    """
+    for name in list(_indexes):
+        _indexes[name] = load_dimension(name)
+
+
+def _refresh_loop():
+    while True:
+        time.sleep(DIM_REFRESH_SECONDS)
+        try:
+            refresh_dimensions()
+        except Exception as e:
+            warnings.warn(f'Dimension refresh failed, keeping the current indexes: {e}')
+
+
+def _start_refresher():
+    global _refresher
+    if _refresher is None and DIM_REFRESH_SECONDS > 0:
+        _refresher = threading.Thread(target=_refresh_loop, name='dimension-refresh', daemon=True)
+        _refresher.start()
+
+
+def attach_benchmarks(df, channel):
+    """
+    Adds the open rate and CTR benchmarks of each campaign, looked up by market, segment and channel.
+
+    Args:
+        df (pd.DataFrame): Campaign query result with 'country' (as queried, not lowercased) and 'bm_segment'.
+        channel (str): Channel the campaigns were queried for, 'EMAIL' or 'PUSH'.
+
+    Returns:
+        pd.DataFrame: df with 'bm_open_rate' and 'bm_ctr' added (NaN without a benchmark) and 'bm_segment' dropped.
+    """
+    values = get_dimension('benchmark').lookup(df['country'], df['bm_segment'], channel)
+    return df.drop(columns='bm_segment').assign(bm_open_rate=values['open_rate'], bm_ctr=values['ctr'])
+
+
+def attach_pod_benchmarks(df_click):
+    """
+    Adds the click rate benchmark of each pod, looked up by pod position and relative height.
+
+    Args:
+        df_click (pd.DataFrame): Click report query result with 'position' and 'height_bin'.
+
+    Returns:
+        pd.DataFrame: df_click with 'bm_click_rate' added (NaN without a benchmark).
+    """
+    values = get_dimension('bm_click_rate').lookup(df_click['position'], df_click['height_bin'])
+    return df_click.assign(bm_click_rate=values['click_rate'])
@@ -1,112 +1,436 @@
-import pandas as pd
+import os
+import time
+import threading
+import weakref
+import importlib.util
+import multiprocessing
+from itertools import repeat
+from functools import lru_cache
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
 
-import matplotlib.pyplot as plt
-from matplotlib.patches import Rectangle
+import numpy as np
 
-from PIL import Image
+from PIL import Image, ImageDraw, ImageFont
 from io import BytesIO
 
+import core.cache_utils as cu
+import core.trace_utils as tr
 
-def get_img_from_dict(data_dict, storage_client, bucket_name):
-    bucket = storage_client.get_bucket(bucket_name)
-    
-    img_dict = {}
-    for cid, data in data_dict.items():
+
+FETCH_WORKERS = 8 # Max concurrent creative downloads, shared by all sessions of this process
+BLOB_TIMEOUT = 20 # Seconds allowed for a single blob download
+
+DISPLAY_WIDTH = 300 # Creatives are displayed at width=300 on both analysis pages
+DISPLAY_SCALE = 2 # Keep 2x the display width so creatives stay sharp on retina screens
+DERIVATIVE_QUALITY = 85 # JPEG quality of cached display-sized renditions
+
+CLICK_BAR_WIDTH = 75 # Click bars are displayed at width=75 next to the creative
+CLICK_BAR_DISPLAY_WIDTH = 300 # Width the creative is displayed at, the bar height follows its aspect ratio
+CLICK_BAR_PAD = 15 # White margin around the pods (what matplotlib's tight_layout used to leave)
+CLICK_BAR_VALUE_FONT_SIZE = 12 # 8.5pt at 100 dpi
+CLICK_BAR_LABEL_FONT_SIZE = 10 # 7pt at 100 dpi
+
+# Click bar render processes, 1 renders in-process. A single-core host gets 1: a worker process there only adds
+# its round trip to the render
+RENDER_WORKERS = int(os.environ.get('CAP_RENDER_WORKERS', min(4, os.cpu_count() or 1)))
+
+_fetch_pool = None
+_fetch_pool_lock = threading.Lock()
+_bucket_handles = weakref.WeakKeyDictionary() # {storage_client: {bucket_name: bucket}}
+
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+
+def get_fetch_pool():
+    """
+    Returns the bounded thread pool used for creative downloads, creating it on first use.
+    """
+    global _fetch_pool
+    with _fetch_pool_lock:
+        if _fetch_pool is None:
+            _fetch_pool = ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix='creative-fetch')
+    return _fetch_pool
+
+
+def get_bucket(storage_client, bucket_name):
+    """
+    Returns a bucket handle that is reused across calls for the same client.
+    storage_client.bucket() builds the handle locally, without the metadata round trip of get_bucket().
+    """
+    with _fetch_pool_lock:
+        buckets = _bucket_handles.setdefault(storage_client, {})
+        if bucket_name not in buckets:
+            buckets[bucket_name] = storage_client.bucket(bucket_name)
+        return buckets[bucket_name]
+
+
+def get_blob_paths(bucket_name, cid, country):
+    """
+    Returns the candidate blob paths of a campaign creative, in the order they should be tried.
+    """
+    if bucket_name == 'creative-edm':
+        return [f"{country}/{cid}.jpg"]
+    return [f"phone/display/{country}/{cid}.jpg", f"tablet/display/{country}/{cid}.jpg"]
+
+
+@tr.traced('gcs')
+def fetch_blob_bytes(bucket, paths, timeout=BLOB_TIMEOUT, cache=None):
+    """
+    Downloads the first existing blob out of paths.
+    Without a cache, blobs are downloaded directly (instead of get_blob + download), which costs one round trip per candidate path.
+    With a cache (core.cache_utils.CreativeCache), each path costs a metadata check and the download only happens if the blob changed.
+
+    Returns:
+        bytes: The blob content, or None if none of the paths exist.
+    """
+    from google.api_core.exceptions import NotFound
+
+    for path in paths:
+        if cache is not None:
+            _, content = cache.fetch(bucket, path, timeout=timeout)
+            if content is not None:
+                return content
+            continue
         try:
-            if bucket_name == 'creative-edm':
-                blob = bucket.get_blob(f"{data['country']}/{cid}.jpg")
-            else:
-                blob = bucket.get_blob(f"phone/display/{data['country']}/{cid}.jpg")
-                if blob is None:
-                    blob = bucket.get_blob(f"tablet/display/{data['country']}/{cid}.jpg")
+            return bucket.blob(path).download_as_bytes(timeout=timeout)
+        except NotFound:
+            continue
+    return None
 
-            img = Image.open(BytesIO(blob.download_as_bytes()))
-            img_dict[cid] = img
-        except:
+
+@tr.traced('decode')
+def make_display_image(content, width=DISPLAY_WIDTH, scale=DISPLAY_SCALE):
+    """
+    Decodes a creative directly to its display size.
+
+    For JPEGs, Image.draft() lets the decoder downscale by 1/2, 1/4 or 1/8 while decoding, so a tall creative
+    never gets decoded at full resolution. The result is then resized to exactly width * scale pixels wide.
+
+    Args:
+        content (bytes): Encoded creative.
+        width (int): Display width in pixels, or None to keep the original resolution.
+        scale (int): Pixel density multiplier (2 for retina renditions).
+
+    Returns:
+        PIL.Image: The decoded (RGB) rendition.
+    """
+    img = Image.open(BytesIO(content))
+    if width is None or img.width <= width * scale:
+        img.load()
+        return img
+
+    target_w = width * scale
+    target_h = max(1, round(img.height * target_w / img.width)) # use original size, draft() may round it
+    img.draft('RGB', (target_w, target_h))
+    return img.convert('RGB').resize((target_w, target_h), Image.LANCZOS)
+
+
+@tr.traced('encode')
+def encode_jpeg(img, quality=DERIVATIVE_QUALITY):
+    buf = BytesIO()
+    img.convert('RGB').save(buf, format='JPEG', quality=quality, optimize=True)
+    return buf.getvalue()
+
+
+@tr.traced('creative')
+def _fetch_image(bucket, paths, timeout, cache, width, scale):
+    if cache is None or width is None:
+        content = fetch_blob_bytes(bucket, paths, timeout=timeout, cache=cache)
+        if content is None:
+            return None
+        return make_display_image(content, width=width, scale=scale) # decode in the worker thread rather than lazily in the page
+
+    # Serve the display-sized rendition of the current generation if it was derived before,
+    # so the original is neither read nor decoded
+    variant = f'@{width}w{scale}x'
+    for path in paths:
+        with tr.span('gcs', metadata_only=True):
+            generation = cache.current_generation(bucket, path, timeout=timeout)
+        if generation is None:
             continue
 
-    return img_dict
+        derivative = cache.get(bucket.name, path, generation, variant)
+        if derivative is not None:
+            with tr.span('decode', derivative=True):
+                img = Image.open(BytesIO(derivative))
+                img.load()
+            return img
 
+        with tr.span('gcs'):
+            generation, content = cache.fetch(bucket, path, timeout=timeout) # the generation downloaded, if overwritten since the check
+        if content is None: # deleted since the metadata check
+            continue
+        img = make_display_image(content, width=width, scale=scale)
+        if generation is not None:
+            cache.put(bucket.name, path, generation, encode_jpeg(img), variant)
+        return img
+    return None
 
-def ctr_adjust_for_color(click_rate_list):
-    adjusted_list = []
-    for cr in click_rate_list:
-        if cr > 0.03:
-            adjusted_list.append(1)
+
+def submit_img_fetches(data_dict, storage_client, bucket_name, timeout=BLOB_TIMEOUT, use_cache=True, width=DISPLAY_WIDTH, scale=DISPLAY_SCALE):
+    """
+    Starts fetching the creatives of all campaigns in data_dict on the fetch pool, without waiting for them.
+    Arguments are those of get_img_from_dict.
+
+    Returns:
+        dict: {campaign_id: Future}, in data_dict order. Each future resolves to a PIL.Image, or None if the creative does not exist.
+    """
+    bucket = get_bucket(storage_client, bucket_name)
+    pool = get_fetch_pool()
+    cache = cu.get_creative_cache() if use_cache else None
+
+    futures = {}
+    for cid, data in data_dict.items():
+        paths = get_blob_paths(bucket_name, cid, data['country'])
+        futures[cid] = pool.submit(tr.bind(_fetch_image), bucket, paths, timeout, cache, width, scale)
+    return futures
+
+
+def get_fetch_result(future):
+    """
+    Returns (img, reason) for a future from submit_img_fetches, waiting for it: reason is None if img was fetched.
+    """
+    try:
+        img = future.result()
+    except Exception as e:
+        return None, f'{type(e).__name__}: {e}'
+    if img is None:
+        return None, 'not found'
+    return img, None
+
+
+def get_img_from_dict(data_dict, storage_client, bucket_name, timeout=BLOB_TIMEOUT, use_cache=True, width=DISPLAY_WIDTH, scale=DISPLAY_SCALE):
+    """
+    Fetches the creatives of all campaigns in data_dict concurrently, as display-sized renditions.
+
+    Args:
+        data_dict (dict or core.cp_utils.CampaignCollection): {campaign_id: {'country': 'sg', ...}}
+        storage_client (storage.Client): Client used to reach the bucket.
+        bucket_name (str): 'creative-edm' or 'creative-push'.
+        timeout (float): Seconds allowed for each blob download.
+        use_cache (bool): Serve creatives from the local creative cache (core.cache_utils), if enabled.
+        width (int): Display width of the creatives, or None to return full-resolution originals.
+        scale (int): Pixel density multiplier of the renditions (2 for retina).
+
+    Returns:
+        tuple: A tuple containing:
+            - img_dict (dict): {campaign_id: PIL.Image}, in data_dict order.
+            - missing (dict): {campaign_id: reason} for creatives that could not be fetched.
+    """
+    futures = submit_img_fetches(data_dict, storage_client, bucket_name, timeout=timeout, use_cache=use_cache, width=width, scale=scale)
+
+    img_dict = {}
+    missing = {}
+    for cid, future in futures.items(): # iterate in submission order to keep data_dict order
+        img, reason = get_fetch_result(future)
+        if img is None:
+            missing[cid] = reason
         else:
-            adjusted_list.append(cr / 0.03)
-    return adjusted_list
+            img_dict[cid] = img
+
+    return img_dict, missing
+
+
+def ctr_adjust_for_color(click_rate_list):
+    # Scale CTRs so that 3% and above gets the full color
+    return np.minimum(np.asarray(click_rate_list, dtype=float) / 0.03, 1)
 
 
 def color_gradient(click_rate):
     #https://rgbcolorpicker.com/0-1
+    # Accepts a single click rate (returns an (r,g,b) tuple) or an array of them (returns an (n, 3) array)
+
+    cr = np.asarray(click_rate, dtype=float)
+    r,b = 1 - cr, 1 - cr
+    g = 1 - ((1 - 0.7)*cr)
+
+    rgb = np.stack([r, g, b], axis=-1)
+    if rgb.ndim == 1:
+        return tuple(rgb)
+    return rgb
+
 
-    r,b = 1 - click_rate, 1 - click_rate
-    g = 1 - ((1 - 0.7)*click_rate)
+@lru_cache(maxsize=None)
+def _get_font(size):
+    # Same font matplotlib used to render the click bar, found without importing matplotlib
+    spec = importlib.util.find_spec('matplotlib')
+    if spec is not None and spec.origin is not None:
+        font_path = os.path.join(os.path.dirname(spec.origin), 'mpl-data', 'fonts', 'ttf', 'DejaVuSans.ttf')
+        if os.path.exists(font_path):
+            return ImageFont.truetype(font_path, size)
+    try:
+        return ImageFont.truetype('DejaVuSans.ttf', size)
+    except OSError:
+        return ImageFont.load_default()
 
-    return (r,g,b)
 
+def render_click_rate_bar(bar_height, heights, colors, values, labels, bar_width=CLICK_BAR_WIDTH, pad=CLICK_BAR_PAD):
+    """
+    Rasterizes a click rate bar: one colored, black-edged box per pod, stacked top to bottom, each sized by its
+    height ratio and annotated with its value and label.
 
+    Args:
+        bar_height (int): Height of the image in pixels.
+        heights (array-like): Relative height of each pod.
+        colors (np.ndarray): (n, 3) RGB colors in 0-1.
+        values (list): Value text of each pod.
+        labels (list): Label text of each pod.
+        bar_width (int): Width of the image in pixels.
+        pad (int): White margin around the pods in pixels.
+
+    Returns:
+        PIL.Image: The rendered bar (RGB).
+    """
+    heights = np.asarray(heights, dtype=float)
+    colors = (np.clip(np.asarray(colors, dtype=float).reshape(-1, 3), 0, 1) * 255).round().astype(np.uint8)
+
+    buf = np.full((bar_height, bar_width, 3), 255, dtype=np.uint8)
+    left, right = pad, bar_width - pad
+    inner_height = max(bar_height - 2 * pad, len(heights))
+
+    # Pod boundaries (in pixel rows) from the cumulative height ratios
+    edges = pad + np.round(np.concatenate([[0], np.cumsum(heights)]) / heights.sum() * inner_height).astype(int)
+    edges = np.minimum(edges, bar_height - 1)
+
+    # Fill every pod row with its color in one go
+    row_pod = np.repeat(np.arange(len(heights)), np.diff(edges))
+    buf[edges[0]:edges[-1], left:right] = colors[row_pod][:, None, :]
+
+    # Black edges: one line per pod boundary, plus both sides
+    buf[edges, left:right] = 0
+    buf[edges[0]:edges[-1] + 1, [left, right - 1]] = 0
+
+    img = Image.fromarray(buf)
+    draw = ImageDraw.Draw(img)
+    value_font = _get_font(CLICK_BAR_VALUE_FONT_SIZE)
+    label_font = _get_font(CLICK_BAR_LABEL_FONT_SIZE)
+    center_x = (left + right) / 2
+    for top, bottom, value, label in zip(edges[:-1], edges[1:], values, labels):
+        pod_height = bottom - top
+        draw.text((center_x, top + 0.4 * pod_height), value, fill='black', font=value_font, anchor='mm') # click rate in middle
+        draw.text((center_x, top + 0.6 * pod_height), label, fill='black', font=label_font, anchor='mm') # label name below
+
+    return img
+
+
+@tr.traced('click_bar')
 def draw_click_rate_bar(img, data, click_data_type):
-    # https://stackoverflow.com/questions/27267305/plotting-rectangles-in-different-subplots-in-python
+    # data holds the pods of the campaign {'pod_count':3, 'click_rate':[0.3, 0.2, 0.4], ...}, e.g. a core.cp_utils.CampaignRecord or PodStore.pods()
+    return _draw_click_rate_bar(img.size, data, click_data_type)
 
-    # data is a dict {'country':'sg', 'curiosity':0.4, 'pod_count':3, 'click_rate':[0.3, 0.2, 0.4], ...}
 
-    w, h = img.size
+def _draw_click_rate_bar(img_size, data, click_data_type):
+    # Only the creative's size is needed, so batch rendering does not have to ship images to worker processes
+    w, h = img_size
     h = h*1.05 #add 5% for footer
 
     pod_count = data['pod_count']
 
     if click_data_type == 'Pod click contribution':
-        click_rate_list = data['click_rate']
-        color_data_list = data['click_rate']
+        click_rate_list = np.asarray(data['click_rate'], dtype=float)[:pod_count]
+        color_data_list = click_rate_list
         round_decimal = 1
     elif click_data_type == 'Pod CTR':
-        click_rate_list = data['pod_ctr']
+        click_rate_list = np.asarray(data['pod_ctr'], dtype=float)[:pod_count]
         color_data_list = ctr_adjust_for_color(click_rate_list)
         round_decimal = 2
 
-    click_label_list = data['label_name']
-    height_ratios = data['height']
-
-    color = []
-    click_rate = []
-    click_label = []
-    for i in range(pod_count):
-        color.append(color_gradient(color_data_list[i])) #convert click rate to color
-        click_rate.append(str(round(click_rate_list[i]*100, round_decimal)) + '%') #display click rate as percentage
-        click_label.append(str(click_label_list[i]))
-
-    df = pd.DataFrame({
-        'Color': color,
-        'Value': click_rate,
-        'Label': click_label
-    })
-
-    px = 1/plt.rcParams['figure.dpi'] #pixel in inches
-    fig = plt.figure(figsize=(75*px, 300*h/w*px)) #image width is fixed at 300px on CAP --> calc corresponding height
-    ax = fig.subplots(pod_count, 1, height_ratios=height_ratios)
-
-    for i in range(pod_count):
-        ax[i].add_patch(Rectangle(xy=(0,0), width=100, height=100, facecolor=df['Color'][i], edgecolor='black')) #arbitrarily pick 100 for scale
-        ax[i].annotate(df['Value'][i], xy=(50, 60), ha='center', va='center', color='black', fontsize=8.5) #annotate click rate in middle
-        ax[i].annotate(df['Label'][i], xy=(50, 40), ha='center', va='center', color='black', fontsize=7) #annotate label name in middle
-
-        ax[i].set_ylim((0,100))
-        ax[i].set_xlim((0,100))
-        ax[i].set_frame_on(False) #remove frame
-        ax[i].set_axis_off() #remove axis
-
-    plt.tight_layout() #remove white space
-    plt.subplots_adjust(wspace=0, hspace=0) #remove gap between axs
-
-    # convert fig to image object
+    colors = color_gradient(np.atleast_1d(color_data_list)) #convert click rate to color
+    click_rate = [str(round(cr*100, round_decimal)) + '%' for cr in click_rate_list] #display click rate as percentage
+    click_label = [str(label) for label in data['label_name'][:pod_count]]
+
+    bar_height = round(CLICK_BAR_DISPLAY_WIDTH*h/w) #image width is fixed at 300px on CAP --> calc corresponding height
+
+    return render_click_rate_bar(bar_height, data['height'][:pod_count], colors, click_rate, click_label)
+
+
+def _click_rate_bar_png(img_size, data, click_data_type):
     buf = BytesIO()
-    fig.savefig(buf)
-    buf.seek(0)
-    img_out = Image.open(buf)
+    _draw_click_rate_bar(img_size, data, click_data_type).save(buf, format='PNG')
+    return buf.getvalue()
+
+
+def get_render_pool():
+    """
+    Returns the worker process pool click bars are rendered in when RENDER_WORKERS > 1, creating it on first use.
+    Workers are spawned rather than forked, as the Streamlit server process is multi-threaded.
+    """
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            _render_pool = ProcessPoolExecutor(max_workers=RENDER_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    return _render_pool
+
+
+def render_click_rate_bars(img_dict, pod_store, click_data_type):
+    """
+    Renders the click rate bars of all campaigns in img_dict, spread across a worker process pool.
+    A single campaign is rendered in-process, where a round trip to the pool would cost more than it saves.
+
+    Args:
+        img_dict (dict): {campaign_id: PIL.Image}, as returned by get_img_from_dict.
+        pod_store (core.cp_utils.PodStore): Pods of the campaigns.
+        click_data_type (str): 'Pod click contribution' or 'Pod CTR'.
+
+    Returns:
+        list: PNG-encoded click bars (bytes), in img_dict order.
+    """
+    sizes = [img.size for img in img_dict.values()]
+    # Ship only the pods of each campaign (slices of the store's arrays), not the whole campaign record
+    pod_data = [pod_store.pods(cid) for cid in img_dict]
+
+    if len(sizes) <= 1 or RENDER_WORKERS <= 1:
+        return [_click_rate_bar_png(size, data, click_data_type) for size, data in zip(sizes, pod_data)]
+
+    chunksize = max(1, len(sizes) // (RENDER_WORKERS * 4))
+    return list(get_render_pool().map(_click_rate_bar_png, sizes, pod_data, repeat(click_data_type), chunksize=chunksize))
+
+
+def submit_click_rate_bar(img_future, pods, click_data_type):
+    """
+    Renders a click rate bar once the creative it goes with is fetched, without waiting for it.
+
+    Args:
+        img_future (Future): The creative, from submit_img_fetches.
+        pods (dict): The campaign's pods, from core.cp_utils.PodStore.pods() (or CampaignRecord.pods()).
+        click_data_type (str): 'Pod click contribution' or 'Pod CTR'.
+
+    Returns:
+        Future: The PNG-encoded click bar (bytes), or None if there is no creative.
+    """
+    bar_future = Future()
+
+    def render(done):
+        try:
+            img = done.result()
+            if img is None:
+                bar_future.set_result(None)
+            elif RENDER_WORKERS <= 1:
+                with tr.span('click_bar'):
+                    bar_future.set_result(_click_rate_bar_png(img.size, pods, click_data_type))
+            else:
+                submitted_at = time.perf_counter()
+
+                def rendered(f):
+                    # Timed from here, worker processes do not trace: incl. the queueing and transfer to the pool
+                    tr.record('click_bar', time.perf_counter() - submitted_at, worker='process')
+                    _set_future_from(bar_future, f)
+
+                inner = get_render_pool().submit(_click_rate_bar_png, img.size, pods, click_data_type)
+                inner.add_done_callback(tr.bind(rendered))
+        except Exception as e:
+            bar_future.set_exception(e)
+
+    img_future.add_done_callback(tr.bind(render))
+    return bar_future
+
 
-    return img_out
+def _set_future_from(target, source):
+    if source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
 
 
 def truncate_labels(labels, max_len=10): #labels is a list
@@ -0,0 +1,380 @@
+"""
+Builds the warehouse queries of the pages from a declarative spec: which columns, which filters and which ordering.
+
+Columns are asked for by their page-side names (e.g. 'delivered' for c.Delivery_Success) and come back under those
+names. A table is joined only if a projected column needs it, and every value is passed as a query parameter, so
+the same spec always gives the same query text (and so the same query cache key).
+
+Builders return a Query, which renders to the SQL of each engine (BIGQUERY or DUCKDB, see core.backend_utils):
+the logical query is the same, only table quoting, parameter markers and array membership differ.
+
+Example:
+    query = qu.campaign_query('EMAIL', ['campaign_id', 'country', 'date'], campaign_ids=['0000111111'])
+    df = be.run_query(query, label='get_campaign_data: campaigns')
+"""
+import core.bq_utils as bq
+import core.sl_utils as sl
+
+
+TABLES = {
+    'campaigns': 'xxx.gcdm.campaigns',
+    'campaign_asset_push': 'xxx.gcdm.campaign_asset_push',
+    'benchmark': 'xxx.gcdm.benchmark',
+    'click_report': 'xxx.gcdm.click_report',
+    'subject_line': 'xxx.content.subject_line',
+    'bm_click_rate': 'xxx.content.bm_click_rate',
+}
+
+# Best practice tables per channel: (subject line features, subject line performance)
+BP_TABLES = {
+    'EMAIL': ('xxx.content.bp_edm_sl', 'xxx.content.bp_edm_sl_perf'),
+    'PUSH': ('xxx.content.bp_pn_sl', 'xxx.content.bp_pn_sl_perf'),
+}
+
+# Feature tables hold one row per top_flag: '1' (best performing average), '0' (other campaigns average),
+# 'magnitude' and 'direction' (feature importance)
+BP_FEATURE_FLAGS = ['1', '0', 'magnitude', 'direction']
+
+
+class Dialect:
+    """
+    The SQL syntax of an engine, for the few constructs the queries below use that differ between engines.
+    """
+
+    def __init__(self, name, quote, param_marker, in_array, string_type):
+        self.name = name
+        self.quote = quote
+        self.param_marker = param_marker
+        self._in_array = in_array
+        self.string_type = string_type
+
+    def table(self, name):
+        return f'{self.quote}{name}{self.quote}'
+
+    def param(self, name):
+        return f'{self.param_marker}{name}'
+
+    def in_array(self, expr, name):
+        # Membership of expr in an array parameter
+        return self._in_array.format(expr=expr, param=self.param(name))
+
+
+BIGQUERY = Dialect('bigquery', quote='`', param_marker='@', in_array='{expr} IN UNNEST({param})', string_type='STRING')
+DUCKDB = Dialect('duckdb', quote='"', param_marker='$', in_array='list_contains({param}, {expr})', string_type='VARCHAR')
+
+
+class Query:
+    """
+    A logical query: renders to the SQL of a dialect, with its parameters.
+
+    Attributes:
+        params (list): (name, type, value) query parameters.
+        tables (list): Tables read.
+        filters (dict): The selection it was built for, e.g. {'market': 'SG', 'start_date': ...}, for routing (core.backend_utils).
+    """
+    __slots__ = ('_build', '_sql', 'params', 'tables', 'filters')
+
+    def __init__(self, build, params=(), tables=(), filters=None):
+        self._build = build
+        self._sql = {}
+        self.params = list(params)
+        self.tables = list(tables)
+        self.filters = filters or {}
+
+    def sql(self, dialect=BIGQUERY):
+        if dialect.name not in self._sql:
+            self._sql[dialect.name] = self._build(dialect)
+        return self._sql[dialect.name]
+
+    def job_config(self):
+        """
+        Returns the BigQuery job configuration carrying the parameters.
+        """
+        return bq.make_job_config(query_parameters=self.params)
+
+    def param_values(self):
+        return {name: value for name, _, value in self.params}
+
+    def __repr__(self):
+        return f'Query({self.sql()!r}, params={self.params!r})'
+
+
+# Campaign columns: {name: (SQL expression, join needed or None)}, c is gcdm.campaigns
+CAMPAIGN_COLUMNS = {
+    'campaign_id': ('c.HYBRIS_ID', None),
+    'product': ('c.Division', None),
+    'country': ('c.Market_Area', None),
+    'date': ('c.date', None),
+    'campaign_name': ('c.Campaign', None),
+    'segment_name': ('c.Segment', None),
+    'delivered': ('c.Delivery_Success', None),
+    'opened': ('c.Opened_Displayed', None),
+    'clicked': ('c.Clicked', None),
+    'subject_line': ('c.Email_Title', None),
+    'ticker': ('p.ticker', 'push'),
+    'text': ('p.text', 'push'),
+    'bm_segment': ('SUBSTR(c.Campaign, 26, 5)', None), # segment the benchmarks are keyed by (refer to core.dim_utils.py)
+}
+CAMPAIGN_COLUMNS.update({feature: (f'sl.{feature}', 'subject_line') for feature in sl.list_sl_all})
+
+# Joins: {join: (table, JOIN clause with the table as {table})}
+CAMPAIGN_JOINS = {
+    'push': ('campaign_asset_push', "LEFT JOIN {table} p ON c.HYBRIS_ID = p.HYBRIS_ID"),
+    # Inner join: only campaigns whose subject line is tagged
+    'subject_line': ('subject_line', "JOIN {table} sl ON c.Email_Title = sl.subject_line"),
+}
+
+# Sorting options of the Content Comparison page
+CAMPAIGN_ORDERINGS = {
+    'Campaign ID': 'c.HYBRIS_ID',
+    'Market': 'c.Market_Area',
+    'Sent': 'c.Delivery_Success DESC',
+    'OR': 'c.Opened_Displayed/c.Delivery_Success DESC',
+    'CTR': 'c.Clicked/c.Opened_Displayed DESC',
+    'Segment': 'c.Segment',
+    'Campaign Date': 'c.date',
+}
+
+# Click report columns, aggregated per pod: {name: (SQL expression, join needed or None)}, c is gcdm.click_report
+CLICK_REPORT_COLUMNS = {
+    'campaign_id': ('c.HYBRIS_ID', None),
+    'pod': ('c.Pod_adj', None),
+    'height': ('max(c.Height_pct)', None),
+    'click_rate': ('sum(c.Click_Rate)', None),
+    'pod_ctr': ('sum(c.CTR)', None),
+    'pod_ctr_with_unsub': ('sum(c.CTR_With_Unsubscribe)', None),
+    'click_rate_excl_footer': ('coalesce(sum(c.CR_Excl_Footer), 0)', None),
+    'click_rate_with_unsub': ('sum(c.CR_With_Unsubscribe)', None),
+    'label_name': ('any_value(c.Label_Name)', None),
+    'url': ('any_value(c.Url)', None),
+    'position': ('any_value(c.Pod_Position)', None),
+    'height_bin': ('any_value(c.Height_pct_bin)', None),
+}
+CLICK_REPORT_KEYS = ['campaign_id', 'pod'] # one row per pod
+
+CLICK_REPORT_JOINS = {} # pod benchmarks are attached locally by position and height_bin (refer to core.dim_utils.py)
+
+
+def campaign_filters(dialect, campaign_ids=None, market=None, start_date=None, end_date=None, channel=None):
+    """
+    Returns the WHERE conditions and query parameters of a campaign selection, for tables aliased c.
+
+    Returns:
+        tuple: (conditions, params), a list of SQL conditions and a list of (name, type, value) parameters.
+    """
+    conditions, params = [], []
+    if campaign_ids is not None:
+        conditions.append(dialect.in_array("c.HYBRIS_ID", "campaign_ids"))
+        params.append(("campaign_ids", "STRING", list(campaign_ids)))
+    if market is not None:
+        conditions.append(f"c.Market_Area = {dialect.param('market')}")
+        params.append(("market", "STRING", market))
+    if start_date is not None and end_date is not None:
+        conditions.append(f"c.date BETWEEN {dialect.param('start_date')} AND {dialect.param('end_date')}")
+        params += [("start_date", "DATE", start_date), ("end_date", "DATE", end_date)]
+    if channel is not None:
+        conditions.append(f"c.Channel = {dialect.param('channel')}")
+        params.append(("channel", "STRING", channel))
+    return conditions, params
+
+
+def projected_joins(columns, column_specs, join_specs):
+    # Joins needed by the projected columns, in join_specs order
+    return [j for j in join_specs if any(column_specs[c][1] == j for c in columns)]
+
+
+def build_query(dialect, table, columns, column_specs, join_specs, conditions, group_by=(), order_by=()):
+    """
+    Assembles a SELECT over table (aliased c) from projected columns, joining only the tables they need.
+
+    Args:
+        dialect (Dialect): SQL syntax to use.
+        table (str): Fully qualified table name.
+        columns (list): Names of the projected columns, keys of column_specs.
+        column_specs (dict): {name: (SQL expression, join needed or None)}.
+        join_specs (dict): {join: (table, JOIN clause)}.
+        conditions (list): SQL conditions, ANDed.
+        group_by (list): Names of projected columns to group by.
+        order_by (list): SQL ordering expressions.
+
+    Returns:
+        str: The query text.
+    """
+    unknown = [c for c in columns if c not in column_specs]
+    if unknown:
+        raise ValueError(f'Unknown columns: {unknown}')
+
+    select = ',\n            '.join(f'{column_specs[c][0]} AS {c}' for c in columns)
+    joins = [join_specs[j][1].format(table=dialect.table(TABLES[join_specs[j][0]])) for j in projected_joins(columns, column_specs, join_specs)]
+    lines = [f"SELECT\n            {select}", f"FROM {dialect.table(table)} c"] + joins
+    if conditions:
+        lines.append("WHERE " + " AND ".join(conditions))
+    if group_by:
+        lines.append("GROUP BY " + ", ".join(group_by))
+    if order_by:
+        lines.append("ORDER BY " + ", ".join(order_by))
+    return "\n        ".join(lines)
+
+
+def campaign_query(channel, columns, campaign_ids=None, market=None, start_date=None, end_date=None, order_by=None):
+    """
+    Builds the campaign query of a channel.
+
+    Args:
+        channel (str): 'EMAIL' or 'PUSH'.
+        columns (list): Names of the projected columns, keys of CAMPAIGN_COLUMNS.
+        campaign_ids (list): Campaigns to select.
+        market (str): Market to select, e.g. 'SG'.
+        start_date, end_date (datetime.date): Campaign date range to select (inclusive).
+        order_by (str): A key of CAMPAIGN_ORDERINGS.
+
+    Returns:
+        Query: The query.
+    """
+    filters = {'campaign_ids': campaign_ids, 'market': market, 'start_date': start_date, 'end_date': end_date, 'channel': channel}
+    ordering = [CAMPAIGN_ORDERINGS[order_by]] if order_by else []
+
+    def build(dialect):
+        conditions, _ = campaign_filters(dialect, **filters)
+        return build_query(dialect, TABLES['campaigns'], columns, CAMPAIGN_COLUMNS, CAMPAIGN_JOINS, conditions, order_by=ordering)
+
+    _, params = campaign_filters(BIGQUERY, **filters)
+    tables = [TABLES['campaigns']] + [TABLES[CAMPAIGN_JOINS[j][0]] for j in projected_joins(columns, CAMPAIGN_COLUMNS, CAMPAIGN_JOINS)]
+    return Query(build, params, tables=tables, filters=filters)
+
+
+def click_report_query(columns, campaign_ids=None, market=None, start_date=None, end_date=None):
+    """
+    Builds the click report query, one row per pod of each selected campaign, ordered by campaign and pod.
+
+    Args:
+        columns (list): Names of the projected columns, keys of CLICK_REPORT_COLUMNS. campaign_id and pod are always included first.
+        campaign_ids (list): Campaigns to select.
+        market (str): Market to select, e.g. 'SG'.
+        start_date, end_date (datetime.date): Campaign date range to select (inclusive).
+
+    Returns:
+        Query: The query.
+    """
+    columns = CLICK_REPORT_KEYS + [c for c in columns if c not in CLICK_REPORT_KEYS]
+    filters = {'campaign_ids': campaign_ids, 'market': market, 'start_date': start_date, 'end_date': end_date}
+
+    def build(dialect):
+        conditions, _ = campaign_filters(dialect, **filters)
+        return build_query(dialect, TABLES['click_report'], columns, CLICK_REPORT_COLUMNS, CLICK_REPORT_JOINS, conditions, group_by=CLICK_REPORT_KEYS, order_by=CLICK_REPORT_KEYS)
+
+    _, params = campaign_filters(BIGQUERY, **filters)
+    tables = [TABLES['click_report']] + [TABLES[CLICK_REPORT_JOINS[j][0]] for j in projected_joins(columns, CLICK_REPORT_COLUMNS, CLICK_REPORT_JOINS)]
+    return Query(build, params, tables=tables, filters=filters)
+
+
+def best_practice_query(channel, market, objective=None, product=None):
+    """
+    Builds the query returning both the feature rows and the subject lines of a best practice selection, stacked
+    with UNION ALL and told apart by the 'part' column.
+
+    Returns:
+        Query: The query.
+    """
+    feature_table, perf_table = BP_TABLES[channel]
+
+    params = [("market", "STRING", market)]
+    if channel == 'EMAIL':
+        params += [("objective", "STRING", objective), ("product", "STRING", product)]
+    params.append(("feature_flags", "STRING", BP_FEATURE_FLAGS))
+
+    features = ', '.join(sl.list_sl_all)
+    null_features = ', '.join(f'NULL AS {f}' for f in sl.list_sl_all)
+
+    def build(d):
+        where_clause = f"country = {d.param('market')}"
+        if channel == 'EMAIL':
+            where_clause += f" AND product = {d.param('product')} AND objective = {d.param('objective')}"
+
+        return f"""
+        SELECT
+            'features' AS part, top_flag, {features}, NULL AS subject_line, NULL AS rank
+        FROM {d.table(feature_table)}
+        WHERE {where_clause} AND {d.in_array('top_flag', 'feature_flags')}
+
+        UNION ALL
+
+        SELECT
+            'subject_lines' AS part, CAST(top_flag AS {d.string_type}) AS top_flag, {null_features}, subject_line, rank
+        FROM {d.table(perf_table)}
+        WHERE {where_clause} AND top_flag IN (0, 1)
+    """
+
+    return Query(build, params, tables=[feature_table, perf_table], filters={'market': market})
+
+
+def reference_query(country, product, objective, top_flags=('1', 'magnitude', 'direction')):
+    """
+    Builds the query of the EMAIL best practice feature rows of a country, product and objective.
+
+    Returns:
+        Query: The query.
+    """
+    feature_table, _ = BP_TABLES['EMAIL']
+    columns = ', '.join(['top_flag'] + sl.list_sl_all)
+
+    def build(d):
+        return f"""
+        SELECT {columns}
+        FROM {d.table(feature_table)}
+        WHERE country = {d.param('country')} AND product = {d.param('product')} AND objective = {d.param('objective')} AND {d.in_array('top_flag', 'top_flags')}
+    """
+
+    params = [
+        ("country", "STRING", country),
+        ("product", "STRING", product),
+        ("objective", "STRING", objective),
+        ("top_flags", "STRING", list(top_flags)),
+    ]
+    return Query(build, params, tables=[feature_table], filters={'market': country})
+
+
+def table_query(table):
+    """
+    Builds the query of a whole table, e.g. for the best practice snapshot.
+
+    Returns:
+        Query: The query.
+    """
+    return Query(lambda d: f"SELECT * FROM {d.table(table)}", tables=[table])
+
+
+def extract_query(table, markets=None, start_date=None, end_date=None):
+    """
+    Builds the query exporting a table to a local extract (core.backend_utils.export_extracts). Fact tables are
+    limited to the campaigns of the given markets and date range, their dimension tables to the rows those
+    campaigns use; the other tables are exported whole.
+
+    Returns:
+        Query: The query.
+    """
+    params = []
+    if markets is not None:
+        params.append(("markets", "STRING", list(markets)))
+    if start_date is not None and end_date is not None:
+        params += [("start_date", "DATE", start_date), ("end_date", "DATE", end_date)]
+
+    def campaign_conditions(d):
+        conditions = []
+        if markets is not None:
+            conditions.append(d.in_array("c.Market_Area", "markets"))
+        if start_date is not None and end_date is not None:
+            conditions.append(f"c.date BETWEEN {d.param('start_date')} AND {d.param('end_date')}")
+        return " AND ".join(conditions) or "TRUE"
+
+    def build(d):
+        if table in (TABLES['campaigns'], TABLES['click_report']):
+            return f"SELECT c.* FROM {d.table(table)} c WHERE {campaign_conditions(d)}"
+        if table == TABLES['campaign_asset_push']:
+            return f"SELECT p.* FROM {d.table(table)} p WHERE p.HYBRIS_ID IN (SELECT c.HYBRIS_ID FROM {d.table(TABLES['campaigns'])} c WHERE {campaign_conditions(d)})"
+        if table == TABLES['subject_line']:
+            return f"SELECT sl.* FROM {d.table(table)} sl WHERE sl.subject_line IN (SELECT c.Email_Title FROM {d.table(TABLES['campaigns'])} c WHERE {campaign_conditions(d)})"
+        return f"SELECT * FROM {d.table(table)}"
+
+    used = params if table in (TABLES['campaigns'], TABLES['click_report'], TABLES['campaign_asset_push'], TABLES['subject_line']) else []
+    return Query(build, used, tables=[table])
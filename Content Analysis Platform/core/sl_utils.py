@@ -1,4 +1,9 @@
-from collections import Counter
+import re
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 
 
 list_sl_cutes = ['curiosity', 'urgency', 'tone', 'emotion', 'specificity']
@@ -92,4 +97,335 @@ def get_top3_recommendations(df):
     # Apply the function to create a new column 'Recommendation'
     df_top3['Recommendation'] = df_top3.apply(get_meaning, axis=1)
 
-    return df_top3['Recommendation']
\ No newline at end of file
+    return df_top3['Recommendation']
+
+
+# Recommendation groups, in display order: (features, count if outperforming, count if underperforming, only features
+# the best performing campaigns include (direction 1))
+REC_GROUPS = [
+    (list_sl_cutes, 1, 3, False),
+    (list_sl_length, 0, 1, True),
+    (list_sl_binary, 1, 3, True),
+]
+
+REC_COLUMNS = ['feature', 'campaign', 'top', 'magnitude', 'direction', 'rec', 'message']
+
+
+class RecommendationModel:
+    """
+    The reference data of one country, product and objective compiled into arrays aligned with list_sl_all, so that
+    recommendations for any number of campaigns are scored with a few matrix operations.
+
+    Parameters:
+    - df_ref: pandas DataFrame of reference rows from core.bp_utils.get_reference_data, with 'top_flag' '1', 'magnitude' and 'direction'.
+    """
+
+    def __init__(self, df_ref):
+        flags = df_ref['top_flag'].astype(str).to_numpy()
+        values = df_ref[list_sl_all].to_numpy(dtype=float, na_value=np.nan)
+
+        def flag_row(flag):
+            # The first row of a flag, a missing row gives NaN scores, so no recommendation
+            rows = np.flatnonzero(flags == flag)
+            return values[rows[0]] if len(rows) else np.full(len(list_sl_all), np.nan)
+
+        self.top = flag_row('1')
+        self.magnitude = flag_row('magnitude')
+        self.direction = flag_row('direction')
+
+        # Message of each feature in its recommended direction (None if there is none)
+        messages = {(f, d): m for f, d, m in zip(rec_mapper['feature'], rec_mapper['direction'], rec_mapper['message'])}
+        self.messages = np.array([messages.get((f, d)) for f, d in zip(list_sl_all, self.direction)], dtype=object)
+
+        # Column positions and per-row counts of each group
+        self.groups = []
+        for features, n_outperform, n_underperform, positive_only in REC_GROUPS:
+            columns = np.array([list_sl_all.index(f) for f in features])
+            eligible = self.direction[columns] == 1 if positive_only else np.ones(len(columns), dtype=bool)
+            self.groups.append((columns, eligible, n_outperform, n_underperform))
+
+    def score(self, features, outperform):
+        """
+        Scores the recommendations of many campaigns at once.
+
+        Parameters:
+        - features: (campaigns x list_sl_all) array of subject line features.
+        - outperform: bool array, per campaign, True if it beat its open rate benchmark (fewer recommendations).
+
+        Returns:
+        - tuple: (rows, columns, rec), aligned arrays giving for each recommendation the campaign's row, the feature's
+          position in list_sl_all and its score, in display order within each campaign (by group, most negative first).
+        """
+        features = np.asarray(features, dtype=float)
+        outperform = np.broadcast_to(np.asarray(outperform, dtype=bool), (len(features),))
+        rec = (features - self.top) * self.magnitude # Multiplying by magnitude of difference weighs the recommendation's 'importance'
+
+        parts = []
+        for g, (columns, eligible, n_outperform, n_underperform) in enumerate(self.groups):
+            n_max = max(n_outperform, n_underperform)
+            if n_max == 0:
+                continue
+            group_rec = rec[:, columns]
+            candidates = np.where((group_rec < 0) & eligible, group_rec, np.inf) # NaN scores are never recommended
+            order = np.argsort(candidates, axis=1, kind='stable')[:, :n_max] # stable, ties keep feature order like nsmallest
+            ranked = np.take_along_axis(candidates, order, axis=1)
+            counts = np.where(outperform, n_outperform, n_underperform)
+            keep = np.isfinite(ranked) & (np.arange(order.shape[1]) < counts[:, None])
+            rows, ranks = np.nonzero(keep)
+            parts.append((rows, np.full(len(rows), g), ranks, columns[order[rows, ranks]], ranked[rows, ranks]))
+
+        if not parts:
+            return np.array([], dtype=int), np.array([], dtype=int), np.array([], dtype=float)
+        rows, groups, ranks, columns, scores = (np.concatenate(a) for a in zip(*parts))
+        order = np.lexsort((ranks, groups, rows))
+        return rows[order], columns[order], scores[order]
+
+    def recommend(self, features, outperform):
+        """
+        Same as score, as a DataFrame with one row per recommendation and the REC_COLUMNS plus 'row', the campaign's row.
+        """
+        features = np.asarray(features, dtype=float)
+        rows, columns, rec = self.score(features, outperform)
+        return pd.DataFrame({
+            'row': rows,
+            'feature': np.array(list_sl_all, dtype=object)[columns],
+            'campaign': features[rows, columns],
+            'top': self.top[columns],
+            'magnitude': self.magnitude[columns],
+            'direction': self.direction[columns],
+            'rec': rec,
+            'message': self.messages[columns],
+        })
+
+
+def get_recommendations(df, df_ref, outperform):
+    """
+    Recommends subject line changes by comparing the average features of campaigns to those of the best
+    performing campaigns, each difference weighted by the importance (magnitude) of the feature.
+
+    Parameters:
+    - df: pandas DataFrame of campaigns, with the list_sl_all columns.
+    - df_ref: pandas DataFrame of reference rows from core.bp_utils.get_reference_data, with 'top_flag' '1', 'magnitude' and 'direction'.
+    - outperform: True if the campaigns beat their open rate benchmark, which calls for fewer recommendations.
+
+    Returns:
+    - A DataFrame with one row per recommendation, incl. 'feature', 'rec' (score, most negative first within each group) and 'message'.
+    """
+    campaign = df[list_sl_all].astype(float).mean().to_numpy()
+    return RecommendationModel(df_ref).recommend(campaign[None, :], outperform)[REC_COLUMNS]
+
+
+def score_campaigns(df, models, outperform, keys=('country', 'product', 'objective')):
+    """
+    Recommends subject line changes for each campaign of df, against the reference of its country, product and
+    objective. Campaigns are scored in one batch per reference, e.g. a whole quarter of sends at once.
+
+    Parameters:
+    - df: pandas DataFrame of campaigns, with the keys and list_sl_all columns.
+    - models: dict of {(country, product, objective): RecommendationModel}, e.g. from core.bp_utils.get_recommendation_models.
+      Campaigns without a model get no recommendation.
+    - outperform: bool array-like, per campaign, True if it beat its open rate benchmark.
+    - keys: The columns of df the models are keyed by.
+
+    Returns:
+    - A DataFrame with one row per recommendation: the df index of the campaign ('index'), its 'rank' from 1 and the REC_COLUMNS.
+    """
+    features = df[list_sl_all].to_numpy(dtype=float, na_value=np.nan)
+    outperform = np.broadcast_to(np.asarray(outperform, dtype=bool), (len(df),))
+
+    results = []
+    for key, positions in df.groupby(list(keys), sort=False).indices.items():
+        model = models.get(key)
+        if model is None:
+            continue
+        recs = model.recommend(features[positions], outperform[positions])
+        recs['row'] = positions[recs['row'].to_numpy()]
+        results.append(recs)
+
+    if not results:
+        return pd.DataFrame(columns=['index', 'rank'] + REC_COLUMNS)
+    recs = pd.concat(results, ignore_index=True).sort_values('row', kind='stable', ignore_index=True)
+    recs.insert(0, 'rank', recs.groupby('row').cumcount() + 1)
+    recs.insert(0, 'index', df.index.to_numpy()[recs.pop('row').to_numpy()])
+    return recs
+
+
+TERM_PATTERN = r"[^\W\d_]+(?:'[^\W\d_]+)?" # Words (letters only), keeping contractions like "don't" whole
+NON_TERM_PATTERN = r"[^\p{L}']+" # What separates the words, as an RE2 pattern for pyarrow.compute
+
+
+def get_stopwords():
+    # Same stopwords as the word clouds, so both views agree on which words are ignored
+    from wordcloud import STOPWORDS
+    return STOPWORDS
+
+
+def tokenize_subject_lines(subject_lines):
+    """
+    Tokenizes subject lines in bulk into lower case words, encoded as integer codes.
+
+    Parameters:
+    - subject_lines (iterable): The subject lines.
+
+    Returns:
+    - tuple: (doc_ids, word_codes, words), where doc_ids and word_codes are aligned numpy arrays giving the
+      index of the subject line and the code of each word, and words maps codes back to words.
+    """
+    lines = pc.utf8_lower(pa.array([str(line) for line in subject_lines], type=pa.string()))
+
+    # Runs of letters and apostrophes, split and encoded in Arrow rather than one Python string per word
+    chunks = pc.utf8_split_whitespace(pc.replace_substring_regex(lines, pattern=NON_TERM_PATTERN, replacement=' '))
+    doc_ids = pc.list_parent_indices(chunks).to_numpy()
+    encoded = pc.list_flatten(chunks).dictionary_encode()
+    codes = encoded.indices.to_numpy()
+    chunk_words = encoded.dictionary.to_numpy(zero_copy_only=False)
+
+    # Only the distinct runs are turned into words: '' (between separators) into none, and a run with
+    # apostrophes like "rock'n'roll" into the words TERM_PATTERN finds in it
+    words_of = [re.findall(TERM_PATTERN, chunk) if "'" in chunk else [chunk] if chunk else [] for chunk in chunk_words]
+    counts = np.array([len(w) for w in words_of], dtype=np.int64)
+    word_codes, words = pd.factorize(np.array([word for w in words_of for word in w], dtype=object))
+
+    # Expand each run into its words, in order
+    repeats = counts[codes]
+    ends = np.cumsum(repeats)
+    offsets = np.arange(ends[-1] if len(ends) else 0) - np.repeat(ends - repeats, repeats)
+    first_word = np.cumsum(counts) - counts
+    codes = word_codes[np.repeat(first_word[codes], repeats) + offsets]
+    return np.repeat(doc_ids, repeats), codes, np.asarray(words, dtype=object)
+
+
+def count_terms(doc_ids, word_codes, n_words, is_stopword, ngram_range=(1, 2)):
+    """
+    Finds the distinct terms (words and n-grams of consecutive words) of each subject line.
+    An n-gram made only of stopwords is dropped, a term used several times in a subject line is kept once.
+
+    Parameters:
+    - doc_ids, word_codes: As returned by tokenize_subject_lines.
+    - n_words (int): Number of distinct words.
+    - is_stopword (np.ndarray): Whether each word code is a stopword.
+    - ngram_range (tuple): Smallest and largest n-gram size.
+
+    Returns:
+    - list: One (n, doc_ids, term_codes) per n-gram size, where an n-gram's code is its word codes in base n_words.
+
+    Raises:
+    - ValueError: If n-gram codes of the largest size do not fit in 64 bits (n_words ** n >= 2 ** 63).
+    """
+    base = max(n_words, 1)
+    n_docs = int(doc_ids[-1]) + 1 if len(doc_ids) else 0
+    if base ** ngram_range[1] >= 2 ** 63:
+        raise ValueError(f'{ngram_range[1]}-grams of {n_words} distinct words do not fit in 64-bit term codes')
+
+    stop = is_stopword[word_codes]
+    terms = []
+    for n in range(ngram_range[0], ngram_range[1] + 1):
+        count = len(word_codes) - n + 1
+        if count <= 0:
+            break
+        # n consecutive words form an n-gram only if they come from the same subject line
+        keep = doc_ids[:count] == doc_ids[n - 1:]
+        only_stopwords = stop[:count].copy()
+        term_codes = word_codes[:count].astype(np.int64)
+        for k in range(1, n):
+            term_codes = term_codes * base + word_codes[k:k + count]
+            only_stopwords &= stop[k:k + count]
+        keep &= ~only_stopwords
+
+        # Count each term once per subject line (a sort and a diff are much faster than np.unique on large int arrays)
+        if n_docs * base ** n < 2 ** 63:
+            keys = np.sort(doc_ids[:count][keep].astype(np.int64) * base ** n + term_codes[keep])
+            keys = keys[np.r_[True, keys[1:] != keys[:-1]]]
+            terms.append((n, keys // base ** n, keys % base ** n))
+        else:
+            # (subject line, term) keys would overflow int64, deduplicate the pairs as rows instead
+            pairs = np.unique(np.column_stack([doc_ids[:count][keep].astype(np.int64), term_codes[keep]]), axis=0)
+            terms.append((n, pairs[:, 0], pairs[:, 1]))
+    return terms
+
+
+def decode_term(n, term_code, words):
+    """
+    Returns the text of an n-gram code from count_terms.
+    """
+    base = len(words)
+    parts = []
+    for _ in range(n):
+        term_code, code = divmod(int(term_code), base)
+        parts.append(words[code])
+    return ' '.join(reversed(parts))
+
+
+def get_distinctive_terms(best_subject_lines, other_subject_lines, top_n=15, min_count=3, min_z=1.96, prior_scale=1.0, ngram_range=(1, 2), stopwords=None):
+    """
+    Ranks the terms over-used in the best performing subject lines and in the other subject lines, by weighted
+    log-odds ratio with an informative Dirichlet prior (Monroe, Colaresi & Quinn, 2008). The prior is the pooled
+    term counts of both corpora, so rare terms are shrunk towards no difference and the z-score tells how
+    confident a difference is.
+
+    Parameters:
+    - best_subject_lines (iterable): Subject lines of the best performing campaigns.
+    - other_subject_lines (iterable): Subject lines of the other campaigns.
+    - top_n (int): Number of terms kept on each side.
+    - min_count (int): Minimum number of subject lines (of both corpora) using a term.
+    - min_z (float): Minimum absolute z-score, 1.96 keeps differences significant at 95%.
+    - prior_scale (float): Weight of the prior relative to the pooled counts.
+    - ngram_range (tuple): Smallest and largest n-gram size.
+    - stopwords (set): Words to ignore, defaults to get_stopwords().
+
+    Returns:
+    - DataFrame: One row per term with 'Term', 'Best Performing' and 'Other' (number of subject lines using it),
+      'Log-Odds', 'Z-Score' and 'Over-used in' ('Best Performing' or 'Other'). Terms over-used in the best
+      performing subject lines come first, the most distinctive on each side first.
+    """
+    columns = ['Term', 'Best Performing', 'Other', 'Log-Odds', 'Z-Score', 'Over-used in']
+
+    best_subject_lines = [line for line in best_subject_lines if isinstance(line, str)]
+    other_subject_lines = [line for line in other_subject_lines if isinstance(line, str)]
+    if not best_subject_lines or not other_subject_lines:
+        return pd.DataFrame(columns=columns)
+
+    # Both corpora are tokenized together, so they share word codes
+    doc_ids, word_codes, words = tokenize_subject_lines(best_subject_lines + other_subject_lines)
+    stopwords = get_stopwords() if stopwords is None else stopwords
+    is_stopword = pd.Series(words, dtype=object).isin(stopwords).to_numpy()
+
+    rows = []
+    for n, term_docs, term_codes in count_terms(doc_ids, word_codes, len(words), is_stopword, ngram_range=ngram_range):
+        # One count vector per corpus over the n-grams seen in either
+        term_ids, vocabulary = pd.factorize(term_codes)
+        is_best = term_docs < len(best_subject_lines)
+        y_best = np.bincount(term_ids[is_best], minlength=len(vocabulary))
+        y_other = np.bincount(term_ids[~is_best], minlength=len(vocabulary))
+        rows.append((np.full(len(vocabulary), n), vocabulary, y_best, y_other))
+    if not rows:
+        return pd.DataFrame(columns=columns)
+
+    n_gram, term_codes, y_best, y_other = (np.concatenate(parts) for parts in zip(*rows))
+    y_best, y_other = y_best.astype(float), y_other.astype(float)
+    n_best, n_other = y_best.sum(), y_other.sum()
+
+    alpha = prior_scale * (y_best + y_other)
+    alpha_0 = alpha.sum()
+
+    log_odds_best = np.log(y_best + alpha) - np.log(n_best + alpha_0 - y_best - alpha)
+    log_odds_other = np.log(y_other + alpha) - np.log(n_other + alpha_0 - y_other - alpha)
+    delta = log_odds_best - log_odds_other
+    z = delta / np.sqrt(1 / (y_best + alpha) + 1 / (y_other + alpha))
+
+    # Rank among the terms used often enough and confidently different, then only decode the terms shown
+    candidates = np.flatnonzero(((y_best + y_other) >= min_count) & (np.abs(z) >= min_z))
+    winners = candidates[z[candidates] > 0]
+    winners = winners[np.argsort(-z[winners], kind='stable')[:top_n]]
+    losers = candidates[z[candidates] < 0]
+    losers = losers[np.argsort(z[losers], kind='stable')[:top_n]]
+    selected = np.concatenate([winners, losers])
+
+    return pd.DataFrame({
+        'Term': [decode_term(n_gram[i], term_codes[i], words) for i in selected],
+        'Best Performing': y_best[selected].astype(int),
+        'Other': y_other[selected].astype(int),
+        'Log-Odds': delta[selected],
+        'Z-Score': z[selected],
+        'Over-used in': ['Best Performing'] * len(winners) + ['Other'] * len(losers),
+    }, columns=columns)
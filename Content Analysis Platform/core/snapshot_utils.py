@@ -0,0 +1,179 @@
+"""
+Local snapshot of the best practice tables.
+
+The best practice tables are small and change rarely, so they are exported into Arrow IPC files and memory-mapped,
+and pages filter them locally instead of querying the warehouse on every submit. The snapshot is refreshed in the
+background every SNAPSHOT_REFRESH_SECONDS, or on demand:
+
+    python -m core.snapshot_utils
+"""
+import os
+import time
+import threading
+import warnings
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+import core.cache_utils as cu
+import core.query_utils as qu
+import core.backend_utils as be
+
+
+SNAPSHOT_TABLES = [
+    'xxx.content.bp_edm_sl',
+    'xxx.content.bp_pn_sl',
+    'xxx.content.bp_edm_sl_perf',
+    'xxx.content.bp_pn_sl_perf',
+]
+
+SNAPSHOT_ENABLED = os.environ.get('CAP_SNAPSHOT', '1') != '0'
+SNAPSHOT_DIR = os.environ.get('CAP_SNAPSHOT_DIR', os.path.join(cu.CACHE_ROOT, 'snapshot'))
+SNAPSHOT_REFRESH_SECONDS = float(os.environ.get('CAP_SNAPSHOT_REFRESH_SECONDS', 6 * 60 * 60)) # 0 disables scheduled refreshes
+SNAPSHOT_VERSIONS_KEPT = 2 # Older versions may still be memory-mapped by other processes
+SNAPSHOT_RETRY_SECONDS = 5 * 60 # Wait before trying again to export a first snapshot after a failure
+
+
+class Snapshot:
+    """
+    A memory-mapped version of the snapshot tables.
+    """
+
+    def __init__(self, version_dir):
+        self.version_dir = version_dir
+        self.tables = {}
+        for table in SNAPSHOT_TABLES:
+            source = pa.memory_map(os.path.join(version_dir, f'{table}.arrow'))
+            self.tables[table] = pa.ipc.open_file(source).read_all() # zero-copy, pages are read from disk on access
+
+    def select(self, table, columns=None, **filters):
+        """
+        Returns the rows of a table matching all filters, as a DataFrame.
+
+        Args:
+            table (str): One of SNAPSHOT_TABLES.
+            columns (list): Columns to return, defaults to all.
+            **filters: column=value for equality, column=[values] for membership.
+        """
+        data = self.tables[table]
+        mask = None
+        for column, value in filters.items():
+            if isinstance(value, (list, tuple)):
+                condition = pc.is_in(data[column], value_set=pa.array(value, type=data.schema.field(column).type))
+            else:
+                condition = pc.equal(data[column], pa.scalar(value, type=data.schema.field(column).type))
+            mask = condition if mask is None else pc.and_(mask, condition)
+        if mask is not None:
+            data = data.filter(mask)
+        if columns is not None:
+            data = data.select(columns)
+        return data.to_pandas()
+
+
+def export_snapshot(snapshot_dir=SNAPSHOT_DIR):
+    """
+    Exports SNAPSHOT_TABLES into a new snapshot version and makes it the current one.
+
+    Returns:
+        str: The directory of the new version.
+    """
+    with cu.new_version(snapshot_dir, SNAPSHOT_VERSIONS_KEPT) as version_dir:
+        for table in SNAPSHOT_TABLES:
+            df = be.run_query(qu.table_query(table), use_cache=False, label=f'snapshot: {table}')
+            arrow_table = pa.Table.from_pandas(df, preserve_index=False)
+            with pa.OSFile(os.path.join(version_dir, f'{table}.arrow'), 'wb') as sink:
+                with pa.ipc.new_file(sink, arrow_table.schema) as writer: # uncompressed, so it can be memory-mapped as is
+                    writer.write_table(arrow_table)
+    return version_dir
+
+
+_snapshot = None
+_snapshot_lock = threading.Lock()
+_refresher = None
+_last_failure = None
+_exporting = False
+
+
+def get_snapshot():
+    """
+    Returns the current snapshot, loading it on first use (exporting one if none exists yet),
+    and picking up versions exported since by the scheduled refresh or by another process.
+
+    While a first snapshot is being exported, or for SNAPSHOT_RETRY_SECONDS after a failed export, other callers
+    get None and query the warehouse instead of waiting.
+
+    Returns:
+        Snapshot: The current snapshot, or None if snapshots are disabled or none is available yet.
+    """
+    global _snapshot, _last_failure, _exporting
+    if not SNAPSHOT_ENABLED:
+        return None
+
+    with _snapshot_lock:
+        version_dir = cu.read_current_version(SNAPSHOT_DIR)
+        if version_dir is not None:
+            _start_refresher()
+            if _snapshot is None or _snapshot.version_dir != version_dir:
+                _snapshot = Snapshot(version_dir)
+            return _snapshot
+        if _exporting or (_last_failure is not None and time.monotonic() - _last_failure < SNAPSHOT_RETRY_SECONDS):
+            return None
+        _exporting = True
+
+    # First export, outside of the lock: it reads the full tables
+    try:
+        version_dir = export_snapshot()
+    except Exception as e:
+        with _snapshot_lock:
+            _exporting = False
+            _last_failure = time.monotonic()
+        warnings.warn(f'Best practice snapshot unavailable, querying the warehouse instead: {e}')
+        return None
+
+    with _snapshot_lock:
+        _exporting = False
+        _last_failure = None
+        _start_refresher() # only once there is a snapshot to refresh
+        _snapshot = Snapshot(version_dir)
+        return _snapshot
+
+
+def refresh_snapshot():
+    """
+    Exports a new snapshot version now and loads it.
+    """
+    global _snapshot, _last_failure
+    version_dir = export_snapshot()
+    with _snapshot_lock:
+        _last_failure = None
+        _snapshot = Snapshot(version_dir)
+    return _snapshot
+
+
+def _refresh_loop():
+    global _last_failure
+    while True:
+        time.sleep(min(SNAPSHOT_REFRESH_SECONDS, 60))
+        version_dir = cu.read_current_version(SNAPSHOT_DIR)
+        if version_dir is not None and time.time() - os.path.getmtime(version_dir) < SNAPSHOT_REFRESH_SECONDS:
+            continue
+        with _snapshot_lock:
+            if _last_failure is not None and time.monotonic() - _last_failure < SNAPSHOT_RETRY_SECONDS:
+                continue
+        try:
+            refresh_snapshot()
+        except Exception as e:
+            with _snapshot_lock:
+                _last_failure = time.monotonic()
+            warnings.warn(f'Best practice snapshot refresh failed, keeping the current version: {e}')
+
+
+def _start_refresher():
+    global _refresher
+    if _refresher is None and SNAPSHOT_REFRESH_SECONDS > 0:
+        _refresher = threading.Thread(target=_refresh_loop, name='snapshot-refresh', daemon=True)
+        _refresher.start()
+
+
+if __name__ == '__main__':
+    print(f'Snapshot exported to {export_snapshot()}')
@@ -0,0 +1,287 @@
+"""
+Timing spans for the hot paths of the pages: BigQuery, GCS, image decode, click bar rendering, charts and word clouds.
+
+Spans nest through contextvars, so a span opened in a page is the parent of the spans opened by the functions it
+calls, incl. on worker threads when the work is submitted through bind(). Every span carries the trace ID of the
+Streamlit session and the ID of the script run it belongs to.
+
+Finished spans are written as JSONL (CAP_TRACE_FILE) and aggregated into one latency histogram per stage, exported
+in the Prometheus text format (CAP_TRACE_PROMETHEUS_FILE, e.g. for the node_exporter textfile collector).
+An exporter that fails to write (e.g. its directory is missing) warns once and is disabled, the traced code carries on.
+
+Tracing is off unless CAP_TRACE=1. When off, traced() returns the function itself and span() a shared no-op,
+so instrumented code runs as if it was not.
+
+Example:
+    @tr.traced('decode')
+    def make_display_image(content): ...
+
+    with tr.span('bigquery', label='get_campaign_data: campaigns'):
+        df = download_result(job)
+"""
+import os
+import json
+import time
+import uuid
+import atexit
+import tempfile
+import warnings
+import threading
+import functools
+import contextvars
+
+
+TRACE_ENABLED = os.environ.get('CAP_TRACE', '0') != '0'
+TRACE_FILE = os.environ.get('CAP_TRACE_FILE', '') # JSONL file finished spans are appended to, '' keeps histograms only
+TRACE_PROMETHEUS_FILE = os.environ.get('CAP_TRACE_PROMETHEUS_FILE', '') # Histograms in the Prometheus text format, rewritten periodically
+TRACE_PROMETHEUS_INTERVAL = 15 # Seconds between rewrites of the Prometheus file
+
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60) # Seconds, upper bounds
+
+_trace = contextvars.ContextVar('cap_trace', default=None) # {'trace_id', 'run_id', 'page'} of the current script run
+_current_span = contextvars.ContextVar('cap_span', default=None)
+
+_lock = threading.Lock()
+_trace_file = None
+_trace_file_failed = False
+_prometheus_failed = False
+_histograms = {} # {stage: [bucket counts (cumulative at export), sum, count]}
+_prometheus_written_at = 0.0
+
+
+class Span:
+    """
+    A timed stage. Use span() rather than creating it directly.
+    """
+    __slots__ = ('name', 'attrs', 'span_id', 'parent_id', '_start', '_wall_start', '_token')
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = None
+
+    def set(self, **attrs):
+        """
+        Adds attributes known only once the stage is under way, e.g. whether it was served from a cache.
+        """
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        parent = _current_span.get()
+        self.parent_id = parent.span_id if parent is not None else None
+        self._token = _current_span.set(self)
+        self._wall_start = time.time()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self._start
+        _current_span.reset(self._token)
+        _emit(self.name, self._wall_start, seconds, self.span_id, self.parent_id, self.attrs, exc_type)
+        return False
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def span(name, **attrs):
+    """
+    Returns a context manager timing the enclosed block as a stage, nested under the current span.
+
+    Args:
+        name (str): Stage name, the histogram the duration is counted in, e.g. 'gcs' or 'decode'.
+        **attrs: JSON-serializable attributes written with the span, e.g. label='get_reference_data'.
+    """
+    if not TRACE_ENABLED:
+        return _NOOP_SPAN
+    return Span(name, attrs)
+
+
+def traced(name, **attrs):
+    """
+    Decorator timing every call of a function as a span. Returns the function unchanged if tracing is off.
+    """
+    def decorator(fn):
+        if not TRACE_ENABLED:
+            return fn
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with Span(name, dict(attrs)):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def bind(fn):
+    """
+    Returns fn bound to a copy of the current context, so that spans it opens on another thread (e.g. when
+    submitted to a pool or used as a future callback) nest under the current span. Call once per submission,
+    as a context cannot be entered by two threads at once. Returns fn itself if tracing is off.
+    """
+    if not TRACE_ENABLED:
+        return fn
+    return functools.partial(contextvars.copy_context().run, fn)
+
+
+def record(name, seconds, **attrs):
+    """
+    Records a stage timed elsewhere (e.g. in a worker process) as a span ending now, under the current span.
+    """
+    if not TRACE_ENABLED:
+        return
+    parent = _current_span.get()
+    _emit(name, time.time() - seconds, seconds, uuid.uuid4().hex[:16], parent.span_id if parent is not None else None, attrs, None)
+
+
+def session_trace_id():
+    """
+    Returns the ID of the current Streamlit session, or a new random ID outside of a script run.
+    """
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+        ctx = get_script_run_ctx(suppress_warning=True)
+    except Exception:
+        ctx = None
+    return ctx.session_id if ctx is not None else uuid.uuid4().hex
+
+
+def start_trace(page, trace_id=None):
+    """
+    Starts the trace of a script run: the spans that follow carry trace_id (the session ID by default),
+    a new run ID and the page name. Call at the top of each page.
+
+    Returns:
+        str: The trace ID, or None if tracing is off.
+    """
+    if not TRACE_ENABLED:
+        return None
+    if trace_id is None:
+        trace_id = session_trace_id()
+    _trace.set({'trace_id': trace_id, 'run_id': uuid.uuid4().hex[:16], 'page': page})
+    _current_span.set(None)
+    return trace_id
+
+
+def _emit(name, wall_start, seconds, span_id, parent_id, attrs, exc_type):
+    global _trace_file, _trace_file_failed
+    trace = _trace.get() or {}
+    record = {
+        'trace_id': trace.get('trace_id'),
+        'run_id': trace.get('run_id'),
+        'page': trace.get('page'),
+        'span_id': span_id,
+        'parent_id': parent_id,
+        'name': name,
+        'start': wall_start,
+        'seconds': seconds,
+        'thread': threading.current_thread().name,
+        'error': exc_type.__name__ if exc_type is not None else None,
+        'attrs': attrs,
+    }
+    line = json.dumps(record, default=str) + '\n' if TRACE_FILE and not _trace_file_failed else None
+
+    with _lock:
+        _observe(name, seconds)
+        if line is not None and not _trace_file_failed:
+            try:
+                if _trace_file is None:
+                    _trace_file = open(TRACE_FILE, 'a', buffering=1) # line buffered, each span is flushed as written
+                _trace_file.write(line)
+            except OSError as e:
+                _trace_file_failed = True
+                warnings.warn(f'Spans not written to {TRACE_FILE}, trace file export disabled: {e}')
+
+    if TRACE_PROMETHEUS_FILE and not _prometheus_failed and time.monotonic() - _prometheus_written_at > TRACE_PROMETHEUS_INTERVAL:
+        write_prometheus()
+
+
+def _observe(name, seconds):
+    histogram = _histograms.get(name)
+    if histogram is None:
+        histogram = _histograms[name] = [[0] * len(HISTOGRAM_BUCKETS), 0.0, 0]
+    for i, bound in enumerate(HISTOGRAM_BUCKETS):
+        if seconds <= bound:
+            histogram[0][i] += 1
+            break
+    histogram[1] += seconds
+    histogram[2] += 1
+
+
+def get_histograms():
+    """
+    Returns the stage histograms of this process: {stage: {'buckets': {upper bound: cumulative count}, 'sum': seconds, 'count': spans}}.
+    """
+    with _lock:
+        snapshot = {name: (list(counts), total, count) for name, (counts, total, count) in _histograms.items()}
+
+    histograms = {}
+    for name, (counts, total, count) in snapshot.items():
+        cumulative, buckets = 0, {}
+        for bound, n in zip(HISTOGRAM_BUCKETS, counts):
+            cumulative += n
+            buckets[bound] = cumulative
+        buckets[float('inf')] = count
+        histograms[name] = {'buckets': buckets, 'sum': total, 'count': count}
+    return histograms
+
+
+def prometheus_text():
+    """
+    Returns the stage histograms in the Prometheus text exposition format, as cap_stage_seconds{stage=...}.
+    """
+    lines = [
+        '# HELP cap_stage_seconds Time spent per stage of the pages.',
+        '# TYPE cap_stage_seconds histogram',
+    ]
+    for name, histogram in sorted(get_histograms().items()):
+        for bound, count in histogram['buckets'].items():
+            le = '+Inf' if bound == float('inf') else repr(float(bound))
+            lines.append(f'cap_stage_seconds_bucket{{stage="{name}",le="{le}"}} {count}')
+        lines.append(f'cap_stage_seconds_sum{{stage="{name}"}} {histogram["sum"]}')
+        lines.append(f'cap_stage_seconds_count{{stage="{name}"}} {histogram["count"]}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(path=None):
+    """
+    Writes the stage histograms to path (TRACE_PROMETHEUS_FILE by default) atomically, so a collector never reads a partial file.
+    A failed write warns, and disables the periodic export if it was to TRACE_PROMETHEUS_FILE.
+    """
+    global _prometheus_written_at, _prometheus_failed
+    exporter = path is None
+    path = path or TRACE_PROMETHEUS_FILE
+    if not path or (exporter and _prometheus_failed):
+        return
+    _prometheus_written_at = time.monotonic()
+
+    tmp = None
+    try:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(prometheus_text())
+        os.replace(tmp, path)
+    except OSError as e:
+        if tmp is not None and os.path.exists(tmp):
+            os.remove(tmp)
+        if exporter:
+            _prometheus_failed = True
+        warnings.warn(f'Stage histograms not written to {path}: {e}')
+
+
+if TRACE_ENABLED and TRACE_PROMETHEUS_FILE:
+    atexit.register(write_prometheus) # keep the spans of the last interval, skipped if the export failed before
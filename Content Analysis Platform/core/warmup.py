@@ -0,0 +1,31 @@
+"""
+Builds ahead of time what the app would otherwise build on the first request after a cold start.
+Run once at image build time: python -m core.warmup
+"""
+import time
+
+
+def build_font_caches():
+    # matplotlib scans the system fonts into MPLCONFIGDIR/fontlist-*.json the first time it looks a font up
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib import font_manager
+    font_manager.findfont('DejaVu Sans')
+
+    # WordCloud and the click bar renderer open their TrueType fonts on first use
+    from wordcloud import WordCloud
+    WordCloud(width=64, height=64).generate_from_frequencies({'cap': 1})
+
+    import core.img_utils as im
+    im._get_font(im.CLICK_BAR_VALUE_FONT_SIZE)
+    im._get_font(im.CLICK_BAR_LABEL_FONT_SIZE)
+
+
+def main():
+    t0 = time.perf_counter()
+    build_font_caches()
+    print(f'Font caches built in {time.perf_counter() - t0:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
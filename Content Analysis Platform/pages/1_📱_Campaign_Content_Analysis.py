@@ -1,23 +1,23 @@
 import streamlit as st
 
-import pandas as pd
 import numpy as np
 
-from google.cloud import storage
-from google.cloud import bigquery
-from google.oauth2 import service_account
-
 import core.img_utils as im
 import core.cp_utils as cp
+import core.bq_utils as bq
+import core.bp_utils as bp
+import core.query_utils as qu
+import core.backend_utils as be
+import core.dim_utils as dm
+import core.client_utils as cl
 import core.sl_utils as sl
 import core.chart_utils as ch
+import core.trace_utils as tr
 
 
 st.set_page_config(layout='wide', page_title='CAP - Content Analysis')
+tr.start_trace('Campaign Content Analysis') # timing spans of this run carry the session's trace ID (refer to core.trace_utils.py)
 
-credentials = service_account.Credentials.from_service_account_file('xxx.json') # Uses service account JSON file that contains our credentials
-bq_client = bigquery.Client(project='xxx', credentials=credentials)
-storage_client = storage.Client(project='xxx', credentials=credentials)
 edm_bucket = 'creative-edm'
 
 # Page Setup: Initializes app sidebar (left) appearance and settings
@@ -31,20 +31,25 @@ with st.sidebar:
     submit_campaign_id = form_campaign_id.form_submit_button(label='Analyze')
 
 
-def get_campaign_data(campaign_id):
+def get_campaign_data(campaign_id, objective):
     """
     Fetches and processes campaign and click-level data for a given set of campaign IDs.
 
+    The campaign and click report queries run concurrently. The reference data and creative of the first campaign
+    are fetched as soon as the campaign query returns, while the click report query is still running.
+
     Args:
         campaign_id (str or list): A single campaign ID or list of IDs to query.
+        objective (str): Campaign objective, to fetch the reference data of the first campaign.
 
     Returns:
         tuple: A tuple containing:
             - df (pd.DataFrame): Processed campaign-level DataFrame.
             - df_click (pd.DataFrame): Processed click-level DataFrame.
             - first_campaign (str): The first campaign ID in the result.
-            - first_campaign_data (dict): Data dictionary for the first campaign.
+            - first_campaign_data (cp.CampaignRecord): Data of the first campaign, incl. its pods.
             - not_found (list): List of campaign IDs that were not found in the query results.
+            - jobs (bq.JobScheduler): Data jobs, incl. 'first_campaign', 'reference' and 'creative' for the first campaign of the campaign query.
 
     Raises:
         ValueError: If both resulting DataFrames are empty.
@@ -52,104 +57,81 @@ def get_campaign_data(campaign_id):
     # Helper module to process 'campaign_id' input to be formatted (refer to core.cp_utils.py). Returns a list of campaign_ids
     campaign_list = cp.parse_campaign_id(campaign_id)
 
-    # Injects list of campaign_ids into query as a parameter
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ArrayQueryParameter("campaign_list", "STRING", campaign_list) # Parameters: ("Placeholder name of SQL query", "Data type of array", Value i.e. list of campaign_ids)
-        ]
+    # Campaign and click report queries, projecting only the columns used below (refer to core.query_utils.py)
+    query_campaign = qu.campaign_query(
+        'EMAIL',
+        ['campaign_id', 'product', 'country', 'date', 'campaign_name', 'delivered', 'opened', 'clicked', 'bm_segment', 'subject_line'] + sl.list_sl_all,
+        campaign_ids=campaign_list,
+    )
+    query_click_report = qu.click_report_query(
+        ['height', 'click_rate', 'pod_ctr', 'label_name', 'url', 'position', 'height_bin'],
+        campaign_ids=campaign_list,
     )
-
-    # Define campaign query
-    QUERY_EDM = f"""
-        SELECT
-            c.HYBRIS_ID, c.Division, c.Market_Area, c.date, c.Campaign,
-            c.Delivery_Success, c.Opened_Displayed, c.Clicked,
-            b.open_rate AS Benchmark_OR, b.ctr AS Benchmark_CTR,
-            sl.*
-        FROM `xxx.gcdm.campaigns` c
-            JOIN `xxx.content.subject_line` sl ON c.Email_Title = sl.subject_line
-            LEFT JOIN `xxx.gcdm.benchmark` b ON c.Market_Area = b.Market_Area AND SUBSTR(c.Campaign, 26, 5) = b.Segment AND c.Channel = b.Channel
-        WHERE c.HYBRIS_ID IN UNNEST(@campaign_list) AND c.Channel = 'EMAIL'
-
-    """
-
-    # Define click report query for each campaign
-    QUERY_CLICK_REPORT = """
-        SELECT
-            HYBRIS_ID, Pod_adj, max(Height_pct), sum(c.Click_Rate), sum(CTR), any_value(Label_Name), any_value(Url), any_value(Pod_Position), any_value(c.Height_pct_bin), max(bm.click_rate)
-        FROM
-            `xxx.gcdm.click_report` c
-            LEFT JOIN `xxx.content.bm_click_rate` bm ON c.Pod_Position = bm.position AND c.Height_pct_bin = bm.height_pct_bin
-        WHERE
-            HYBRIS_ID IN UNNEST(@campaign_list)
-        GROUP BY 1,2
-        ORDER BY 1,2
-
-    """
-
-    query_campaign = QUERY_EDM
-    query_click_report = QUERY_CLICK_REPORT
 
     # Execute and save results of campaign query as dataframe
-    df = bq_client.query(query_campaign, job_config=job_config).to_dataframe()
-    df.columns = ['campaign_id', 'product', 'country', 'date', 'campaign_name', 'delivered', 'opened', 'clicked', 'bm_open_rate', 'bm_ctr', 'subject_line'] + sl.list_sl_all # Rename columns + append list of other sl features as columns
-    df['country'] = df['country'].str.lower() 
-    df['product'] = np.where(df['product'].isin(['VD', 'DA', 'DA, VD']), 'CE', 'MX') # Recategorize product types to just CE and MX
+    def query_campaigns():
+        df = be.run_query(query_campaign, label='get_campaign_data: campaigns')
+        df = dm.attach_benchmarks(df, channel='EMAIL') # Open rate and CTR benchmarks from the in-process index (refer to core.dim_utils.py)
+        df['country'] = df['country'].str.lower() 
+        df['product'] = np.where(df['product'].isin(['VD', 'DA', 'DA, VD']), 'CE', 'MX') # Recategorize product types to just CE and MX
+        return df
+
+    # Execute click report query, with the click rate benchmark of each pod
+    def query_click_report_pods():
+        df_click = be.run_query(query_click_report, label='get_campaign_data: click report')
+        return dm.attach_pod_benchmarks(df_click)
+
+    # Declare data jobs: only the reference data and creative depend on the campaign query
+    jobs = bq.JobScheduler()
+    jobs.add('campaign', query_campaigns)
+    jobs.add('click', query_click_report_pods)
+    jobs.add('first_campaign', get_first_campaign, depends_on=['campaign'])
+    jobs.add('reference', get_first_campaign_reference, objective, depends_on=['first_campaign'])
+    jobs.add('creative', get_first_campaign_img, depends_on=['first_campaign'])
+
+    df = jobs.result('campaign')
 
     # Execute and save results of click report query as dataframe
-    df_click = bq_client.query(query_click_report, job_config=job_config).to_dataframe()
+    df_click = jobs.result('click')
     if df_click.empty:
         return False
-    df_click.columns = ['campaign_id', 'pod', 'height', 'click_rate', 'pod_ctr', 'label_name', 'url', 'position', 'height_bin', 'bm_click_rate'] # Rename columns
-    df_click['pod_count'] = df_click.groupby('campaign_id')['pod'].transform('count') # Add column for no. of pods per campaign
-    gb = df_click.groupby(['campaign_id', 'pod_count'])[['click_rate', 'pod_ctr', 'height', 'label_name']].agg(lambda x: list(x)).reset_index() # Aggregating values for each campaign
-
-    gb['label_name'] = gb['label_name'].apply(im.truncate_labels)  #truncate the label_name 
+    pods = cp.PodStore.from_click_report(df_click) # Pods of each campaign in flat arrays, labels truncated (refer to core.cp_utils.py)
 
-    df = df.merge(gb, on='campaign_id', how='inner') # Merge with campaign dataframe
+    df = df[df['campaign_id'].isin(pods.campaign_ids)].reset_index(drop=True) # Keep campaigns with a click report
     if df.empty:
         return False
 
-    data_dict = df.set_index('campaign_id').to_dict('index') #format: {'0000111111':{'country':'sg', 'curiosity':0.4, 'pod_count':3, 'click_rate':[0.3, 0.2, 0.4], ...}}
+    data_dict = cp.CampaignCollection(df, pods=pods) # dict-like, read as {'0000111111':{'country':'sg', 'curiosity':0.4, 'pod_count':3, 'click_rate':[0.3, 0.2, 0.4], ...}} without materializing it
 
     first_campaign = next(iter(data_dict)) # Retrieve the first key from data_dict
     first_campaign_data = data_dict[first_campaign]
 
     not_found = [c for c in campaign_list if c not in df['campaign_id'].to_list()]
 
-    return df, df_click, first_campaign, first_campaign_data, not_found
-
-
-def get_reference_data(country, product, objective):
-    """
-    Fetch reference data from the `bp_edm_sl` table based on the specified country, product, and objective.
+    return df, df_click, first_campaign, first_campaign_data, not_found, jobs
 
-    Args:
-        country (str): The country to filter the reference data.
-        product (str): The product to filter the reference data.
-        objective (str): The objective to filter the reference data.
 
-    Returns:
-        A DataFrame containing CUTES scores and other binary/categorical variabls.
-    """
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter("country", "STRING", country),
-            bigquery.ScalarQueryParameter("product", "STRING", product),
-            bigquery.ScalarQueryParameter("objective", "STRING", objective)
-        ]
-    )
+def get_first_campaign(df):
+    # First campaign of the campaign query, as (campaign_id, data) or None
+    if df.empty:
+        return None
+    row = df.iloc[0]
+    return row['campaign_id'], {'country': row['country'], 'product': row['product']}
 
-    QUERY = """
-        SELECT b.* EXCEPT (country, product, objective)
-        FROM `xxx.content.bp_edm_sl` b
-        WHERE country = @country AND product = @product AND objective = @objective AND top_flag IN ('1', 'magnitude', 'direction')
 
-    """
+def get_first_campaign_reference(first_campaign, objective):
+    if first_campaign is None:
+        return None
+    _, data = first_campaign
+    return bp.get_reference_data(country=data['country'].upper(), product=data['product'], objective=objective)
 
-    df = bq_client.query(QUERY, job_config=job_config).to_dataframe()    
 
-    return df
+def get_first_campaign_img(first_campaign):
+    # Fetch campaign image using first campaign's ID and data from storage bucket
+    if first_campaign is None:
+        return {}, {}
+    cid, data = first_campaign
+    return im.get_img_from_dict({cid:data}, storage_client=cl.get_storage_client(), bucket_name=edm_bucket)
 
 
 def display(df, first_campaign_img, first_campaign_data, df_ref, df_click):
@@ -159,7 +141,7 @@ def display(df, first_campaign_img, first_campaign_data, df_ref, df_click):
     Args:
         df: DataFrame containing campaign data.
         first_campaign_img (str): URL of the image for the first campaign.
-        first_campaign_data (dict): Dictionary containing data for the first campaign, including its subject line and date.
+        first_campaign_data (cp.CampaignRecord): Data for the first campaign, including its subject line, date and pods.
         df_ref (pandas.DataFrame): DataFrame containing reference data for benchmarking best practices.
         df_click (pandas.DataFrame): DataFrame containing click data for pods in the campaign.
 
@@ -228,30 +210,7 @@ def display(df, first_campaign_img, first_campaign_data, df_ref, df_click):
     # Start of recommendation part
     cols_sl[1].markdown(":green[**Recommendation (based on Best Practices)**]")
 
-    df_ref = df_ref.set_index('top_flag').transpose()
-    comb = pd.concat([df[sl.list_sl_all].mean(), df_ref], axis=1) # Combined dataframe of campaign and dataframe of reference_data
-    comb = comb.rename(columns={0:'campaign', '1':'top'}) # Rename columns
-    comb['rec'] = (comb['campaign'] - comb['top']) * comb['magnitude'] # Calculate recommendation score, multiplying by magnitude of difference weighs the recommendation's 'importance'
-
-    cutes = comb.loc['curiosity':'specificity', :]
-    length = comb.loc['length_long':'length_short', :]
-    binary = comb.loc['emoji':'ai', :]
-
-    mapper = pd.DataFrame(sl.rec_mapper)
-    if open_rate >= bm_open_rate:
-    # If outperform benchmark, only 1 recommendation from CUTES and another from binary variables
-        cutes = cutes[(cutes['rec'] < 0)].nsmallest(1, 'rec')
-        length = length[(length['rec'] < 0) & (length['direction'] == 1)].nsmallest(0, 'rec')
-        binary = binary[(binary['rec'] < 0) & (binary['direction'] == 1)].nsmallest(1, 'rec')
-    else:
-    # If underperform benchmark, 3 recommendations from CUTES, 1 from length, and 3 from binary variables
-        cutes = cutes[(cutes['rec'] < 0)].nsmallest(3, 'rec')
-        length = length[(length['rec'] < 0) & (length['direction'] == 1)].nsmallest(1, 'rec')
-        binary = binary[(binary['rec'] < 0) & (binary['direction'] == 1)].nsmallest(3, 'rec')
-
-    recs = pd.concat([cutes, length, binary])
-    recs = recs.reset_index(names=['feature'])
-    recs = recs.merge(mapper, on=['feature', 'direction'], how='left')
+    recs = sl.get_recommendations(df, df_ref, outperform=open_rate >= bm_open_rate) # refer to core.sl_utils.py
 
     for i, m in enumerate(recs['message'].to_list()):
         cols_sl[1].markdown(f"{i+1}. {m}")
@@ -304,26 +263,32 @@ def display(df, first_campaign_img, first_campaign_data, df_ref, df_click):
 
 def main():
     if submit_campaign_id:
-        data_tuple = get_campaign_data(campaign_id=campaign_id) #return a tuple of (df, first campaign ID, first campaign data, not_found)
+        data_tuple = get_campaign_data(campaign_id=campaign_id, objective=campaign_obj) #return a tuple of (df, df_click, first campaign ID, first campaign data, not_found, jobs)
         if data_tuple:
-            df, df_click, first_cp_id, first_cp_data, not_found = data_tuple[0], data_tuple[1], data_tuple[2], data_tuple[3], data_tuple[4]
+            df, df_click, first_cp_id, first_cp_data, not_found, jobs = data_tuple[0], data_tuple[1], data_tuple[2], data_tuple[3], data_tuple[4], data_tuple[5]
 
             if df.shape[0] > 1: # If more than 1 campaign is found, deal with each scenario
                 st.write("You searched for multiple campaigns. Only 1st campaign's creatives will be displayed. Analysis will still be performed for all campaigns.")
                 if not_found:
                     st.write(f"These campaign IDs cannot be found {', '.join(not_found)}")
 
-            country = first_cp_data['country'].upper()
-            product = first_cp_data['product']
             # product = cp.get_product_from_model(first_cp_data['model'])
-            df_ref = get_reference_data(country=country, product=product, objective=campaign_obj)
+            if jobs.result('first_campaign')[0] == first_cp_id:
+                # Fetched concurrently with the click report query
+                df_ref = jobs.result('reference')
+                img_dict, missing = jobs.result('creative') #get img using 1st camp data
+            else:
+                # The first campaign of the campaign query has no click report, fetch for the first campaign left
+                first_campaign = (first_cp_id, first_cp_data)
+                df_ref = get_first_campaign_reference(first_campaign, objective=campaign_obj)
+                img_dict, missing = get_first_campaign_img(first_campaign)
 
-            # Fetch campaign images using first campaign's ID and data from storage bucket
-            img_dict = im.get_img_from_dict({first_cp_id:first_cp_data}, storage_client=storage_client, bucket_name=edm_bucket) #get img using 1st camp data
             if img_dict:
                 display(df=df, df_click=df_click, first_campaign_img=img_dict[first_cp_id], first_campaign_data=first_cp_data, df_ref=df_ref)
-            else:
+            elif missing.get(first_cp_id) == 'not found':
                 st.write('The creatives for searched campaigns have not been updated yet!')
+            else:
+                st.write(f'Error fetching the creative of {first_cp_id}: {missing[first_cp_id]}')
         else:
             st.write('The search did not return any campaign!')
 
@@ -1,27 +1,26 @@
 import streamlit as st
 
-import pandas as pd
-import numpy as np
-
 from datetime import datetime
 import datetime
-
-from google.cloud import storage
-from google.cloud import bigquery
-from google.oauth2 import service_account
+from concurrent.futures import as_completed
 
 import core.img_utils as im
 import core.cp_utils as cp
+import core.bq_utils as bq
+import core.client_utils as cl
+import core.query_utils as qu
+import core.backend_utils as be
+import core.trace_utils as tr
 
 
 st.set_page_config(layout='wide', page_title='CAP - Content Analysis Platform')
+tr.start_trace('Content Comparison') # timing spans of this run carry the session's trace ID (refer to core.trace_utils.py)
 
-credentials = service_account.Credentials.from_service_account_file('xxx.json')
-storage_client = storage.Client(project='xxx', credentials=credentials)
-bq_client = bigquery.Client(project='xxx', credentials=credentials)
 edm_bucket = 'creative-edm'
 pn_bucket = 'creative-push'
 
+CAMPAIGNS_PER_PAGE = 6 # Campaigns displayed at once, the page width and load time do not grow with the search
+
 
 with st.sidebar:
     st.header("SEAO Content Analytics")
@@ -60,147 +59,47 @@ with st.sidebar:
 
 
 def get_campaign_data(channel, click_rate_display, sorting, campaign_id=None, market=None, date=None):
+    # Campaigns are selected either by ID or by market and date range
     if campaign_id is not None:
-        campaign_list = cp.parse_campaign_id(campaign_id)
-        job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ArrayQueryParameter("campaign_list", "STRING", campaign_list),
-            bigquery.ScalarQueryParameter("market", "STRING", market)
-            # bigquery.ScalarQueryParameter("start_date", "DATE", start_date_selected),
-            # bigquery.ScalarQueryParameter("end_date", "DATE", end_date_selected),
-        ]
-    )
-        
-    else:
-        campaign_list = []
-        start_date_selected = date[0]
-        end_date_selected = date[1]
-        job_config = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ArrayQueryParameter("campaign_list", "STRING", campaign_list),
-                bigquery.ScalarQueryParameter("market", "STRING", market),
-                bigquery.ScalarQueryParameter("start_date", "DATE", start_date_selected),
-                bigquery.ScalarQueryParameter("end_date", "DATE", end_date_selected),
-            ]
-        )
-
-    # # Mapping the selected filter option to SQL    
-    # where_clause = ""
-    # if campaign_id is not None:
-    #     where_clause = f"WHERE c.HYBRIS_ID IN UNNEST(@campaign_list) "
-    # else:
-    #     # where_clause = f"WHERE c.Market_Area = @market AND c.date = @date"
-    #     where_clause = f"WHERE c.country = @market AND c.date BETWEEN @start_date AND @end_date"
-
-
-    where_clause = ""
-    if campaign_id is not None:
-        where_clause = f"WHERE c.HYBRIS_ID IN UNNEST(@campaign_list) "
+        filters = {'campaign_ids': cp.parse_campaign_id(campaign_id)}
     else:
-        where_clause = f"WHERE c.Market_Area = @market AND c.date = @date"
-
-    # Mapping the selected sorting option to SQL
-    order_by_clause = "ORDER BY "
-    if sorting == 'Campaign ID':
-        order_by_clause += "c.HYBRIS_ID"
-    elif sorting == 'Market':
-        order_by_clause += "Market_Area"
-    elif sorting == 'Sent':
-        order_by_clause += "Delivery_Success DESC"
-    elif sorting == 'OR':
-        order_by_clause += "Opened_Displayed/Delivery_Success DESC"
-    elif sorting == 'CTR':
-        order_by_clause += "Clicked/Opened_Displayed DESC"
-    elif sorting == 'Segment':
-        order_by_clause += "Segment"
-    elif sorting == 'Campaign Date':
-        order_by_clause += "date"
-
-
-    # Mapping the selected filter option to SQL
-    select_clause = ""
+        filters = {'market': market, 'start_date': date[0], 'end_date': date[-1]}
+
+    # Columns displayed for each channel
     if channel == 'EMAIL':
-        select_clause = "c.Email_Title"
+        content_columns = ['subject_line']
     else:
-        select_clause = "p.ticker, p.text"
-
-
-    QUERY = f"""
-        SELECT
-            c.Market_Area, c.HYBRIS_ID, {select_clause}, c.date, c.Campaign, c.Segment,
-            c.Delivery_Success, c.Opened_Displayed, c.Clicked
-        FROM `xxx.gcdm.campaigns` c
-        LEFT JOIN `xxx.gcdm.campaign_asset_push` p
-        ON c.HYBRIS_ID = p.HYBRIS_ID
-        {where_clause} AND c.Channel = '{channel}'
-        {order_by_clause}
-    """
-
-    # QUERY_EDM = f"""
-    #     SELECT
-    #         country, HYBRIS_ID, Email_Title, date, Campaign_Name, Segment_Benchmark,
-    #         Targeted_Sent, Opened_Displayed, Clicked
-    #     FROM `xxx.DASHBOARD_FLAGSHIP.PARADIGM_CAMPAIGN_PERFORMANCE_EDM` c
-    #     {where_clause} AND is_latest_rank = 1
-    #     {order_by_clause}
-    # """
-
-    # QUERY_PN = f"""
-    #     SELECT
-    #         country, c.HYBRIS_ID, ticker, text, date, Campaign_Name, Segment,
-    #         SMP_Sent, SMP_Displayed, SMP_Clicked
-    #     FROM `xxx.DASHBOARD_FLAGSHIP.PARADIGM_CAMPAIGN_PERFORMANCE_PUSH` c
-    #     JOIN `xxx.gcdm.campaign_asset_push` p 
-    #     ON c.HYBRIS_ID = p.HYBRIS_ID
-    #     {where_clause} AND is_latest_rank = 1
-    #     {order_by_clause}
-
-    # """
-
-    # QUERY_CLICK_REPORT = f"""
-    #     SELECT cr.HYBRIS_ID, Pod_adj, max(Height_pct), sum(Click_Rate), sum(CTR), sum(CTR_With_Unsubscribe), coalesce(sum(CR_Excl_Footer), 0), sum(CR_With_Unsubscribe), any_value(Label_Name)
-    #     FROM `xxx.gcdm.click_report` cr
-    #     JOIN `xxx.DASHBOARD_FLAGSHIP.PARADIGM_CAMPAIGN_PERFORMANCE_EDM` c
-    #     ON cr.HYBRIS_ID = c.HYBRIS_ID
-    #     {where_clause}
-    #     GROUP BY 1,2
-    #     ORDER BY 1,2
-
-    # """
-
-
-    QUERY_CLICK_REPORT = f"""
-        SELECT HYBRIS_ID, Pod_adj, max(Height_pct), sum(Click_Rate), sum(CTR), sum(CTR_With_Unsubscribe), coalesce(sum(CR_Excl_Footer), 0), sum(CR_With_Unsubscribe), any_value(Label_Name)
-        FROM `xxx.gcdm.click_report` c
-        {where_clause}
-        GROUP BY 1,2
-        ORDER BY 1,2
+        content_columns = ['ticker', 'text']
+    columns = ['country', 'campaign_id'] + content_columns + ['date', 'campaign_name', 'segment_name', 'delivered', 'opened', 'clicked']
+
+    # Campaign and click report queries (refer to core.query_utils.py)
+    QUERY = qu.campaign_query(channel, columns, order_by=sorting, **filters)
+    QUERY_CLICK_REPORT = qu.click_report_query(
+        ['height', 'click_rate', 'pod_ctr', 'pod_ctr_with_unsub', 'click_rate_excl_footer', 'click_rate_with_unsub', 'label_name'],
+        **filters,
+    )
 
-    """
 
+    # The campaign and click report queries are independent, run them concurrently
+    jobs = bq.JobScheduler()
+    jobs.add('campaign', be.run_query, QUERY, label='get_campaign_data: campaigns')
+    if channel == 'EMAIL':
+        jobs.add('click', be.run_query, QUERY_CLICK_REPORT, label='get_campaign_data: click report')
 
-    df = bq_client.query(QUERY, job_config=job_config).to_dataframe()
+    df = jobs.result('campaign')
 
-    if channel == 'EMAIL':
-        # df = bq_client.query(QUERY_EDM, job_config=job_config).to_dataframe()
-        df.columns = ['country', 'campaign_id', 'subject_line', 'date', 'campaign_name','segment_name', 'delivered', 'engaged', 'clicked']
-    else:
-        # df = bq_client.query(QUERY_PN, job_config=job_config).to_dataframe()
-    
-        df.columns = ['country', 'campaign_id', 'ticker', 'text', 'date', 'campaign_name','segment_name', 'delivered','engaged', 'clicked']
-    df['open_rate'] = (df['engaged'] / df['delivered'] * 100).round(1).astype(str) + '%'
-    df['CTR'] = (df['clicked'] / df['engaged'] * 100).round(1).astype(str) + '%'
+    df['open_rate'] = (df['opened'] / df['delivered'] * 100).round(1).astype(str) + '%'
+    df['CTR'] = (df['clicked'] / df['opened'] * 100).round(1).astype(str) + '%'
     df['country'] = df['country'].str.lower()
 
 
     if channel == 'EMAIL':
-        df_click = bq_client.query(QUERY_CLICK_REPORT, job_config=job_config).to_dataframe()
+        df_click = jobs.result('click')
         if df_click.empty:
             st.write('The search did not return any campaign. Please try a different search!')
             return False
 
-        df_click.columns = ['campaign_id', 'pod', 'height', 'click_rate', 'pod_ctr', 'pod_ctr_with_unsub', 'click_rate_excl_footer', 'click_rate_with_unsub', 'label_name']
-        df_click['pod_count'] = df_click.groupby('campaign_id')['pod'].transform('count')
+        label_map = None
         if click_rate_display == 'Normal':
             click_rate = 'click_rate'
             pod_ctr = 'pod_ctr'
@@ -210,28 +109,63 @@ def get_campaign_data(channel, click_rate_display, sorting, campaign_id=None, ma
         else:
             click_rate = 'click_rate_with_unsub'
             pod_ctr = 'pod_ctr_with_unsub'
-            df_click['label_name'] = np.where(df_click['label_name'] == 'footer', 'unsub', df_click['label_name'])
+            label_map = {'footer': 'unsub'}
 
-        gb = df_click.groupby(['campaign_id', 'pod_count'])[[click_rate, pod_ctr, 'height', 'label_name']].agg(lambda x: list(x)).reset_index()
-        gb.columns = ['campaign_id', 'pod_count', 'click_rate', 'pod_ctr', 'height', 'label_name']
+        # Pods of all campaigns in flat arrays (refer to core.cp_utils.py), labels truncated
+        pods = cp.PodStore.from_click_report(df_click, click_rate=click_rate, pod_ctr=pod_ctr, label_map=label_map)
 
-        gb['label_name'] = gb['label_name'].apply(im.truncate_labels)  #truncate label_name
-
-        data = df.merge(gb, on='campaign_id', how='inner')
+        data = df[df['campaign_id'].isin(pods.campaign_ids)] # only campaigns with a click report
     else:
+        pods = None
         data = df
-    data_dict = data.set_index('campaign_id').to_dict('index') #format: {'0000111111':{'country':'sg', 'curiosity':0.4, 'pod_count':3, 'click_rate':[0.3, 0.2, 0.4], ...}}
+    data_dict = cp.CampaignCollection(data, pods=pods) # dict-like, read as {'0000111111':{'country':'sg', 'pod_count':3, 'click_rate':[0.3, 0.2, 0.4], ...}} without materializing it
 
     return data_dict
 
 
-def display(channel, img_dict, data_dict, click_data_type):
+def get_page_assets(results, page, click_data_type):
+    """
+    Starts fetching the creatives and rendering the click rate bars of a page of results, unless already started.
+    Only the pages next to the requested one, for the current click options, are kept, so memory does not grow
+    with the number of pages visited.
+
+    Returns:
+        dict: {campaign_id: (creative future, click bar future or None)}, in result order.
+    """
+    assets = results['assets']
+    key = (page, results['click_rate_display'], click_data_type)
+    if key not in assets:
+        data_dict = results['data_dict']
+        page_ids = data_dict.campaign_ids[page * CAMPAIGNS_PER_PAGE:(page + 1) * CAMPAIGNS_PER_PAGE]
+        img_futures = im.submit_img_fetches({cid: data_dict[cid] for cid in page_ids}, storage_client=cl.get_storage_client(), bucket_name=results['bucket'])
+        assets[key] = {}
+        for cid, img_future in img_futures.items():
+            bar_future = None
+            if results['channel'] == 'EMAIL':
+                bar_future = im.submit_click_rate_bar(img_future, data_dict[cid].pods(), click_data_type)
+            assets[key][cid] = (img_future, bar_future)
+
+    for other in list(assets):
+        if abs(other[0] - page) > 1 or other[1:] != key[1:]:
+            del assets[other]
+    return assets[key]
+
+
+def go_to_page(page):
+    st.session_state['comparison']['page'] = page
+
+
+def display(channel, page_assets, data_dict):
+    """
+    Displays a page of campaigns progressively: the campaign cards are written straight from the query result
+    with placeholders, and each creative and click rate bar fills its slot as soon as it is ready.
+    """
     if channel == 'EMAIL':
         unit_length = 450
     else:
         unit_length = 350
 
-    display_width = unit_length * len(img_dict)
+    display_width = unit_length * len(page_assets)
     st.markdown(
         f"""
         <style>
@@ -244,18 +178,20 @@ def display(channel, img_dict, data_dict, click_data_type):
         """,
         unsafe_allow_html=True,
     )
+    missing_slot = st.empty() # filled once all creatives are in
 
     col_ratios = []
-    for i in range(len(img_dict)):
+    for i in range(len(page_assets)):
         if channel == 'EMAIL': #80% for image, 20% for click rate bar
-            col_ratios.append(0.75/len(img_dict))
-            col_ratios.append(0.25/len(img_dict))
+            col_ratios.append(0.75/len(page_assets))
+            col_ratios.append(0.25/len(page_assets))
         else:
-            col_ratios.append(0.99/len(img_dict))
+            col_ratios.append(0.99/len(page_assets))
             col_ratios.append(0.01)
     cols = st.columns(col_ratios, gap='medium')
 
-    for i, (k, v) in enumerate(img_dict.items()):
+    slots = {} # {future: (kind, campaign_id, placeholder)}
+    for i, (k, (img_future, bar_future)) in enumerate(page_assets.items()):
         cols[i*2].write(f"{k} | {data_dict[k]['country'].upper()} | {data_dict[k]['date']}")
         cols[i*2].text(f"{data_dict[k]['campaign_name']}")
         cols[i*2].text(f"{data_dict[k]['segment_name']}")
@@ -268,41 +204,90 @@ def display(channel, img_dict, data_dict, click_data_type):
             cols[i*2].text(f"Text: {data_dict[k]['text']}")
             cols[i*2].text(f"Displayed: {cp.human_format(data_dict[k]['delivered'])} | CTR: {data_dict[k]['CTR']}")
             cols[i*2].text('CTR is the percentage of displayed users who clicked Push notifs')    
-        
-        cols[i*2].image(img_dict[k], width=300)
+
+        slots[img_future] = ('creative', k, cols[i*2].empty())
+        slots[img_future][2].caption('Loading creative...')
 
         if channel == 'EMAIL':
             for x in range(5):
                 cols[i*2+1].text("|")
-            cols[i*2+1].image(im.draw_click_rate_bar(img_dict[k], data_dict[k], click_data_type=click_data_type), width=75) 
+            slots[bar_future] = ('click bar', k, cols[i*2+1].empty())
+
+    # Fill the slots in completion order, so the first creative shows as soon as it arrives
+    missing = {}
+    for future in as_completed(slots):
+        kind, k, slot = slots[future]
+        if kind == 'creative':
+            img, reason = im.get_fetch_result(future)
+            if img is None:
+                missing[k] = reason
+                slot.caption(f'Creative unavailable ({reason})')
+            else:
+                slot.image(img, width=300)
+        elif future.exception() is None and future.result() is not None:
+            slot.image(future.result(), width=75)
+
+    if missing:
+        missing_slot.write(f"Creatives could not be fetched for {', '.join(f'{k} ({v})' for k, v in missing.items())}")
 
     return
 
 
+def display_results(results, click_data_type):
+    """
+    Displays one page of the results kept in session state, and starts preparing the next page in the background.
+    Reruns (e.g. changing page) neither query nor touch campaigns outside these two pages.
+    """
+    data_dict = results['data_dict']
+    page_count = -(-len(data_dict) // CAMPAIGNS_PER_PAGE)
+    page = min(results['page'], page_count - 1)
+
+    page_assets = get_page_assets(results, page, click_data_type)
+    if page + 1 < page_count:
+        get_page_assets(results, page + 1, click_data_type) # prefetch, not waited for
+
+    nav = st.columns([0.1, 0.1, 0.8])
+    nav[0].button('Previous', on_click=go_to_page, args=(page - 1,), disabled=page == 0)
+    nav[1].button('Next', on_click=go_to_page, args=(page + 1,), disabled=page + 1 >= page_count)
+    first = page * CAMPAIGNS_PER_PAGE + 1
+    nav[2].write(f"Campaigns {first}-{first + len(page_assets) - 1} of {len(data_dict)} (page {page + 1} of {page_count})")
+
+    display(channel=results['channel'], page_assets=page_assets, data_dict=data_dict)
+
+
 def main():
+    # Results are kept in session state, so that changing page reruns the script without querying again.
+    # The click contribution option and the sorting shape the results (pods and order), changing either after a
+    # search runs it again (from the query cache) with the new options.
+    results = st.session_state.get('comparison')
     if submit_campaign_id:
-        data_dict = get_campaign_data(channel=channel_1, click_rate_display=click_rate_display, sorting=sorting, campaign_id=campaign_id)
-        
-        if channel_1 == 'EMAIL':
-            bucket = edm_bucket
+        search = {'channel': channel_1, 'campaign_id': campaign_id}
+    elif submit_market_date:
+        search = {'channel': channel_2, 'market': market, 'date': date}
+    elif results is not None and (results['click_rate_display'], results['sorting']) != (click_rate_display, sorting):
+        search = results['search']
+    else:
+        search = None
 
-        else:
-            bucket = pn_bucket
+    if search is not None:
+        try:
+            data_dict = get_campaign_data(click_rate_display=click_rate_display, sorting=sorting, **search)
+        except bq.QueryBudgetExceeded as e: # e.g. a date range too wide, with CAP_QUERY_BUDGET_ACTION=refuse
+            st.error(str(e))
+            data_dict = False
 
         if data_dict:
-            img_dict = im.get_img_from_dict(data_dict=data_dict, storage_client=storage_client, bucket_name=bucket)
-            display(channel=channel_1, img_dict=img_dict, data_dict=data_dict, click_data_type=click_data_type)
-    if submit_market_date:
-        data_dict = get_campaign_data(channel=channel_2, click_rate_display=click_rate_display, sorting=sorting, market=market, date=date)
-
-        if channel_2 == 'EMAIL':
-            bucket = edm_bucket
+            bucket = edm_bucket if search['channel'] == 'EMAIL' else pn_bucket
+            page = results['page'] if results is not None and search is results['search'] else 0
+            st.session_state['comparison'] = {
+                'channel': search['channel'], 'bucket': bucket, 'search': search, 'click_rate_display': click_rate_display,
+                'sorting': sorting, 'data_dict': data_dict, 'page': page, 'assets': {},
+            }
         else:
-            bucket = pn_bucket
+            st.session_state.pop('comparison', None)
 
-        if data_dict:
-            img_dict = im.get_img_from_dict(data_dict=data_dict, storage_client=storage_client, bucket_name=bucket)
-            display(channel=channel_2, img_dict=img_dict, data_dict=data_dict, click_data_type=click_data_type)
+    if 'comparison' in st.session_state:
+        display_results(st.session_state['comparison'], click_data_type=click_data_type)
 
 
-main()
\ No newline at end of file
+main()
@@ -1,26 +1,13 @@
 import streamlit as st
-from streamlit_extras.stylable_container import stylable_container
-
-import pandas as pd
-import numpy as np
-
-from google.cloud import bigquery
-from google.oauth2 import service_account
 
 import core.sl_utils as sl
+import core.bp_utils as bp
 import core.chart_utils as ch
-
-import plotly.graph_objects as go
-import matplotlib.pyplot as plt
-from wordcloud import WordCloud
-from random import sample
-
+import core.trace_utils as tr
 
 
 st.set_page_config(layout='wide', page_title='CAP - Subject Line BP')
-
-credentials = service_account.Credentials.from_service_account_file('xxx-6d563dad79b2.json')
-bq_client = bigquery.Client(project='xxx', credentials=credentials)
+tr.start_trace('Subject Line Best Practices') # timing spans of this run carry the session's trace ID (refer to core.trace_utils.py)
 
 
 with st.sidebar:
@@ -39,232 +26,14 @@ with st.sidebar:
     submit_form_pn = form_pn.form_submit_button(label='Apply Filters')
 
 
-def get_cutes_score(market, objective, product):
-    # Set up job configuration with parameters
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter("market", "STRING", market),
-            bigquery.ScalarQueryParameter("objective", "STRING", objective),
-            bigquery.ScalarQueryParameter("product", "STRING", product)
-        ]
-    )
-
-    # Define the query
-    QUERY_CUTES = """
-        WITH bp_campaigns AS (
-            SELECT
-                curiosity, urgency, tone, emotion, specificity
-            FROM
-                content.bp_edm_sl
-            WHERE
-                country = @market
-                AND product = @product
-                AND objective = @objective
-                AND top_flag = '1'
-        ),
-
-        other_campaigns AS (
-            SELECT
-                curiosity, urgency, tone, emotion, specificity
-            FROM
-                content.bp_edm_sl
-            WHERE
-                country = @market
-                AND product = @product
-                AND objective = @objective
-                AND top_flag = '0'
-        ),
-
-        unpivoted_bp_campaigns AS (
-            SELECT
-                variable,
-                value
-            FROM
-                bp_campaigns
-            UNPIVOT (
-                value FOR variable IN (
-                    curiosity, urgency, tone, emotion, specificity
-                )
-            )
-        ),
-
-        unpivoted_other_campaigns AS (
-            SELECT
-                variable,
-                value
-            FROM
-                other_campaigns
-            UNPIVOT (
-                value FOR variable IN (
-                    curiosity, urgency, tone, emotion, specificity
-                )
-            )
-        )
-
-        SELECT
-            bp.variable AS Approach,
-            bp.value AS `Best Performing`,
-            oth.value AS `All Campaigns`,
-            bp.value - oth.value AS Difference
-        FROM
-            unpivoted_bp_campaigns bp
-        JOIN
-            unpivoted_other_campaigns oth
-            ON bp.variable = oth.variable
-    """
-
-    # Run the query and convert to dataframe
-    df_cutes = bq_client.query(QUERY_CUTES, job_config=job_config).to_dataframe()
-    
-    # Return the dataframe with the results
-    return df_cutes
-
-def get_binary_var_bp(market, objective, product):
-    """
-    Fetch and preprocess the binary variable Best Practice data from BigQuery.
-
-    Parameters:
-        market (str): Market name.
-        objective (str): Objective name.
-        product (str): Product name.
-
-    Returns:
-        pd.DataFrame: Processed DataFrame with 'Rank', 'Features', 'Importance_Stars', and 'Recommendation' columns.
-    """
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter("market", "STRING", market),
-            bigquery.ScalarQueryParameter("objective", "STRING", objective),
-            bigquery.ScalarQueryParameter("product", "STRING", product)
-        ]
-    )
-
-    QUERY_BP_BV = """
-        WITH magnitude_data AS (
-            SELECT
-                emoji,personalization,offer,product_name,feature,question,exclamation,ai, length_long, length_med, length_short
-            FROM
-                content.bp_edm_sl
-            WHERE
-                country = @market
-                AND product = @product
-                AND objective = @objective
-                AND top_flag = 'magnitude'
-            ),
-        direction_data AS (
-            SELECT
-                emoji,personalization,offer,product_name,feature,question,exclamation,ai, length_long, length_med, length_short
-            FROM
-                content.bp_edm_sl
-            WHERE
-                country = @market
-                AND product = @product
-                AND objective = @objective
-                AND top_flag = 'direction'
-            ),
-        unpivoted_magnitude AS (
-            SELECT
-                'magnitude' AS top_flag,
-                variable,
-                value
-            FROM
-                magnitude_data
-            UNPIVOT (
-                value FOR variable IN (
-                emoji, personalization, offer, product_name, feature, 
-                question, exclamation, ai, length_long, length_med, length_short
-                )
-            )
-            ),
-        unpivoted_direction AS (
-            SELECT
-                'direction' AS top_flag,
-                variable,
-                value
-            FROM
-                direction_data
-            UNPIVOT (
-                value FOR variable IN (
-                emoji, personalization, offer, product_name, feature, 
-                question, exclamation, ai, length_long, length_med, length_short
-                )
-            )
-            )
-        SELECT
-            m.variable AS Features,
-            ABS(m.value) AS Importance,
-            CASE WHEN d.value < 0 THEN 'Exclude' ELSE 'Include' END AS Recommendation
-        FROM
-            unpivoted_magnitude m
-        JOIN
-            unpivoted_direction d
-        ON m.variable = d.variable
-        ORDER BY 2 DESC
-    """
-
-    # Fetch the data from BigQuery
-    df_bv_bp = bq_client.query(QUERY_BP_BV, job_config=job_config).to_dataframe()
-
-    # Preprocess the DataFrame
-    def importance_to_stars(value, max_value=1.0, char="*"):
-        max_stars = 20  # Total number of stars for max progress
-        num_stars = int((value / max_value) * max_stars)
-        return char * num_stars
-    
-    # Filter for rows where Recommendation is 'Include'
-    df_bv_bp = df_bv_bp[df_bv_bp["Recommendation"] == "Include"].reset_index(drop=True)
-
-    # Add a "Rank" column starting from 1
-    df_bv_bp.insert(0, "Rank", range(1, len(df_bv_bp) + 1))
-
-    # Add a new column with star-based progress representation
-    df_bv_bp["Importance_Stars"] = df_bv_bp["Importance"].apply(importance_to_stars)
-
-    return df_bv_bp
-
-def best_sl(market, objective, product):
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter("market", "STRING", market),
-            bigquery.ScalarQueryParameter("objective", "STRING", objective),
-            bigquery.ScalarQueryParameter("product", "STRING", product)
-        ]
-    )
-
-    QUERY_BEST_SL = """
-        SELECT subject_line, rank, country, product, objective
-        FROM xxx.content.bp_edm_sl_perf
-        WHERE top_flag=1 AND country = @market AND product = @product AND objective = @objective
-    """
-
-    df_best_sl = bq_client.query(QUERY_BEST_SL, job_config=job_config).to_dataframe()
-    return df_best_sl
-
-def other_sl(market, objective, product):
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter("market", "STRING", market),
-            bigquery.ScalarQueryParameter("objective", "STRING", objective),
-            bigquery.ScalarQueryParameter("product", "STRING", product)
-        ]
-    )
-
-    QUERY_BEST_SL = """
-        SELECT subject_line, rank
-        FROM xxx.content.bp_edm_sl_perf
-        WHERE top_flag=0 AND country = @market AND product = @product AND objective = @objective
-    """
-
-    df_other_sl = bq_client.query(QUERY_BEST_SL, job_config=job_config).to_dataframe()
-    return df_other_sl    
-
-
 if submit_form_edm:
+    from streamlit_extras.stylable_container import stylable_container # only needed once a form is submitted
 
     st.header('EMAIL Subject Line Best Practices')
-    # Data required for first container
-    df_bv_bp = get_binary_var_bp(market, objective, product)
-    df_cutes = get_cutes_score(market, objective, product)  
+    # All data for the page, fetched in one query (refer to core.bp_utils.py)
+    best_practice = bp.get_best_practice('EMAIL', market, objective=objective, product=product)
+    df_bv_bp = best_practice['features']
+    df_cutes = best_practice['cutes']
      
     # First container with analysis
     with stylable_container(
@@ -315,15 +84,6 @@ if submit_form_edm:
         # Right column: Feature Analysis
         cols_sl[1].subheader("Feature Analysis")
 
-        # Function to convert `Importance` into progress bar string
-        def importance_to_stars(value, max_value=1.0, char="*"):
-            max_stars = 20  # Total number of stars for max progress
-            num_stars = int((value / max_value) * max_stars)
-            return char * num_stars
-
-        # Add a new column with star-based progress representation
-        df_bv_bp["Importance_Stars"] = df_bv_bp["Importance"].apply(importance_to_stars)
-
         cols_sl[1].data_editor(
             df_bv_bp[["Rank", "Features", "Importance_Stars", "Recommendation"]], 
             column_config={
@@ -360,8 +120,8 @@ if submit_form_edm:
     ):
         st.subheader("Top 10 Best Performing Subject Lines")
 
-        # Fetch the best performing subject lines (assume df_best_sl is already fetched)
-        df_best_sl = best_sl(market, objective, product)
+        # Best performing subject lines
+        df_best_sl = best_practice['best_sl']
         
         # Display the top 10 subject lines sorted by rank
         top_10_sl = df_best_sl.sort_values('rank').head(10)['subject_line'].to_list()
@@ -379,11 +139,10 @@ if submit_form_edm:
             border-radius: 10px; 
             box-shadow: 0 4px 8px rgba(0, 0, 0, 0.1);}""",
         ):
-        # Fetch the best performing subject lines and concatenate into one string
-        df_best_sl = best_sl(market, objective, product)  
+        # Concatenate the best performing subject lines into one string
         bp_text = " ".join(df_best_sl['subject_line'].dropna())         
-        # Fetch the other subject lines and concatenate into one string
-        df_other_sl = other_sl(market, objective, product)  
+        # Concatenate the other subject lines into one string
+        df_other_sl = best_practice['other_sl']
         oth_text = " ".join(df_other_sl['subject_line'].dropna())
 
         # Generate the circular word clouds
@@ -394,220 +153,39 @@ if submit_form_edm:
         col3, col4, = st.columns(2)
         with col3:
             st.subheader("Words used in most engaged subject lines")
-            st.pyplot(wc_best)
+            st.image(wc_best)
         with col4:
             st.subheader("Words used in other subject lines")
-            st.pyplot(wc_others)
+            st.image(wc_others)
+
+        # Terms that set the best performing subject lines apart, ranked by confidence (refer to core.sl_utils.py)
+        df_terms = sl.get_distinctive_terms(df_best_sl['subject_line'], df_other_sl['subject_line'])
+        terms_column_config = {
+            "Best Performing": st.column_config.NumberColumn(help="Number of best performing subject lines using the term"),
+            "Other": st.column_config.NumberColumn(help="Number of other subject lines using the term"),
+            "Z-Score": st.column_config.NumberColumn(help="Confidence of the difference, above 1.96 is significant at 95%", format="%.1f"),
+        }
+        terms_columns = ["Term", "Best Performing", "Other", "Z-Score"]
+
+        col5, col6, = st.columns(2)
+        with col5:
+            st.subheader("Terms over-used in most engaged subject lines")
+            st.dataframe(df_terms.loc[df_terms['Over-used in'] == 'Best Performing', terms_columns], column_config=terms_column_config, hide_index=True)
+        with col6:
+            st.subheader("Terms over-used in other subject lines")
+            st.dataframe(df_terms.loc[df_terms['Over-used in'] == 'Other', terms_columns], column_config=terms_column_config, hide_index=True)
 
 
 ### PUSH
 
-def get_cutes_score_pn(market):
-    # Set up job configuration with parameters
-    job_config = bigquery.QueryJobConfig(
-            query_parameters=[
-            bigquery.ScalarQueryParameter("market", "STRING", market)
-        ]
-    )
-
-    # Define the query
-    QUERY_CUTES = """
-        WITH bp_campaigns AS (
-            SELECT
-                curiosity, urgency, tone, emotion, specificity
-            FROM
-                content.bp_pn_sl
-            WHERE
-                country = @market
-                AND top_flag = '1'
-        ),
-
-        other_campaigns AS (
-            SELECT
-                curiosity, urgency, tone, emotion, specificity
-            FROM
-                content.bp_pn_sl
-            WHERE
-                country = @market
-                AND top_flag = '0'
-        ),
-
-        unpivoted_bp_campaigns AS (
-            SELECT
-                variable,
-                value
-            FROM
-                bp_campaigns
-            UNPIVOT (
-                value FOR variable IN (
-                    curiosity, urgency, tone, emotion, specificity
-                )
-            )
-        ),
-
-        unpivoted_other_campaigns AS (
-            SELECT
-                variable,
-                value
-            FROM
-                other_campaigns
-            UNPIVOT (
-                value FOR variable IN (
-                    curiosity, urgency, tone, emotion, specificity
-                )
-            )
-        )
-
-        SELECT
-            bp.variable AS Approach,
-            bp.value AS `Best Performing`,
-            oth.value AS `All Campaigns`,
-            bp.value - oth.value AS Difference
-        FROM
-            unpivoted_bp_campaigns bp
-        JOIN
-            unpivoted_other_campaigns oth
-            ON bp.variable = oth.variable
-    """
-
-    # Run the query and convert to dataframe
-    df_cutes = bq_client.query(QUERY_CUTES, job_config=job_config).to_dataframe()
-    
-    # Return the dataframe with the results
-    return df_cutes
-
-def get_binary_var_bp_pn(market):
-    """
-    Fetch and preprocess the binary variable Best Practice data from BigQuery.
-
-    Parameters:
-        market (str): Market name.
-
-    Returns:
-        pd.DataFrame: Processed DataFrame with 'Rank', 'Features', 'Importance_Stars', and 'Recommendation' columns.
-    """
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter("market", "STRING", market)
-        ]
-    )
-    QUERY_BP_BV = """
-        WITH magnitude_data AS (
-            SELECT
-                emoji,personalization,offer,product_name,feature,question,exclamation,ai, length_long, length_med, length_short
-            FROM
-                content.bp_pn_sl
-            WHERE
-                country = @market
-                AND top_flag = 'magnitude'
-            ),
-        direction_data AS (
-            SELECT
-                emoji,personalization,offer,product_name,feature,question,exclamation,ai, length_long, length_med, length_short
-            FROM
-                content.bp_pn_sl
-            WHERE
-                country = @market
-                AND top_flag = 'direction'
-            ),
-        unpivoted_magnitude AS (
-            SELECT
-                'magnitude' AS top_flag,
-                variable,
-                value
-            FROM
-                magnitude_data
-            UNPIVOT (
-                value FOR variable IN (
-                emoji, personalization, offer, product_name, feature, 
-                question, exclamation, ai, length_long, length_med, length_short
-                )
-            )
-            ),
-        unpivoted_direction AS (
-            SELECT
-                'direction' AS top_flag,
-                variable,
-                value
-            FROM
-                direction_data
-            UNPIVOT (
-                value FOR variable IN (
-                emoji, personalization, offer, product_name, feature, 
-                question, exclamation, ai, length_long, length_med, length_short
-                )
-            )
-            )
-        SELECT
-            m.variable AS Features,
-            ABS(m.value) AS Importance,
-            CASE WHEN d.value < 0 THEN 'Exclude' ELSE 'Include' END AS Recommendation
-        FROM
-            unpivoted_magnitude m
-        JOIN
-            unpivoted_direction d
-        ON m.variable = d.variable
-        ORDER BY 2 DESC
-    """
-
-    # Fetch the data from BigQuery
-    df_bv_bp = bq_client.query(QUERY_BP_BV, job_config=job_config).to_dataframe()
-
-    # Preprocess the DataFrame
-    def importance_to_stars(value, max_value=1.0, char="*"):
-        max_stars = 20  # Total number of stars for max progress
-        num_stars = int((value / max_value) * max_stars)
-        return char * num_stars
-    
-    # Filter for rows where Recommendation is 'Include'
-    df_bv_bp = df_bv_bp[df_bv_bp["Recommendation"] == "Include"].reset_index(drop=True)
-
-    # Add a "Rank" column starting from 1
-    df_bv_bp.insert(0, "Rank", range(1, len(df_bv_bp) + 1))
-
-    # Add a new column with star-based progress representation
-    df_bv_bp["Importance_Stars"] = df_bv_bp["Importance"].apply(importance_to_stars)
-
-    return df_bv_bp
-
-def best_sl_pn(market):
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter("market", "STRING", market)
-        ]
-    )
-
-    QUERY_BEST_SL = """
-        SELECT subject_line, rank, country
-        FROM xxx.content.bp_pn_sl_perf
-        WHERE top_flag=1 AND country = @market
-    """
-
-    df_best_sl = bq_client.query(QUERY_BEST_SL, job_config=job_config).to_dataframe()
-    return df_best_sl
-
-def other_sl_pn(market):
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter("market", "STRING", market)
-        ]
-    )
-    QUERY_BEST_SL = """
-        SELECT subject_line, rank
-        FROM xxx.content.bp_pn_sl_perf
-        WHERE top_flag=0 AND country = @market 
-    """
-
-    df_other_sl = bq_client.query(QUERY_BEST_SL, job_config=job_config).to_dataframe()
-    return df_other_sl    
-
-
 if submit_form_pn:
+    from streamlit_extras.stylable_container import stylable_container # only needed once a form is submitted
     st.header('PUSH Title Best Practices')
 
-    # Data required for first container
-    df_bv_bp = get_binary_var_bp_pn(market)
-    df_cutes = get_cutes_score_pn(market)  
+    # All data for the page, fetched in one query (refer to core.bp_utils.py)
+    best_practice = bp.get_best_practice('PUSH', market)
+    df_bv_bp = best_practice['features']
+    df_cutes = best_practice['cutes']
      
     # First container with analysis
     with stylable_container(
@@ -658,15 +236,6 @@ if submit_form_pn:
         # Right column: Feature Analysis
         cols_sl[1].subheader("Feature Analysis")
 
-        # Function to convert `Importance` into progress bar string
-        def importance_to_stars(value, max_value=1.0, char="*"):
-            max_stars = 20  # Total number of stars for max progress
-            num_stars = int((value / max_value) * max_stars)
-            return char * num_stars
-
-        # Add a new column with star-based progress representation
-        df_bv_bp["Importance_Stars"] = df_bv_bp["Importance"].apply(importance_to_stars)
-
         cols_sl[1].data_editor(
             df_bv_bp[["Rank", "Features", "Importance_Stars", "Recommendation"]], 
             column_config={
@@ -703,8 +272,8 @@ if submit_form_pn:
     ):
         st.subheader("Top 10 Best Performing Push Titles")
 
-        # Fetch the best performing subject lines (assume df_best_sl is already fetched)
-        df_best_sl = best_sl_pn(market)
+        # Best performing subject lines
+        df_best_sl = best_practice['best_sl']
         
         # Display the top 10 subject lines sorted by rank
         top_10_sl = df_best_sl.sort_values('rank').head(10)['subject_line'].to_list()
@@ -722,11 +291,10 @@ if submit_form_pn:
             border-radius: 10px; 
             box-shadow: 0 4px 8px rgba(0, 0, 0, 0.1);}""",
         ):
-        # Fetch the best performing subject lines and concatenate into one string
-        df_best_sl = best_sl_pn(market)  
+        # Concatenate the best performing subject lines into one string
         bp_text = " ".join(df_best_sl['subject_line'].dropna())         
-        # Fetch the other subject lines and concatenate into one string
-        df_other_sl = other_sl_pn(market)  
+        # Concatenate the other subject lines into one string
+        df_other_sl = best_practice['other_sl']
         oth_text = " ".join(df_other_sl['subject_line'].dropna())
 
         # Generate the circular word clouds
@@ -737,7 +305,24 @@ if submit_form_pn:
         col3, col4, = st.columns(2)
         with col3:
             st.subheader("Words used in most engaged Push Titles")
-            st.pyplot(wc_best)
+            st.image(wc_best)
         with col4:
             st.subheader("Words used in other Push Titles")
-            st.pyplot(wc_others)
+            st.image(wc_others)
+
+        # Terms that set the best performing Push Titles apart, ranked by confidence (refer to core.sl_utils.py)
+        df_terms = sl.get_distinctive_terms(df_best_sl['subject_line'], df_other_sl['subject_line'])
+        terms_column_config = {
+            "Best Performing": st.column_config.NumberColumn(help="Number of best performing Push Titles using the term"),
+            "Other": st.column_config.NumberColumn(help="Number of other Push Titles using the term"),
+            "Z-Score": st.column_config.NumberColumn(help="Confidence of the difference, above 1.96 is significant at 95%", format="%.1f"),
+        }
+        terms_columns = ["Term", "Best Performing", "Other", "Z-Score"]
+
+        col5, col6, = st.columns(2)
+        with col5:
+            st.subheader("Terms over-used in most engaged Push Titles")
+            st.dataframe(df_terms.loc[df_terms['Over-used in'] == 'Best Performing', terms_columns], column_config=terms_column_config, hide_index=True)
+        with col6:
+            st.subheader("Terms over-used in other Push Titles")
+            st.dataframe(df_terms.loc[df_terms['Over-used in'] == 'Other', terms_columns], column_config=terms_column_config, hide_index=True)